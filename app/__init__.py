@@ -51,33 +51,32 @@ def create_app(config_name='default'):
     app.register_blueprint(api_bp, url_prefix='/api')
     app.register_blueprint(auth_bp)
 
+    # ── 重新套用上次結束前未寫回 Excel 的儲存格修改 ─────────────────
+    with app.app_context():
+        from app.models.inventory import replay_casting_edits, init_casting_store
+        replay_casting_edits()
+        # 資料庫模式：同步鑄件盤點資料庫（首次啟用時由活頁簿匯入）
+        init_casting_store()
+
     # ── 背景預熱快取 ────────────────────────────────────────────────
+    # 預熱、定時更新與使用者請求都經由快取登錄表的 single-flight 路徑，
+    # 同一資料集同時只會重建一次，請求碰到預熱中的資料會等待並共用結果。
     def _warmup_cache():
         """伺服器啟動後在背景預先載入所有耗時資料，讓第一次使用者請求秒回。"""
-        import time
         with app.app_context():
-            try:
-                t0 = time.time()
-                print("[WARMUP] 開始預熱快取...")
-                from app.models.inventory import load_casting_inventory
-                load_casting_inventory()
-                print(f"[WARMUP] inventory OK ({(time.time()-t0)*1000:.0f} ms)")
-
-                from app.models.order import load_orders
-                load_orders()
-                print(f"[WARMUP] orders OK ({(time.time()-t0)*1000:.0f} ms)")
-
-                from app.models.shortage import calculate_shortage
-                calculate_shortage()
-                print(f"[WARMUP] shortage OK ({(time.time()-t0)*1000:.0f} ms)")
-
-                from app.models.lifting import load_lifting_inventory
-                load_lifting_inventory()
-                print(f"[WARMUP] lifting OK ({(time.time()-t0)*1000:.0f} ms)")
-
-                print(f"[WARMUP] 快取預熱完成，總耗時 {(time.time()-t0)*1000:.0f} ms")
-            except Exception as e:
-                print(f"[WARMUP] 預熱失敗: {e}")
+            from app.models.cache_registry import warm_up
+            from app.models.inventory import load_casting_inventory
+            from app.models.order import load_orders
+            from app.models.shortage import calculate_shortage
+            from app.models.lifting import load_lifting_inventory
+            print("[WARMUP] 開始預熱快取...")
+            total_ms = warm_up([
+                ('inventory', load_casting_inventory),
+                ('orders', load_orders),
+                ('shortage', calculate_shortage),
+                ('lifting', load_lifting_inventory)
+            ], '[WARMUP]')
+            print(f"[WARMUP] 快取預熱完成，總耗時 {total_ms:.0f} ms")
 
     import threading
     _t = threading.Thread(target=_warmup_cache, daemon=True, name="cache-warmup")
@@ -98,10 +97,10 @@ def create_app(config_name='default'):
                     if last_run_tag != run_tag:
                         with app.app_context():
                             print(f"[SCHEDULE] 執行每日定時更新缺料與工單系統 ({run_tag})...")
+                            from app.models.cache_registry import warm_up
                             from app.models.order import load_orders
                             from app.models.shortage import calculate_shortage
-                            load_orders()
-                            calculate_shortage()
+                            warm_up([('orders', load_orders), ('shortage', calculate_shortage)], '[SCHEDULE]')
                             print(f"[SCHEDULE] 定時更新完成。")
                         last_run_tag = run_tag
             except Exception as e:
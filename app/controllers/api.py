@@ -1,17 +1,26 @@
 from flask import Blueprint, jsonify, request, session
 from flask_login import login_required, current_user
 from datetime import datetime
-from ..models.inventory import load_casting_inventory, get_part_details, update_cell, get_edit_history, get_zero_inventory_models
+from ..models.inventory import load_casting_inventory, get_part_details, update_cells, get_edit_history, get_zero_inventory_models
+from ..models.model_names import normalize_model_name, canonical_model_name
 from ..models.order import load_orders
 from ..models.lifting import load_lifting_inventory, update_lifting_status
 from ..models.material_request import (
     get_delivery_records, add_delivery_record, update_delivery_record, delete_delivery_record,
     get_shipping_records, add_shipping_request, delete_shipping_record, update_shipping_signature
 )
+from ..models.write_queue import WriteQueueFull, write_queue_stats
+from ..models.edit_history import EditHistory
 from .. import socketio
 
 api_bp = Blueprint('api', __name__)
 
+
+@api_bp.errorhandler(WriteQueueFull)
+def handle_write_queue_full(e):
+    """寫入佇列已滿：請使用者稍後再試"""
+    return jsonify({'success': False, 'error': str(e)}), 503
+
 def calculate_supply_demand():
     """計算供需狀況"""
     from ..models.shortage import calculate_shortage
@@ -72,7 +81,8 @@ def calculate_supply_demand():
 
 @api_bp.route('/inventory')
 def api_inventory():
-    data = load_casting_inventory()
+    # 快取資料由所有請求共用，不可直接修改
+    data = dict(load_casting_inventory())
     data['timestamp'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     return jsonify(data)
 
@@ -81,7 +91,7 @@ def api_inventory():
 def api_orders():
     if not current_user.is_admin():
         return jsonify({'error': '權限不足'}), 403
-    data = load_orders()
+    data = dict(load_orders())
     data['timestamp'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     return jsonify(data)
 
@@ -93,11 +103,9 @@ def api_finished_orders_requirements():
         return jsonify({'error': '權限不足'}), 403
     try:
         import pandas as pd
-        from ..models.order import get_picking_data, PICKING_CACHE
+        from ..models.order import get_picking_raw_df
         # 確保快取已載入
-        get_picking_data()
-        
-        raw_df = PICKING_CACHE.get('raw_df')
+        raw_df = get_picking_raw_df()
         if raw_df is None:
             return jsonify({'error': '資料尚未載入'}), 500
             
@@ -226,6 +234,23 @@ def api_summary():
     response.headers['Expires'] = '0'
     return response
 
+@api_bp.route('/cache/stats')
+@login_required
+def api_cache_stats():
+    """各快取資料集的命中 / 重建統計、各活頁簿寫入佇列的深度與等待時間、寫入日誌的寫回狀態，以及各檔案目前的世代編號"""
+    if not current_user.is_admin():
+        return jsonify({'error': '權限不足'}), 403
+    from ..models.cache_registry import registry
+    from ..models.fingerprint import file_generations
+    from ..models.inventory import journal_writer_stats
+    return jsonify({
+        'datasets': registry.stats(),
+        'write_queues': write_queue_stats(),
+        'journal_writers': journal_writer_stats(),
+        'file_generations': file_generations(),
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    })
+
 @api_bp.route('/inventory/zero-stock')
 def api_zero_stock():
     """獲取總數為0的鑄件機型"""
@@ -255,9 +280,13 @@ def api_search_model(model_name):
         finished = inventory.get('finished', {})
         all_models = inventory.get('all_models', {})
         
-        # 查找機型
+        # 查找機型（名稱寫法不同時，以標準化鍵對應到總表機型）
         if model_name not in all_models:
-            return jsonify({'found': False, 'model': model_name, 'message': '找不到此機型'})
+            canonical = canonical_model_name(model_name)
+            if canonical not in all_models:
+                return jsonify({'found': False, 'model': model_name, 'message': '找不到此機型'})
+            model_name = canonical
+        norm_key = normalize_model_name(model_name)
         
         model_data = all_models[model_name]
         
@@ -269,6 +298,8 @@ def api_search_model(model_name):
             
             # 找到該機型的資料
             model_row = next((r for r in rows if r.get('機型') == model_name), None)
+            if model_row is None:
+                model_row = next((r for r in rows if normalize_model_name(r.get('機型')) == norm_key), None)
             
             if model_row:
                 # 根據不同零件計算半品和成品
@@ -321,6 +352,25 @@ def api_part_details(part_type):
     data = get_part_details(part_type)
     return jsonify(data)
 
+def _emit_inventory_updates(part_type, username, rows):
+    """以單一 data_updated 事件廣播 update_cells 成功的所有修改，回傳修改筆數"""
+    updates = [{
+        'item_id': row['item_id'],
+        'model_name': row['model_name'],
+        'field': change['field'],
+        'old_value': change['old_value'],
+        'new_value': change['new_value'],
+        'total': change['total']
+    } for row in rows if row['success'] for change in row['changes']]
+    if updates:
+        socketio.emit('data_updated', {
+            'part': part_type,
+            'updates': updates,
+            'user': username,
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        })
+    return len(updates)
+
 @api_bp.route('/inventory/update/<part_type>', methods=['POST'])
 def api_update_inventory(part_type):
     """更新鑄件製程數據"""
@@ -360,32 +410,21 @@ def api_update_inventory(part_type):
         
         # 使用已驗證的使用者名稱
         
-        results = []
-        for field, new_value in updates.items():
-            result = update_cell(part_type, item_id, field, new_value, username, model_name=model_name)
-            if result.get('success'):
-                # 使用更新後的 item_id (如果有的話)
-                actual_item_id = result.get('item_id', item_id)
-                
-                # 透過 SocketIO 廣播更新
-                socketio.emit('data_updated', {
-                    'part': part_type,
-                    'item_id': actual_item_id,
-                    'model_name': model_name,
-                    'field': field,
-                    'old_value': result.get('old_value'),
-                    'new_value': new_value,
-                    'total': result.get('total'),
-                    'user': username,
-                    'timestamp': datetime.now().strftime('%H:%M:%S')
-                })
-                # 在結果中包含更新後的品號
-                result['item_id'] = actual_item_id
-                results.append(result)
-            else:
-                return jsonify({'success': False, 'error': result.get('error')})
+        result = update_cells(part_type, [{'item_id': item_id, 'model_name': model_name, 'updates': updates}], username)
+        if not result['success']:
+            rows = result['results']
+            return jsonify({'success': False, 'error': rows[0].get('error') if rows else result.get('error')})
+        
+        # 透過 SocketIO 廣播更新
+        row = result['results'][0]
+        _emit_inventory_updates(part_type, username, [row])
         
+        # 在結果中包含更新後的品號
+        results = [{'success': True, 'old_value': change['old_value'], 'total': change['total'], 'item_id': row['item_id']}
+                   for change in row['changes']]
         return jsonify({'success': True, 'results': results})
+    except WriteQueueFull:
+        raise
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -416,33 +455,19 @@ def api_batch_update_inventory(part_type):
         data = request.get_json()
         rows = data.get('rows', [])
         
-        all_results = []
-        for row_data in rows:
-            item_id = row_data.get('item_id')
-            model_name = row_data.get('model_name')
-            updates = row_data.get('updates', {})
-            
-            for field, new_value in updates.items():
-                result = update_cell(part_type, item_id, field, new_value, username, model_name=model_name)
-                if result.get('success'):
-                    actual_item_id = result.get('item_id', item_id)
-                    socketio.emit('data_updated', {
-                        'part': part_type,
-                        'item_id': actual_item_id,
-                        'model_name': model_name,
-                        'field': field,
-                        'old_value': result.get('old_value'),
-                        'new_value': new_value,
-                        'total': result.get('total'),
-                        'user': username,
-                        'timestamp': datetime.now().strftime('%H:%M:%S')
-                    })
-                    result['item_id'] = actual_item_id
-                    all_results.append(result)
-                else:
-                    return jsonify({'success': False, 'error': f"品號 {item_id} 更新失敗: {result.get('error')}"})
-                    
-        return jsonify({'success': True, 'count': len(all_results)})
+        # 所有列一次處理：單一日誌交易、一次歷程寫入、一個廣播事件
+        result = update_cells(part_type, rows, username)
+        if 'error' in result:
+            return jsonify({'success': False, 'error': result['error']})
+        
+        count = _emit_inventory_updates(part_type, username, result['results'])
+        response = {'success': result['success'], 'count': count, 'results': result['results']}
+        failed = [r for r in result['results'] if not r['success']]
+        if failed:
+            response['error'] = '；'.join(f"品號 {r['item_id'] or r['model_name']} 更新失敗: {r['error']}" for r in failed)
+        return jsonify(response)
+    except WriteQueueFull:
+        raise
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -675,6 +700,10 @@ def api_stock_history():
     date_from = request.args.get('date_from')        # YYYY-MM-DD
     date_to = request.args.get('date_to')            # YYYY-MM-DD
     keyword = request.args.get('keyword')            # 關鍵字
+    cursor = request.args.get('cursor', type=int)    # 上一頁的 next_cursor
+    limit = request.args.get('limit', 200, type=int)
+    if not 1 <= limit <= EditHistory.MAX_PAGE_SIZE:
+        return jsonify({'success': False, 'error': f'每頁筆數必須介於 1 到 {EditHistory.MAX_PAGE_SIZE}'}), 400
     
     try:
         result = get_stock_history(
@@ -682,12 +711,15 @@ def api_stock_history():
             part_type=part_type,
             date_from=date_from,
             date_to=date_to,
-            keyword=keyword
+            keyword=keyword,
+            limit=limit,
+            cursor=cursor
         )
         return jsonify({
             'success': True,
             'records': result['records'],
             'stats': result['stats'],
+            'next_cursor': result['next_cursor'],
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         })
     except Exception as e:
@@ -711,8 +743,9 @@ def stock_in():
         work_order_code = data.get('work_order_code')
         barcode = data.get('barcode')
         purchase_order = data.get('purchase_order')
+        lines = data.get('lines')  # 多筆明細 [{'model', 'quantity', ...}]，一次完成
         
-        if not part_name or not quantity:
+        if not part_name or not (quantity or lines):
             return jsonify({'success': False, 'error': '缺少必要參數'}), 400
         
         # 調用 inventory.py 中的入庫函數
@@ -725,7 +758,8 @@ def stock_in():
             user=current_user.username,
             work_order_code=work_order_code,
             barcode=barcode,
-            purchase_order=purchase_order
+            purchase_order=purchase_order,
+            lines=lines
         )
         
         if result['success']:
@@ -735,6 +769,8 @@ def stock_in():
         else:
             return jsonify(result), 400
             
+    except WriteQueueFull:
+        raise
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -754,8 +790,9 @@ def stock_out():
         quantity = data.get('quantity')
         model = data.get('model')
         purchase_order = data.get('purchase_order')
+        lines = data.get('lines')  # 多筆明細 [{'model', 'quantity', ...}]，全部成功或全部不執行
         
-        if not part_name or not quantity:
+        if not part_name or not (quantity or lines):
             return jsonify({'success': False, 'error': '缺少必要參數'}), 400
         
         # 調用 inventory.py 中的出庫函數
@@ -768,7 +805,8 @@ def stock_out():
             model=model, 
             purchase_order=purchase_order, 
             supplier=supplier,
-            user=current_user.username
+            user=current_user.username,
+            lines=lines
         )
         
         if result['success']:
@@ -778,6 +816,46 @@ def stock_out():
         else:
             return jsonify(result), 400
             
+    except WriteQueueFull:
+        raise
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@api_bp.route('/stock/transaction', methods=['POST'])
+@login_required
+def stock_transaction():
+    """多零件出入庫交易 API - 多筆出入庫全部成功或全部不執行"""
+    # 檢查權限：只有管理員可以操作
+    if not current_user.is_admin():
+        return jsonify({'success': False, 'error': '權限不足：只有管理員可以執行出入庫操作'}), 403
+
+    try:
+        data = request.get_json()
+        movements = data.get('movements')  # [{'action': 'in'|'out', 'part_name', 'model', 'quantity', ...}]
+        work_order = data.get('work_order')
+
+        if not movements:
+            return jsonify({'success': False, 'error': '缺少必要參數'}), 400
+
+        from ..models.inventory import stock_transaction as run_stock_transaction
+        result = run_stock_transaction(
+            movements,
+            user=current_user.username,
+            work_order=work_order,
+            supplier=data.get('supplier')
+        )
+
+        if result['success']:
+            # 通知所有客戶端更新數據
+            socketio.emit('data_updated', {'type': 'stock_transaction', 'work_order': work_order,
+                                           'parts': [m['part_name'] for m in result['movements']]})
+            return jsonify(result)
+        else:
+            return jsonify(result), 400
+
+    except WriteQueueFull:
+        raise
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -0,0 +1,54 @@
+"""
+檔案的原子寫入
+先寫入同目錄的暫存檔並 fsync，再以 os.replace 取代原檔（同一檔案系統上為原子操作），最後 fsync 所在目錄。
+讀取者（快照、背景寫回、辦公室開啟的 Excel）看到的一定是完整的舊版或新版，不會讀到寫到一半的 zip；
+寫入過程失敗或中斷時原檔保持不變，只留下（並清除）暫存檔。
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+def _fsync_dir(directory):
+    """讓 rename 本身也寫入磁碟（Windows 不支援開啟目錄，略過）"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def atomic_write(path, prefix='.~save-'):
+    """以 with 使用：對產生的暫存檔路徑寫入完整內容，離開區塊時 fsync 並原子取代 path
+
+    暫存檔建立在同一目錄（os.replace 需要同一檔案系統），沿用原檔的權限。
+    """
+    path = os.path.abspath(path)
+    directory = os.path.dirname(path)
+    suffix = os.path.splitext(path)[1]
+    fd, tmp_path = tempfile.mkstemp(prefix=prefix, suffix=suffix, dir=directory)
+    os.close(fd)
+    try:
+        yield tmp_path
+        with open(tmp_path, 'rb+') as f:
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _fsync_dir(directory)
+
+
+def save_workbook(wb, path):
+    """openpyxl 活頁簿的原子儲存（取代 wb.save(path) 的原地覆寫）"""
+    with atomic_write(path) as tmp_path:
+        wb.save(tmp_path)
@@ -0,0 +1,428 @@
+"""
+統一快取登錄表
+每個衍生資料集宣告自己的輸入（檔案或檔案中的單一分頁、其他資料集、時間標記），
+輸入的組合決定快取鍵；任何上游變動都會沿著相依關係傳遞，只重建受影響的下游資料。
+同一資料集同時只會有一個重建在進行，其餘呼叫者等待並共用同一份結果（single-flight）。
+每個資料集以不可變的 Published 物件整體替換，讀取者不會看到拆開的半新半舊狀態；
+已有舊版本時讀取者不等待重建，直接取得舊版本，由背景執行緒重建後再替換。
+本程序自己修改檔案時（apply_change），登錄了 delta 的資料集以修改內容直接更新已發布的版本，不需重建。
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app, has_app_context
+
+from .fingerprint import file_fingerprint
+from .snapshot_store import read_snapshot, write_snapshot
+
+
+class FileInput:
+    """檔案輸入，以內容指紋判斷是否變更"""
+
+    def __init__(self, path_fn, optional=False):
+        self.path_fn = path_fn
+        self.optional = optional
+
+    def key(self, registry):
+        path = self.path_fn()
+        if self.optional and not os.path.exists(path):
+            return None
+        return file_fingerprint(path)
+
+
+class FilePartInput:
+    """檔案中的一部分（例如活頁簿的單一分頁），只在該部分變更時失效
+
+    part_key_fn(path) 回傳該部分的識別，必須比計算整個檔案的內容雜湊便宜
+    """
+
+    def __init__(self, path_fn, part_key_fn):
+        self.path_fn = path_fn
+        self.part_key_fn = part_key_fn
+
+    def key(self, registry):
+        return self.part_key_fn(self.path_fn())
+
+
+class DatasetInput:
+    """其他資料集作為輸入（先確保上游已發布，再取其快取鍵）"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def key(self, registry):
+        registry.get(self.name)
+        return registry.published_key(self.name)
+
+
+class TagInput:
+    """時間標記等非檔案輸入"""
+
+    def __init__(self, tag_fn):
+        self.tag_fn = tag_fn
+
+    def key(self, registry):
+        return self.tag_fn()
+
+
+# 已發布的版本：快取鍵與資料一起發布，讀取者一次取得同一版本，不會拿到新鍵配舊資料
+Published = namedtuple('Published', ['key', 'data', 'built_at'])
+
+
+class _Flight:
+    """進行中的重建；等待者在 done 後讀取 data / error"""
+
+    def __init__(self, key, seq):
+        self.key = key
+        self.seq = seq
+        self.done = threading.Event()
+        self.data = None
+        self.error = None
+
+
+class CacheEntry:
+    def __init__(self, name, builder, inputs, persist=None, cache_if=None, delta=None):
+        self.name = name
+        self.builder = builder
+        self.inputs = tuple(inputs)
+        self.persist = persist        # SnapshotCodec，None 表示只存在記憶體
+        self.cache_if = cache_if      # 回傳 False 的結果不快取（例如空清單）
+        # delta(舊資料, 變更) -> 新資料；回傳同一物件表示不受影響，None 表示無法增量更新（改為重建）
+        self.delta = delta
+        self.published = None         # Published，整個物件一次替換
+        self.last_data = None         # 最後一次發布的資料，失效後仍保留供增量重建與錯誤退回
+        self.published_seq = 0        # 只發布比目前版本更新的重建結果
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.flight = None
+        self.stats = {
+            'hits': 0, 'stale_hits': 0, 'disk_hits': 0, 'misses': 0, 'rebuilds': 0,
+            'errors': 0, 'coalesced': 0, 'deltas': 0,
+            'last_build_ms': 0.0, 'total_build_ms': 0.0, 'last_built_at': None
+        }
+
+
+class CacheRegistry:
+    def __init__(self):
+        self._entries = {}
+        # apply_change 彼此互斥：修改前後取得的快取鍵必須對應同一次修改
+        self._change_lock = threading.RLock()
+
+    def register(self, name, builder, inputs=(), persist=None, cache_if=None, delta=None):
+        self._entries[name] = CacheEntry(name, builder, inputs, persist, cache_if, delta)
+
+    def entry(self, name):
+        return self._entries[name]
+
+    def published_key(self, name):
+        published = self._entries[name].published
+        return published.key if published is not None else None
+
+    @staticmethod
+    def _hash_parts(parts):
+        return hashlib.blake2b(repr(parts).encode('utf-8'), digest_size=16).hexdigest()
+
+    def _current_key(self, entry):
+        return self._hash_parts(tuple(inp.key(self) for inp in entry.inputs))
+
+    def _peek_parts(self, entry):
+        """各輸入目前的識別，上游資料集只取已發布的快取鍵（不觸發重建）"""
+        return tuple(self.published_key(inp.name) if isinstance(inp, DatasetInput) else inp.key(self)
+                     for inp in entry.inputs)
+
+    def _cache_file(self, entry):
+        cache_dir = os.path.join(os.getcwd(), 'app', 'cache')
+        os.makedirs(cache_dir, exist_ok=True)
+        return os.path.join(cache_dir, entry.persist.filename)
+
+    def _load_persisted(self, entry, key):
+        if not entry.persist:
+            return None
+        cache_file = self._cache_file(entry)
+        if not os.path.exists(cache_file):
+            return None
+        try:
+            return read_snapshot(cache_file, entry.persist, key)
+        except Exception as e:
+            print(f"[Cache] 讀取 {entry.persist.filename} 失敗，改為重建: {e}")
+        return None
+
+    def _save_persisted(self, entry, key, data):
+        if not entry.persist:
+            return
+        try:
+            write_snapshot(self._cache_file(entry), entry.persist, key, data)
+        except Exception as e:
+            print(f"[Cache] 寫入 {entry.persist.filename} 失敗: {e}")
+
+    def get(self, name, stale_ok=True):
+        """取得資料集
+
+        輸入未變更時直接回傳已發布的版本；輸入已變更時回傳舊版本並在背景重建，
+        只有從未發布過（冷啟動或被捨棄）時才等待重建完成。同一時間只重建一次。
+        stale_ok=False 時一律等待與目前輸入一致的版本（寫入者依此決定寫入位置）。
+        """
+        entry = self._entries[name]
+        key = self._current_key(entry)
+        published = entry.published
+        if published is not None:
+            if published.key == key:
+                entry.stats['hits'] += 1
+                return published.data
+            if stale_ok:
+                entry.stats['stale_hits'] += 1
+                self._refresh_in_background(entry, key)
+                return published.data
+
+        with entry.lock:
+            published = entry.published
+            if published is not None and (stale_ok or published.key == key):
+                entry.stats['hits'] += 1
+                return published.data
+            flight, leader = self._join_flight(entry, key)
+
+        if leader:
+            self._run_flight(entry, flight)
+        else:
+            entry.stats['coalesced'] += 1
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.data
+
+    def _join_flight(self, entry, key):
+        """呼叫前需持有 entry.lock；同一快取鍵的重建只會有一個"""
+        flight = entry.flight
+        if flight is not None and flight.key == key:
+            return flight, False
+        entry.seq += 1
+        flight = entry.flight = _Flight(key, entry.seq)
+        return flight, True
+
+    def _refresh_in_background(self, entry, key):
+        with entry.lock:
+            flight, leader = self._join_flight(entry, key)
+        if not leader:
+            return
+        app = current_app._get_current_object() if has_app_context() else None
+        if app is None:
+            self._run_flight(entry, flight)
+            return
+
+        def _run():
+            with app.app_context():
+                self._run_flight(entry, flight)
+
+        threading.Thread(target=_run, daemon=True, name=f"cache-refresh-{entry.name}").start()
+
+    def _run_flight(self, entry, flight):
+        try:
+            data, cacheable = self._rebuild(entry, flight.key)
+            flight.data = data
+            if cacheable:
+                with entry.lock:
+                    if flight.seq > entry.published_seq:
+                        entry.published = Published(flight.key, data, time.time())
+                        entry.last_data = data
+                        entry.published_seq = flight.seq
+        except Exception as e:
+            flight.error = e
+            print(f"[Cache] {entry.name} 重建失敗: {e}")
+        finally:
+            with entry.lock:
+                if entry.flight is flight:
+                    entry.flight = None
+            flight.done.set()
+
+    def _rebuild(self, entry, key):
+        """回傳 (資料, 是否可發布)"""
+        data = self._load_persisted(entry, key)
+        if data is not None:
+            entry.stats['disk_hits'] += 1
+            return data, True
+
+        entry.stats['misses'] += 1
+        t0 = time.perf_counter()
+        try:
+            data = entry.builder()
+        except Exception:
+            entry.stats['errors'] += 1
+            raise
+        elapsed = (time.perf_counter() - t0) * 1000
+        entry.stats['rebuilds'] += 1
+        entry.stats['last_build_ms'] = round(elapsed, 1)
+        entry.stats['total_build_ms'] = round(entry.stats['total_build_ms'] + elapsed, 1)
+        entry.stats['last_built_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
+
+        if entry.cache_if is None or entry.cache_if(data):
+            self._save_persisted(entry, key, data)
+            return data, True
+        return data, False
+
+    def peek(self, name):
+        """回傳最後一次發布的資料（不檢查是否過期，已失效的也算），供錯誤退回與增量重建使用"""
+        return self._entries[name].last_data
+
+    def invalidate(self, name):
+        """捨棄已發布的版本，下次讀取等待重建（寫入者能立即讀到自己的變更）"""
+        entry = self._entries[name]
+        with entry.lock:
+            entry.published = None
+            # 寫入前就開始的重建不再發布
+            entry.published_seq = entry.seq
+
+    def invalidate_file(self, path):
+        """本程序寫入檔案後呼叫：捨棄直接依賴該檔案的資料集，下游會因上游重建而更新
+
+        只依賴檔案部分內容 (FilePartInput) 的資料集，該部分確實變更時才捨棄
+        """
+        path = os.path.abspath(path)
+        for name, entry in self._entries.items():
+            matched = [inp for inp in entry.inputs
+                       if isinstance(inp, (FileInput, FilePartInput)) and os.path.abspath(inp.path_fn()) == path]
+            if not matched:
+                continue
+            if any(isinstance(inp, FileInput) for inp in matched) or self._current_key(entry) != self.published_key(name):
+                self.invalidate(name)
+
+    def _file_dependents(self, path):
+        """直接或經由其他資料集依賴該檔案的資料集，上游排在下游之前
+
+        Returns:
+            tuple: (資料集名稱 list, 直接依賴檔案的名稱 set)
+        """
+        direct = {name for name, entry in self._entries.items()
+                  if any(isinstance(inp, (FileInput, FilePartInput)) and os.path.abspath(inp.path_fn()) == path
+                         for inp in entry.inputs)}
+        affected = set(direct)
+        grown = True
+        while grown:
+            grown = False
+            for name, entry in self._entries.items():
+                if name not in affected and any(isinstance(inp, DatasetInput) and inp.name in affected
+                                                for inp in entry.inputs):
+                    affected.add(name)
+                    grown = True
+
+        order, seen = [], set()
+
+        def visit(name):
+            if name in seen:
+                return
+            seen.add(name)
+            for inp in self._entries[name].inputs:
+                if isinstance(inp, DatasetInput) and inp.name in affected:
+                    visit(inp.name)
+            order.append(name)
+
+        for name in self._entries:
+            if name in affected:
+                visit(name)
+        return order, direct
+
+    def apply_change(self, path, write, change=None):
+        """本程序修改檔案（或其待寫回修改）時使用，取代修改後的 invalidate_file
+
+        write() 執行修改。修改前已是最新版本的下游資料集不重建，直接以修改後的快取鍵發布：
+        - change 為 None 表示內容不變（例如把已反映在快取中的待寫回修改寫回檔案），只更新快取鍵
+        - 否則 change() 在修改後呼叫，回傳的變更交給各資料集的 delta 產生新版本
+        輸入只有上游資料集變更、且上游資料未變（delta 回傳同一物件）的資料集同樣只更新快取鍵。
+        無法增量更新的資料集與 invalidate_file 相同處理。
+
+        Returns:
+            write() 的回傳值
+        """
+        path = os.path.abspath(path)
+        with self._change_lock:
+            names, direct = self._file_dependents(path)
+            before = {}
+            for name in names:
+                entry = self._entries[name]
+                published = entry.published
+                if published is None:
+                    continue
+                try:
+                    parts = self._peek_parts(entry)
+                except Exception:
+                    continue
+                if published.key == self._hash_parts(parts):
+                    before[name] = (published, parts)
+
+            result = write()
+
+            try:
+                value = change() if change is not None else None
+            except Exception as e:
+                print(f"[Cache] 無法取得 {os.path.basename(path)} 的變更內容，改為重建: {e}")
+                before, value = {}, None
+            unchanged = set()
+            for name in names:
+                entry = self._entries[name]
+                data = None
+                if name in before:
+                    published, old_parts = before[name]
+                    try:
+                        data = self._changed_data(entry, published, old_parts, change is None, value, unchanged)
+                    except Exception as e:
+                        print(f"[Cache] {name} 增量更新失敗，改為重建: {e}")
+                if data is None:
+                    if name in direct:
+                        self.invalidate(name)
+                    continue
+                if data is published.data:
+                    unchanged.add(name)
+                self._publish_change(entry, published, data, persist=change is None)
+        return result
+
+    def _changed_data(self, entry, published, old_parts, same_content, change, unchanged):
+        """修改後的資料；None 表示需要重建"""
+        parts = self._peek_parts(entry)
+        changed = [inp for inp, old, new in zip(entry.inputs, old_parts, parts) if old != new]
+        if any(isinstance(inp, DatasetInput) and self.published_key(inp.name) is None for inp in changed):
+            return None
+        if same_content or not changed or all(isinstance(inp, DatasetInput) and inp.name in unchanged
+                                              for inp in changed):
+            return published.data
+        if entry.delta is None:
+            return None
+        return entry.delta(published.data, change)
+
+    def _publish_change(self, entry, published, data, persist):
+        key = self._hash_parts(self._peek_parts(entry))
+        with entry.lock:
+            if entry.published is not None and entry.published.key == key and entry.published.data is data:
+                return
+            entry.published = Published(key, data, published.built_at if data is published.data else time.time())
+            entry.last_data = data
+            # 修改前就開始的重建不再發布
+            entry.published_seq = entry.seq
+        if data is not published.data:
+            entry.stats['deltas'] += 1
+        if persist:
+            self._save_persisted(entry, key, data)
+
+    def stats(self):
+        return {name: dict(entry.stats) for name, entry in self._entries.items()}
+
+
+def warm_up(loaders, label):
+    """依序呼叫各資料集的載入函式（預熱與定時更新共用，與使用者請求走同一條 single-flight 路徑）
+
+    Args:
+        loaders: [(名稱, 載入函式), ...]
+        label: 日誌前綴，例如 '[WARMUP]'
+    """
+    t0 = time.time()
+    for name, loader in loaders:
+        try:
+            loader()
+            print(f"{label} {name} OK ({(time.time() - t0) * 1000:.0f} ms)")
+        except Exception as e:
+            print(f"{label} {name} 失敗: {e}")
+    return (time.time() - t0) * 1000
+
+
+registry = CacheRegistry()
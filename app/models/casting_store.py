@@ -0,0 +1,436 @@
+"""
+鑄件盤點資料的 SQLite 資料庫模式（選用，設定 CASTING_STORE = 'sqlite'）
+零件分頁的列（品號、機型、各製程數量）以資料庫為準：讀取者取得的分頁內容與所有寫入都來自資料庫，
+品號 / 機型有索引，寫入不需開啟 Excel。活頁簿仍是辦公室使用的介面：
+- 資料庫的修改記為「未寫回」的儲存格，背景執行緒只把這些儲存格寫回活頁簿（與寫入日誌相同的修補方式）
+- 有人直接編輯活頁簿（檔案指紋與上次同步時不同）時重新匯入：未寫回的修改依品號 / 機型對應到檔案的列上，
+  檔案與資料庫都改了同一格且值不同時記錄衝突，保留資料庫的值（之後寫回檔案）
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import pandas as pd
+from openpyxl import load_workbook
+
+from .fingerprint import file_fingerprint
+from .workbook import read_workbook_frames, read_workbook_generation, DEFAULT_READER_ENGINES
+from .xlsx_patch import WorkbookPatch, PatchUnsupported
+from .write_queue import get_write_queue
+from .atomic_file import save_workbook
+
+
+def _encode_value(val):
+    """儲存格值轉為可存入 JSON 的表示（與讀取 Excel 後的正規化一致：整數值的浮點數為 int）"""
+    if val is None or (isinstance(val, float) and val != val):
+        return None
+    if isinstance(val, (pd.Timestamp, datetime)):
+        return {'$dt': pd.Timestamp(val).isoformat()}
+    if hasattr(val, 'item'):  # numpy 純量
+        val = val.item()
+    if isinstance(val, float) and val.is_integer():
+        return int(val)
+    if isinstance(val, str) and not val.strip():
+        return None
+    return val
+
+
+def _decode_value(val):
+    if isinstance(val, dict) and '$dt' in val:
+        return pd.Timestamp(val['$dt'])
+    return val
+
+
+def _encode_row(values):
+    values = list(values)
+    while values and values[-1] is None:
+        values.pop()
+    return json.dumps(values, ensure_ascii=False)
+
+
+def _cell(row, col):
+    return row[col] if col < len(row) else None
+
+
+class StoreSheet:
+    """寫入交易中的單一分頁：依列位置讀寫儲存格，修改立即寫入（同一交易內後續查詢看得到）"""
+
+    def __init__(self, store, sheet_idx):
+        self._store = store
+        self._conn = store._conn
+        self.sheet_idx = sheet_idx
+        self._rows = {}
+        self.changed = False
+
+    def __len__(self):
+        row = self._conn.execute('SELECT COUNT(*) FROM rows WHERE sheet_idx = ?', (self.sheet_idx,)).fetchone()
+        return row[0]
+
+    def _row(self, pos):
+        if pos not in self._rows:
+            row = self._conn.execute('SELECT vals FROM rows WHERE sheet_idx = ? AND pos = ?',
+                                     (self.sheet_idx, pos)).fetchone()
+            if row is None:
+                raise IndexError(f'第 {pos} 列不存在')
+            self._rows[pos] = json.loads(row[0])
+        return self._rows[pos]
+
+    def value(self, pos, col):
+        return _decode_value(_cell(self._row(pos), col))
+
+    def item_id_at(self, pos):
+        return self.value(pos, 0)
+
+    def model_at(self, pos):
+        return self.value(pos, 1)
+
+    def set(self, pos, col, value):
+        row = self._row(pos)
+        row.extend([None] * (col + 1 - len(row)))
+        row[col] = _encode_value(value)
+        self._store._write_row(self.sheet_idx, pos, row)
+        self._conn.execute('INSERT OR IGNORE INTO dirty (sheet_idx, pos, col) VALUES (?, ?, ?)',
+                           (self.sheet_idx, pos, col))
+        self.changed = True
+
+    def append(self, values):
+        """新增一列（{欄位索引: 值}），回傳列位置"""
+        pos = len(self)
+        self._rows[pos] = []
+        self._store._write_row(self.sheet_idx, pos, [])
+        for col, value in values.items():
+            self.set(pos, col, value)
+        return pos
+
+    def _find(self, column, key):
+        row = self._conn.execute(f'SELECT MIN(pos) FROM rows WHERE sheet_idx = ? AND {column} = ?',
+                                 (self.sheet_idx, key)).fetchone()
+        return row[0]
+
+    def find_item(self, item_id):
+        return self._find('item_key', self._store.item_key(item_id))
+
+    def find_model(self, model_name):
+        return self._find('model_key', self._store.model_key(model_name))
+
+
+class CastingStore:
+    """單一活頁簿的資料庫（只管理 sheets 指定的分頁）
+
+    Args:
+        item_key / model_key: 由儲存格值產生品號 / 機型索引鍵的函式（與找列規則一致）
+    """
+
+    EXPORT_DELAY = 1.0  # 收到修改後等待的秒數，讓連續的修改合併成一次寫回
+
+    def __init__(self, db_path, workbook, sheets, item_key, model_key, engines=DEFAULT_READER_ENGINES):
+        self.db_path = db_path
+        self.workbook = os.path.abspath(workbook)
+        self.sheets = tuple(sheets)
+        self.item_key = item_key
+        self.model_key = model_key
+        self.engines = engines
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # 寫入、匯入與寫回互斥（可重入：寫回前會先檢查是否需要匯入）
+        self.lock = threading.RLock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS sheets (
+                sheet_idx INTEGER PRIMARY KEY, name TEXT, columns TEXT, version INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS rows (
+                sheet_idx INTEGER, pos INTEGER, item_key TEXT, model_key TEXT, vals TEXT NOT NULL,
+                PRIMARY KEY (sheet_idx, pos));
+            CREATE INDEX IF NOT EXISTS idx_rows_item ON rows (sheet_idx, item_key, pos);
+            CREATE INDEX IF NOT EXISTS idx_rows_model ON rows (sheet_idx, model_key, pos);
+            -- 上次同步時檔案的內容，用來判斷重新匯入時哪一邊修改了儲存格
+            CREATE TABLE IF NOT EXISTS base_rows (
+                sheet_idx INTEGER, pos INTEGER, vals TEXT NOT NULL, PRIMARY KEY (sheet_idx, pos));
+            -- 尚未寫回活頁簿的儲存格
+            CREATE TABLE IF NOT EXISTS dirty (
+                sheet_idx INTEGER, pos INTEGER, col INTEGER, PRIMARY KEY (sheet_idx, pos, col));
+            CREATE TABLE IF NOT EXISTS conflicts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, sheet_idx INTEGER, item_id TEXT, model_name TEXT,
+                col INTEGER, db_value TEXT, file_value TEXT, base_value TEXT, detected_at TEXT);
+        ''')
+        self._conn.commit()
+        self._frames = {}  # sheet_idx -> (version, DataFrame)
+        self._versions = None  # {sheet_idx: version}，寫入或匯入後重新載入
+        self._synced_generation = None  # 上次確認與資料庫一致的活頁簿世代
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    # ── 讀取 ──────────────────────────────────────────────────────
+
+    def _meta(self, key):
+        row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def version(self, sheet_idx):
+        """分頁的版本（每次寫入或匯入加一）；讀取記憶體中的副本，不需每次查詢資料庫"""
+        with self.lock:
+            if self._versions is None:
+                self._versions = dict(self._conn.execute('SELECT sheet_idx, version FROM sheets'))
+            return self._versions.get(sheet_idx)
+
+    def frame(self, sheet_idx):
+        """分頁內容 DataFrame（與讀取活頁簿的結果相同格式），同一版本只建立一次，呼叫者不可修改"""
+        with self.lock:
+            version = self.version(sheet_idx)
+            cached = self._frames.get(sheet_idx)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            columns = json.loads(self._conn.execute('SELECT columns FROM sheets WHERE sheet_idx = ?',
+                                                    (sheet_idx,)).fetchone()[0])
+            rows = []
+            for (vals,) in self._conn.execute('SELECT vals FROM rows WHERE sheet_idx = ? ORDER BY pos', (sheet_idx,)):
+                row = [_decode_value(v) for v in json.loads(vals)][:len(columns)]
+                rows.append(row + [None] * (len(columns) - len(row)))
+            df = pd.DataFrame(rows, columns=columns)
+            self._frames[sheet_idx] = (version, df)
+            return df
+
+    def conflicts(self, limit=100):
+        """最近的衝突紀錄（新的在前）"""
+        with self.lock:
+            rows = self._conn.execute('SELECT sheet_idx, item_id, model_name, col, db_value, file_value, base_value, '
+                                      'detected_at FROM conflicts ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+        keys = ('sheet_idx', 'item_id', 'model_name', 'col', 'db_value', 'file_value', 'base_value', 'detected_at')
+        return [dict(zip(keys, row)) for row in rows]
+
+    # ── 寫入 ──────────────────────────────────────────────────────
+
+    def _write_row(self, sheet_idx, pos, row):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO rows (sheet_idx, pos, item_key, model_key, vals) VALUES (?, ?, ?, ?, ?)',
+            (sheet_idx, pos, self.item_key(_decode_value(_cell(row, 0))),
+             self.model_key(_decode_value(_cell(row, 1))), _encode_row(row)))
+
+    def edit(self, fn):
+        """在單一交易中修改：fn(sheet) 以 sheet(分頁索引) 取得 StoreSheet；例外時全部復原
+
+        Returns:
+            fn 的回傳值
+        """
+        with self.lock:
+            opened = {}
+
+            def sheet(sheet_idx):
+                if sheet_idx not in opened:
+                    opened[sheet_idx] = StoreSheet(self, sheet_idx)
+                return opened[sheet_idx]
+
+            try:
+                with self._conn:
+                    result = fn(sheet)
+                    for s in opened.values():
+                        if s.changed:
+                            self._conn.execute('UPDATE sheets SET version = version + 1 WHERE sheet_idx = ?',
+                                               (s.sheet_idx,))
+            finally:
+                self._versions = None
+        self.notify()
+        return result
+
+    # ── 與活頁簿同步 ──────────────────────────────────────────────
+
+    def sync(self, generation=None):
+        """活頁簿與上次同步時不同（有人直接編輯）時重新匯入，回傳是否匯入
+
+        generation: 呼叫者已知的活頁簿世代（fingerprint.known_generation）；與上次確認時相同則不檢查檔案
+        """
+        if generation is not None and generation == self._synced_generation:
+            return False
+        with self.lock:
+            if file_fingerprint(self.workbook) == self._meta('fingerprint'):
+                self._synced_generation = generation
+                return False
+            # 記錄的指紋與匯入的內容取自同一次讀入（同一世代）
+            data, fingerprint, _, _ = read_workbook_generation(self.workbook)
+            _, sheet_names, frames = read_workbook_frames(self.workbook, self.engines, data=data)
+            try:
+                with self._conn:
+                    for sheet_idx in self.sheets:
+                        if sheet_idx < len(frames):
+                            self._import_sheet(sheet_idx, sheet_names[sheet_idx], frames[sheet_idx])
+                    self._set_meta('fingerprint', fingerprint)
+            finally:
+                self._versions = None
+            self._synced_generation = generation
+            print(f"[Store] 已匯入 {os.path.basename(self.workbook)}")
+            return True
+
+    def _rows_of(self, table, sheet_idx):
+        return [json.loads(vals) for (vals,) in self._conn.execute(
+            f'SELECT vals FROM {table} WHERE sheet_idx = ? ORDER BY pos', (sheet_idx,))]
+
+    def _import_sheet(self, sheet_idx, name, df):
+        file_rows = [[_encode_value(v) for v in row] for row in df.itertuples(index=False, name=None)]
+        merged = [list(row) for row in file_rows]
+        dirty = self._conn.execute('SELECT pos, col FROM dirty WHERE sheet_idx = ? ORDER BY pos, col',
+                                   (sheet_idx,)).fetchall()
+        new_dirty = set()
+        if dirty:
+            new_dirty = self._rebase_dirty(sheet_idx, dirty, file_rows, merged)
+
+        self._conn.execute('DELETE FROM rows WHERE sheet_idx = ?', (sheet_idx,))
+        self._conn.execute('DELETE FROM base_rows WHERE sheet_idx = ?', (sheet_idx,))
+        self._conn.execute('DELETE FROM dirty WHERE sheet_idx = ?', (sheet_idx,))
+        for pos, row in enumerate(merged):
+            self._write_row(sheet_idx, pos, row)
+        self._conn.executemany('INSERT INTO base_rows (sheet_idx, pos, vals) VALUES (?, ?, ?)',
+                               [(sheet_idx, pos, _encode_row(row)) for pos, row in enumerate(file_rows)])
+        self._conn.executemany('INSERT INTO dirty (sheet_idx, pos, col) VALUES (?, ?, ?)',
+                               [(sheet_idx, pos, col) for pos, col in sorted(new_dirty)])
+        columns = json.dumps([_encode_value(c) for c in df.columns], ensure_ascii=False)
+        self._conn.execute('INSERT INTO sheets (sheet_idx, name, columns, version) VALUES (?, ?, ?, 1) '
+                           'ON CONFLICT (sheet_idx) DO UPDATE SET name = excluded.name, columns = excluded.columns, '
+                           'version = version + 1', (sheet_idx, name, columns))
+
+    def _rebase_dirty(self, sheet_idx, dirty, file_rows, merged):
+        """把尚未寫回的儲存格依品號 / 機型對應到新的檔案內容上，回傳新的未寫回儲存格 {(列, 欄)}"""
+        db_rows = self._rows_of('rows', sheet_idx)
+        base_rows = self._rows_of('base_rows', sheet_idx)
+        by_item, by_model = {}, {}
+        for pos, row in enumerate(file_rows):
+            by_item.setdefault(self.item_key(_decode_value(_cell(row, 0))), pos)
+            model = self.model_key(_decode_value(_cell(row, 1)))
+            if model is not None:
+                by_model.setdefault(model, pos)
+
+        by_row = {}
+        for pos, col in dirty:
+            by_row.setdefault(pos, []).append(col)
+
+        new_dirty = set()
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        for pos, cols in by_row.items():
+            db_row = db_rows[pos]
+            item_id, model_name = _decode_value(_cell(db_row, 0)), _decode_value(_cell(db_row, 1))
+            target = None
+            if item_id and item_id != 'N/A':
+                target = by_item.get(self.item_key(item_id))
+            if target is None and model_name:
+                target = by_model.get(self.model_key(model_name))
+            if target is None and pos >= len(base_rows):
+                # 資料庫新增、尚未寫回的列：接在檔案內容之後
+                target = len(merged)
+                merged.append(list(db_row))
+                new_dirty.update((target, col) for col in range(len(db_row)) if db_row[col] is not None)
+                continue
+
+            for col in cols:
+                db_value = _cell(db_row, col)
+                base_value = _cell(base_rows[pos], col) if pos < len(base_rows) else None
+                file_value = _cell(file_rows[target], col) if target is not None else None
+                if target is None or (file_value != base_value and file_value != db_value):
+                    self._conn.execute(
+                        'INSERT INTO conflicts (sheet_idx, item_id, model_name, col, db_value, file_value, base_value, '
+                        'detected_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (sheet_idx, str(item_id), str(model_name), col, json.dumps(db_value, ensure_ascii=False),
+                         json.dumps(file_value, ensure_ascii=False), json.dumps(base_value, ensure_ascii=False), now))
+                    print(f"[Store] 衝突：分頁 {sheet_idx} {item_id}/{model_name} 第 {col} 欄 "
+                          f"資料庫 {db_value}，檔案 {file_value}" + ('' if target is not None else '（檔案中已無此列）'))
+                if target is None:
+                    continue
+                row = merged[target]
+                row.extend([None] * (col + 1 - len(row)))
+                row[col] = db_value
+                if file_value != db_value:
+                    new_dirty.add((target, col))
+        return new_dirty
+
+    def export(self):
+        """把尚未寫回的儲存格寫入活頁簿，回傳寫回的儲存格數"""
+        with self.lock:
+            self.sync()
+            dirty = self._conn.execute('SELECT sheet_idx, pos, col FROM dirty ORDER BY sheet_idx, pos, col').fetchall()
+            if not dirty:
+                return 0
+            t0 = time.perf_counter()
+            rows = {}
+            cells = []
+            for sheet_idx, pos, col in dirty:
+                if (sheet_idx, pos) not in rows:
+                    rows[(sheet_idx, pos)] = json.loads(self._conn.execute(
+                        'SELECT vals FROM rows WHERE sheet_idx = ? AND pos = ?', (sheet_idx, pos)).fetchone()[0])
+                cells.append((sheet_idx, pos + 2, col + 1, _decode_value(_cell(rows[(sheet_idx, pos)], col))))
+            _write_cells(self.workbook, cells)
+
+            with self._conn:
+                self._conn.executemany('INSERT OR REPLACE INTO base_rows (sheet_idx, pos, vals) VALUES (?, ?, ?)',
+                                       [(sheet_idx, pos, _encode_row(row)) for (sheet_idx, pos), row in rows.items()])
+                self._conn.execute('DELETE FROM dirty')
+                self._set_meta('fingerprint', file_fingerprint(self.workbook))
+            print(f"[Store] 寫回 {os.path.basename(self.workbook)} {len(cells)} 個儲存格 "
+                  f"({(time.perf_counter() - t0) * 1000:.0f} ms)")
+            return len(cells)
+
+    # ── 背景寫回 ──────────────────────────────────────────────────
+
+    def notify(self):
+        """有新的修改：喚醒背景寫回執行緒（必要時啟動；同時呼叫時只會啟動一個）"""
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, daemon=True,
+                                                name=f"store-export-{os.path.basename(self.workbook)}")
+                self._thread.start()
+        self._wakeup.set()
+
+    def _loop(self):
+        while True:
+            self._wakeup.wait()
+            time.sleep(self.EXPORT_DELAY)
+            self._wakeup.clear()
+            try:
+                # 與其他修改活頁簿的操作在同一個寫入執行緒上依序進行
+                get_write_queue(self.workbook).call(self.export)
+            except Exception as e:
+                # 修改仍標記為未寫回，稍後重試
+                print(f"[Store] 寫回 {os.path.basename(self.workbook)} 失敗，稍後重試: {e}")
+                time.sleep(5)
+                self._wakeup.set()
+
+
+def _write_cells(path, cells):
+    """寫入儲存格 [(分頁索引, 列, 欄, 值)]：只改既有列時直接修補 XML，否則以 openpyxl 開檔"""
+    try:
+        with WorkbookPatch(path) as wb:
+            for sheet_idx, row, col, value in cells:
+                wb.sheet(sheet_idx).set(row, col, value)
+            wb.save()
+        return
+    except PatchUnsupported as e:
+        print(f"[Store] 改用 openpyxl 寫回: {e}")
+
+    wb = load_workbook(path)
+    try:
+        for sheet_idx, row, col, value in cells:
+            wb.worksheets[sheet_idx].cell(row=row, column=col,
+                                          value=value.to_pydatetime() if isinstance(value, pd.Timestamp) else value)
+        save_workbook(wb, path)
+    finally:
+        wb.close()
+
+
+# {db_path: CastingStore}
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_store(db_path, workbook, sheets, item_key, model_key, engines=DEFAULT_READER_ENGINES):
+    db_path = os.path.abspath(db_path)
+    with _STORES_LOCK:
+        store = _STORES.get(db_path)
+        if store is None:
+            store = _STORES[db_path] = CastingStore(db_path, workbook, sheets, item_key, model_key, engines)
+        return store
@@ -0,0 +1,481 @@
+"""
+鑄件修改歷程（稽核紀錄）
+以 SQLite（WAL 模式）只附加保存：每次記錄只插入新的列，成本與歷程長度無關，也不再只保留最近 500 筆。
+零件、品號、時間、出入庫類型建有索引，依零件或品號查詢不需讀入整份歷程；
+出入庫查詢以索引做時間範圍查詢（timestamp 字串可直接比較大小），並以 id 作為游標分頁。
+舊版的 edit_history.json 在第一次開啟時匯入一次（保留原本的先後順序），之後不再讀寫。
+修正備註 / 數量與刪除是少數的就地修改，以 (part, item_id, timestamp, field) 找到同一筆。
+關鍵字搜尋使用 n-gram 反向索引（英數字取 3 字元、中日文取 2 字元），先以索引交集取得候選再確認子字串，不掃描整份歷程。
+各零件的統計（筆數、不重複品號 / 使用者數、每日筆數）在寫入與刪除時於同一交易內增量維護，讀取統計不需掃描歷程。
+機型在記錄時寫入；沒有機型的舊紀錄由 backfill_model_names 一次性補上，讀取歷程時不需要再查活頁簿。
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+
+# 歷程欄位（依 JSON 時代的鍵名；transaction 為 SQL 保留字，欄位名稱為 transaction_id）
+_COLUMNS = ('timestamp', 'user', 'part', 'item_id', 'model_name', 'field', 'old_value', 'new_value',
+            'note', 'transaction')
+# 只在有值時才出現在歷程中的鍵（與舊版 JSON 相同）
+_OPTIONAL = ('note', 'transaction')
+# 關鍵字搜尋的欄位（工單編碼、鑄件編號、採購單號都在 note / field 中）
+_SEARCH_FIELDS = ('item_id', 'note', 'field', 'user', 'part')
+# 同一類字元的連續片段：英數字、中日文；其他字元（空白、標點）為分隔
+_TOKEN = re.compile(r'[0-9a-z]+|[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff]+')
+
+
+def _column(key):
+    return 'transaction_id' if key == 'transaction' else key
+
+
+def _operation(field):
+    """出入庫類型：欄位含「入庫」為 'in'、含「出庫」為 'out'，其他修改為 None"""
+    field = field or ''
+    if '入庫' in field:
+        return 'in'
+    if '出庫' in field:
+        return 'out'
+    return None
+
+
+def _grams(text):
+    """關鍵字索引的 n-gram：英數字片段取連續 3 字元、中日文片段取連續 2 字元（過短的片段不產生）
+
+    關鍵字的每個片段必定落在符合紀錄的某個片段之內，因此關鍵字的 n-gram 都會出現在符合紀錄的 n-gram 中。
+    """
+    grams = set()
+    for token in _TOKEN.findall(text.lower()):
+        n = 3 if token.isascii() else 2
+        grams.update(token[i:i + n] for i in range(len(token) - n + 1))
+    return grams
+
+
+def _lower(text):
+    return text.lower() if isinstance(text, str) else text
+
+
+def _search_text(values):
+    return ' '.join(str(v) for v in values if v is not None)
+
+
+class EditHistory:
+    """只附加的修改歷程；查詢結果依記錄順序由新到舊"""
+
+    MAX_QUERY_GRAMS = 3  # 關鍵字查詢最多以幾個 n-gram 的索引交集縮小範圍（其餘由子字串確認）
+    MAX_PAGE_SIZE = 1000  # 出入庫查詢每頁筆數上限
+
+    def __init__(self, db_path, legacy_json=None):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._migrated = set()  # 本程序已確認完成的一次性遷移
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        # SQLite 內建的 lower() 只轉換 ASCII；關鍵字比對改用 Python 的 str.lower，與查詢字串及 n-gram 的轉換一致
+        self._conn.create_function('py_lower', 1, _lower, deterministic=True)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TEXT,
+                user TEXT,
+                part TEXT,
+                item_id TEXT,
+                model_name TEXT,
+                field TEXT,
+                old_value,
+                new_value,
+                note TEXT,
+                transaction_id TEXT,
+                operation TEXT
+            )''')
+        if 'operation' not in {row[1] for row in self._conn.execute('PRAGMA table_info(history)')}:
+            self._conn.execute('ALTER TABLE history ADD COLUMN operation TEXT')
+            self._conn.execute("UPDATE history SET operation = CASE WHEN field LIKE '%入庫%' THEN 'in' "
+                               "WHEN field LIKE '%出庫%' THEN 'out' END")
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_history_part ON history (part, id)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_history_item ON history (part, item_id, id)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history (timestamp)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_history_operation ON history (operation, part, timestamp)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        # 增量統計：stats_totals 為各零件的筆數與不重複數，stats_keys 為不重複品號 / 使用者的參照數，stats_daily 為每日筆數
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS stats_totals (
+                part TEXT PRIMARY KEY,
+                total INTEGER NOT NULL DEFAULT 0,
+                items INTEGER NOT NULL DEFAULT 0,
+                users INTEGER NOT NULL DEFAULT 0
+            )''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS stats_keys (
+                part TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                value TEXT NOT NULL,
+                n INTEGER NOT NULL,
+                PRIMARY KEY (part, kind, value)
+            )''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS stats_daily (
+                part TEXT NOT NULL,
+                day TEXT NOT NULL,
+                n INTEGER NOT NULL,
+                PRIMARY KEY (part, day)
+            )''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS history_grams (
+                gram TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                PRIMARY KEY (gram, id)
+            ) WITHOUT ROWID''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_history_grams_id ON history_grams (id)')
+        # 各 n-gram 出現的歷程筆數，與 history_grams 在同一交易內維護（查詢時挑選最少見的 n-gram）
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS gram_counts (
+                gram TEXT PRIMARY KEY,
+                n INTEGER NOT NULL
+            ) WITHOUT ROWID''')
+        self._conn.commit()
+        if not self._meta('stats_built'):
+            self._rebuild_stats()
+        if not self._meta('grams_built'):
+            self._rebuild_grams()
+        elif not self._meta('gram_counts_built'):
+            with self._lock, self._conn:
+                self._rebuild_gram_counts()
+        # 關鍵字索引的查詢使用另一個連線：WAL 模式下只讀取已提交的內容，不需等待寫入者的鎖
+        self._reader = sqlite3.connect(db_path, check_same_thread=False)
+        self._read_lock = threading.Lock()
+        if legacy_json:
+            self._import_json(legacy_json)
+
+    def _import_json(self, path):
+        """匯入舊版 JSON 歷程（只做一次；JSON 為新到舊，依舊到新插入）"""
+        if self._meta('imported_json'):
+            return
+        entries = []
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        with self._lock, self._conn:
+            self._insert(reversed(entries))
+            self._conn.execute("INSERT INTO meta (key, value) VALUES ('imported_json', ?)", (path,))
+        if entries:
+            print(f"[History] 已匯入 {os.path.basename(path)} {len(entries)} 筆歷程")
+
+    def _meta(self, key):
+        row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def backfill_model_names(self, lookup):
+        """一次性遷移：為沒有機型的歷程補上機型
+
+        lookup(part, item_id) 回傳機型或 None；lookup 拋出例外（例如活頁簿暫時無法讀取）時不標記完成，下次再試。
+        """
+        if 'model_names' in self._migrated:
+            return
+        with self._lock:
+            if self._meta('model_names_backfilled'):
+                self._migrated.add('model_names')
+                return
+            rows = self._conn.execute(
+                "SELECT id, part, item_id FROM history WHERE model_name IS NULL OR model_name = ''").fetchall()
+        try:
+            updates = [(model, row_id) for row_id, part, item_id in rows
+                       for model in [lookup(part, item_id)] if model]
+        except Exception as e:
+            print(f"[History] 無法補上機型，稍後再試: {e}")
+            return
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE history SET model_name = ? WHERE id = ? AND (model_name IS NULL OR model_name = '')", updates)
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('model_names_backfilled', ?)",
+                               (str(len(updates)),))
+        self._migrated.add('model_names')
+        print(f"[History] 已為 {len(updates)} 筆舊歷程補上機型")
+
+    @staticmethod
+    def _row(entry):
+        row = [entry.get(key) for key in _COLUMNS]
+        item_id = row[_COLUMNS.index('item_id')]
+        if item_id is not None:
+            row[_COLUMNS.index('item_id')] = str(item_id)
+        return row + [_operation(entry.get('field'))]
+
+    def _insert(self, entries):
+        ids = []
+        for entry in entries:
+            ids.append(self._conn.execute(
+                f"INSERT INTO history ({', '.join(_column(k) for k in _COLUMNS)}, operation) "
+                f"VALUES ({', '.join('?' for _ in _COLUMNS)}, ?)", self._row(entry)).lastrowid)
+            self._count(entry.get('part'), entry.get('item_id'), entry.get('user'), entry.get('timestamp'), 1)
+            self._index(ids[-1], [entry.get(key) for key in _SEARCH_FIELDS])
+        return ids
+
+    # ── 關鍵字索引 ────────────────────────────────────────────
+
+    def _index(self, entry_id, values):
+        """寫入一筆歷程的 n-gram 與出現筆數（呼叫者已在交易中）"""
+        grams = _grams(_search_text(values))
+        self._conn.executemany('INSERT INTO history_grams (gram, id) VALUES (?, ?)', [(gram, entry_id) for gram in grams])
+        self._conn.executemany('INSERT INTO gram_counts (gram, n) VALUES (?, 1) '
+                               'ON CONFLICT (gram) DO UPDATE SET n = n + 1', [(gram,) for gram in grams])
+
+    def _unindex(self, entry_ids):
+        """移除歷程的 n-gram 並扣除出現筆數（呼叫者已在交易中）"""
+        for entry_id in entry_ids:
+            self._conn.execute('UPDATE gram_counts SET n = n - 1 '
+                               'WHERE gram IN (SELECT gram FROM history_grams WHERE id = ?)', (entry_id,))
+            self._conn.execute('DELETE FROM history_grams WHERE id = ?', (entry_id,))
+        self._conn.execute('DELETE FROM gram_counts WHERE n <= 0')
+
+    def _reindex(self, entry_ids):
+        self._unindex(entry_ids)
+        for row in self._conn.execute(
+                f"SELECT id, {', '.join(_SEARCH_FIELDS)} FROM history WHERE id IN ({', '.join('?' for _ in entry_ids)})",
+                list(entry_ids)).fetchall():
+            self._index(row[0], row[1:])
+
+    def _selective_grams(self, grams):
+        """查詢用的 n-gram：只取出現筆數最少的 MAX_QUERY_GRAMS 個（常見的 n-gram 如「000」幾乎不縮小範圍）
+
+        筆數取自 gram_counts（每個 n-gram 一次主鍵查詢）；連最少的 n-gram 都出現在四分之一以上的紀錄時，
+        索引交集不比逐筆比對快，回傳空 list。有 n-gram 完全沒出現時交集必為空，查詢立即結束。
+        """
+        if not grams:
+            return []
+        grams = list(grams)
+        with self._read_lock:
+            total = self._reader.execute('SELECT coalesce(SUM(total), 0) FROM stats_totals').fetchone()[0]
+            counts = dict(self._reader.execute(
+                f"SELECT gram, n FROM gram_counts WHERE gram IN ({', '.join('?' for _ in grams)})", grams))
+        cap = max(total // 4, 1)
+        counts = {gram: counts.get(gram, 0) for gram in grams}
+        selected = sorted(grams, key=lambda gram: (counts[gram], gram))[:self.MAX_QUERY_GRAMS]
+        return [] if counts[selected[0]] >= cap else selected
+
+    def _rebuild_grams(self):
+        """由歷程重建關鍵字索引（第一次使用關鍵字索引的既有資料庫）"""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM history_grams')
+            self._conn.execute('DELETE FROM gram_counts')
+            for row in self._conn.execute(f"SELECT id, {', '.join(_SEARCH_FIELDS)} FROM history").fetchall():
+                self._index(row[0], row[1:])
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('grams_built', '1')")
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('gram_counts_built', '1')")
+
+    def _rebuild_gram_counts(self):
+        """由既有的關鍵字索引計算各 n-gram 的出現筆數（呼叫者已在交易中）"""
+        self._conn.execute('DELETE FROM gram_counts')
+        self._conn.execute('INSERT INTO gram_counts (gram, n) SELECT gram, COUNT(*) FROM history_grams GROUP BY gram')
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('gram_counts_built', '1')")
+
+    # ── 增量統計 ──────────────────────────────────────────────
+
+    def _count(self, part, item_id, user, timestamp, delta):
+        """一筆歷程加入（delta=1）或移除（delta=-1）時更新統計（呼叫者已在交易中）"""
+        part = part or ''
+        self._conn.execute('INSERT OR IGNORE INTO stats_totals (part) VALUES (?)', (part,))
+        self._conn.execute('UPDATE stats_totals SET total = total + ? WHERE part = ?', (delta, part))
+        for kind, column in (('item', 'items'), ('user', 'users')):
+            value = item_id if kind == 'item' else user
+            value = '' if value is None else str(value)
+            self._conn.execute('INSERT OR IGNORE INTO stats_keys (part, kind, value, n) VALUES (?, ?, ?, 0)',
+                               (part, kind, value))
+            self._conn.execute('UPDATE stats_keys SET n = n + ? WHERE part = ? AND kind = ? AND value = ?',
+                               (delta, part, kind, value))
+            n = self._conn.execute('SELECT n FROM stats_keys WHERE part = ? AND kind = ? AND value = ?',
+                                   (part, kind, value)).fetchone()[0]
+            if delta > 0 and n == delta:
+                self._conn.execute(f'UPDATE stats_totals SET {column} = {column} + 1 WHERE part = ?', (part,))
+            elif delta < 0 and n <= 0:
+                self._conn.execute('DELETE FROM stats_keys WHERE part = ? AND kind = ? AND value = ?', (part, kind, value))
+                self._conn.execute(f'UPDATE stats_totals SET {column} = {column} - 1 WHERE part = ?', (part,))
+        day = (timestamp or '')[:10]
+        self._conn.execute('INSERT OR IGNORE INTO stats_daily (part, day, n) VALUES (?, ?, 0)', (part, day))
+        self._conn.execute('UPDATE stats_daily SET n = n + ? WHERE part = ? AND day = ?', (delta, part, day))
+        if delta < 0:
+            self._conn.execute('DELETE FROM stats_daily WHERE part = ? AND day = ? AND n <= 0', (part, day))
+
+    def _rebuild_stats(self):
+        """由歷程重建統計（第一次使用增量統計的既有資料庫）"""
+        with self._lock, self._conn:
+            for table in ('stats_totals', 'stats_keys', 'stats_daily'):
+                self._conn.execute(f'DELETE FROM {table}')
+            self._conn.execute("""
+                INSERT INTO stats_keys (part, kind, value, n)
+                SELECT coalesce(part, ''), 'item', coalesce(item_id, ''), COUNT(*) FROM history GROUP BY 1, 3""")
+            self._conn.execute("""
+                INSERT INTO stats_keys (part, kind, value, n)
+                SELECT coalesce(part, ''), 'user', coalesce(user, ''), COUNT(*) FROM history GROUP BY 1, 3""")
+            self._conn.execute("""
+                INSERT INTO stats_daily (part, day, n)
+                SELECT coalesce(part, ''), substr(coalesce(timestamp, ''), 1, 10), COUNT(*) FROM history GROUP BY 1, 2""")
+            self._conn.execute("""
+                INSERT INTO stats_totals (part, total, items, users)
+                SELECT part, SUM(n),
+                       (SELECT COUNT(*) FROM stats_keys k WHERE k.part = d.part AND k.kind = 'item'),
+                       (SELECT COUNT(*) FROM stats_keys k WHERE k.part = d.part AND k.kind = 'user')
+                FROM stats_daily d GROUP BY part""")
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('stats_built', '1')")
+
+    def stats(self, part, days=7, now=None):
+        """零件的歷程統計（讀取附加、修正與刪除時維護好的計數，不掃描歷程）
+
+        Returns:
+            dict: {'total_edits', 'unique_items', 'unique_users', 'recent_edits'（最近 days 天含今天的筆數）}
+        """
+        now = now or datetime.now()
+        since = (now - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        with self._lock:
+            row = self._conn.execute('SELECT total, items, users FROM stats_totals WHERE part = ?',
+                                     (part or '',)).fetchone() or (0, 0, 0)
+            recent = self._conn.execute('SELECT coalesce(SUM(n), 0) FROM stats_daily WHERE part = ? AND day >= ?',
+                                        (part or '', since)).fetchone()[0]
+        return {'total_edits': row[0], 'unique_items': row[1], 'unique_users': row[2], 'recent_edits': recent}
+
+    def append_many(self, entries):
+        """以單一交易附加多筆歷程（依發生順序），回傳各筆 id"""
+        with self._lock, self._conn:
+            return self._insert(entries)
+
+    @staticmethod
+    def _entry(row):
+        entry = dict(zip(_COLUMNS, row[1:]))
+        for key in _OPTIONAL:
+            if entry[key] is None:
+                del entry[key]
+        entry['id'] = row[0]
+        return entry
+
+    def _select(self, where='', params=(), limit=None):
+        sql = f"SELECT id, {', '.join(_column(k) for k in _COLUMNS)} FROM history {where} ORDER BY id DESC"
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params = tuple(params) + (int(limit),)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def query(self, part=None, item_id=None, limit=None):
+        """依零件 / 品號篩選的歷程（由新到舊）"""
+        conditions, params = [], []
+        if part is not None:
+            conditions.append('part = ?')
+            params.append(part)
+        if item_id is not None:
+            conditions.append('item_id = ?')
+            params.append(str(item_id))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return self._select(where, params, limit)
+
+    def stock_query(self, operation=None, part=None, date_from=None, date_to=None, keyword=None,
+                    cursor=None, limit=200):
+        """出入庫歷程（由新到舊），篩選條件皆以 SQL 在索引上執行
+
+        Args:
+            operation: 'in' / 'out'，其他值為兩者
+            date_from / date_to: timestamp 範圍（含兩端，'YYYY-MM-DD HH:MM:SS'）
+            keyword: 品號、備註、欄位、使用者、零件中包含的文字（不分大小寫）
+            cursor: 上一頁最後一筆的 id，只回傳比它舊的紀錄
+            limit: 每頁筆數，限制在 1 ~ MAX_PAGE_SIZE
+
+        Returns:
+            tuple: (歷程 list, 下一頁的 cursor（沒有下一頁為 None）, 全部符合的筆數 {'total', 'stock_in', 'stock_out'})
+            全部符合的筆數只在第一頁（沒有 cursor）計算，後續頁為 None，沿用第一頁的結果
+        """
+        limit = min(max(int(limit), 1), self.MAX_PAGE_SIZE)
+        conditions, params = [], []
+        if operation in ('in', 'out'):
+            conditions.append('operation = ?')
+            params.append(operation)
+        else:
+            conditions.append("operation IN ('in', 'out')")
+        if part:
+            conditions.append('part = ?')
+            params.append(part)
+        if date_from:
+            conditions.append('timestamp >= ?')
+            params.append(date_from)
+        if date_to:
+            conditions.append('timestamp <= ?')
+            params.append(date_to)
+        if keyword:
+            # 先以 n-gram 索引交集縮小範圍，再確認子字串（關鍵字太短而沒有 n-gram 時只能逐筆比對）
+            grams = self._selective_grams(_grams(keyword))
+            if grams:
+                with self._read_lock:
+                    candidates = [row[0] for row in self._reader.execute(' INTERSECT '.join(
+                        'SELECT id FROM history_grams WHERE gram = ?' for _ in grams), grams)]
+                conditions.append('id IN (SELECT value FROM json_each(?))')
+                params.append(json.dumps(candidates))
+            conditions.append("instr(py_lower(coalesce(item_id, '') || ' ' || coalesce(note, '') || ' ' || "
+                              "coalesce(field, '') || ' ' || coalesce(user, '') || ' ' || coalesce(part, '')), ?) > 0")
+            params.append(keyword.lower())
+        where = 'WHERE ' + ' AND '.join(conditions)
+
+        stats = None
+        if cursor is None:
+            with self._lock:
+                counts = dict(self._conn.execute(
+                    f'SELECT operation, COUNT(*) FROM history {where} GROUP BY operation', params).fetchall())
+            stats = {'total': sum(counts.values()), 'stock_in': counts.get('in', 0), 'stock_out': counts.get('out', 0)}
+        else:
+            where += ' AND id < ?'
+            params.append(int(cursor))
+        entries = self._select(where, params, limit=limit + 1)
+        next_cursor = None
+        if len(entries) > limit:
+            entries = entries[:limit]
+            next_cursor = entries[-1]['id']
+        return entries, next_cursor, stats
+
+    def find(self, part, item_id, timestamp, field):
+        """以 (part, item_id, timestamp, field) 找出最新的一筆；找不到時回傳 None"""
+        found = self._select('WHERE part = ? AND item_id = ? AND timestamp = ? AND field = ?',
+                             (part, str(item_id), timestamp, field), limit=1)
+        return found[0] if found else None
+
+    def update(self, entry_id, **values):
+        """就地修正單筆歷程（例如 note、new_value）；統計依修正前後的內容在同一交易內調整"""
+        if not values:
+            return
+        assignments = ', '.join(f'{_column(k)} = ?' for k in values)
+        counted = 'SELECT part, item_id, user, timestamp FROM history WHERE id = ?'
+        with self._lock, self._conn:
+            before = self._conn.execute(counted, (entry_id,)).fetchone()
+            self._conn.execute(f'UPDATE history SET {assignments} WHERE id = ?', (*values.values(), entry_id))
+            after = self._conn.execute(counted, (entry_id,)).fetchone()
+            if before != after:
+                self._count(*before, -1)
+                self._count(*after, 1)
+            if any(key in _SEARCH_FIELDS for key in values):
+                self._reindex([entry_id])
+
+    def delete(self, part, item_id, timestamp, field):
+        """刪除符合 (part, item_id, timestamp, field) 的歷程，回傳是否有刪除"""
+        where = 'WHERE part = ? AND item_id = ? AND timestamp = ? AND field = ?'
+        params = (part, str(item_id), timestamp, field)
+        with self._lock, self._conn:
+            removed = self._conn.execute(f'SELECT id, part, item_id, user, timestamp FROM history {where}', params).fetchall()
+            self._conn.execute(f'DELETE FROM history {where}', params)
+            for row in removed:
+                self._count(*row[1:], -1)
+            self._unindex([row[0] for row in removed])
+        return bool(removed)
+
+
+_HISTORIES = {}
+_HISTORIES_LOCK = threading.Lock()
+
+
+def get_history(db_path, legacy_json=None):
+    db_path = os.path.abspath(db_path)
+    with _HISTORIES_LOCK:
+        history = _HISTORIES.get(db_path)
+        if history is None:
+            history = _HISTORIES[db_path] = EditHistory(db_path, legacy_json)
+        return history
@@ -0,0 +1,242 @@
+"""
+活頁簿修改的寫入日誌（write-behind）
+修改先寫入 SQLite（WAL 模式，commit 後即持久化）再回應使用者；尚未寫回的修改由讀取端覆蓋在快照上，
+背景寫入執行緒把累積的修改一次開檔、套用、存檔，成功後標記為已寫回。
+程序中斷時未寫回的修改留在日誌中，啟動時重新套用。套用必須是冪等的（寫回與標記之間中斷會重複套用）。
+僅支援單一程序（尚未寫回的清單保留在記憶體中）。
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import current_app, has_app_context
+
+
+class EditJournal:
+    """以 SQLite 保存的修改日誌，記憶體中保留尚未寫回的項目"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS edits (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                workbook TEXT NOT NULL,
+                part TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                flushed_at TEXT,
+                error TEXT
+            )''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_edits_pending ON edits (workbook, flushed_at)')
+        self._conn.commit()
+        # {workbook: [entry, ...]}，依 id 排序
+        self._pending = {}
+        for row_id, workbook, part, payload in self._conn.execute(
+                'SELECT id, workbook, part, payload FROM edits WHERE flushed_at IS NULL ORDER BY id'):
+            self._pending.setdefault(workbook, []).append(self._entry(row_id, part, payload))
+
+    @staticmethod
+    def _entry(row_id, part, payload):
+        entry = json.loads(payload)
+        entry['id'] = row_id
+        entry['part'] = part
+        return entry
+
+    def append(self, workbook, part, payload):
+        """寫入一筆修改，commit 完成後才回傳（回傳值為日誌 id）"""
+        return self.append_many(workbook, [(part, payload)])[0]
+
+    def append_many(self, workbook, items):
+        """以單一交易寫入多筆修改 [(part, payload), ...]，回傳各筆日誌 id"""
+        workbook = os.path.abspath(workbook)
+        created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        rows = [(part, json.dumps(payload, ensure_ascii=False, default=str)) for part, payload in items]
+        ids = []
+        with self._lock:
+            with self._conn:
+                for part, text in rows:
+                    cur = self._conn.execute(
+                        'INSERT INTO edits (workbook, part, payload, created_at) VALUES (?, ?, ?, ?)',
+                        (workbook, part, text, created_at))
+                    ids.append(cur.lastrowid)
+            pending = self._pending.setdefault(workbook, [])
+            for row_id, (part, text) in zip(ids, rows):
+                pending.append(self._entry(row_id, part, text))
+        return ids
+
+    def pending(self, workbook):
+        """尚未寫回的修改（依寫入順序）"""
+        with self._lock:
+            return list(self._pending.get(os.path.abspath(workbook), ()))
+
+    def mark_flushed(self, workbook, ids, errors=None):
+        """標記已寫回；errors 為 {id: 錯誤訊息}，無法套用的修改也標記，避免阻塞後續寫回"""
+        workbook = os.path.abspath(workbook)
+        errors = errors or {}
+        ids = set(ids)
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            self._conn.executemany('UPDATE edits SET flushed_at = ?, error = ? WHERE id = ?',
+                                   [(now, errors.get(i), i) for i in ids])
+            self._conn.commit()
+            self._pending[workbook] = [e for e in self._pending.get(workbook, []) if e['id'] not in ids]
+
+
+class JournalWriter:
+    """單一活頁簿的背景寫入執行緒
+
+    apply_fn(path, entries) 一次開檔套用所有修改並存檔，回傳 {id: 錯誤訊息}（成功的不列入）。
+    wrap_flush(path, write) 包住寫回與標記（例如以 registry.apply_change 更新快取鍵），回傳 write() 的結果。
+    run(fn) 決定背景寫回在哪裡執行（例如活頁簿的寫入佇列），回傳 fn() 的結果；預設在背景執行緒直接執行。
+    寫回失敗與無法套用的修改記錄在 stats()，供管理者查詢（失敗時修改留在日誌中，日誌會持續累積）。
+    """
+
+    FLUSH_DELAY = 1.0  # 收到第一筆修改後等待的秒數，讓連續的修改合併成一次存檔
+    RECENT_ERRORS = 20  # stats() 保留最近幾筆無法套用的修改
+
+    def __init__(self, journal, workbook, apply_fn, on_flushed=None, wrap_flush=None, run=None):
+        self.journal = journal
+        self.workbook = os.path.abspath(workbook)
+        self.apply_fn = apply_fn
+        self.on_flushed = on_flushed
+        self.wrap_flush = wrap_flush
+        self.run = run
+        # 寫回與其他直接修改檔案的操作互斥（可重入：exclusive 內會先寫回）
+        self.lock = threading.RLock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'flushes': 0, 'flushed_edits': 0, 'failures': 0, 'consecutive_failures': 0,
+            'last_flush_at': None, 'last_error': None, 'last_error_at': None, 'apply_errors': 0
+        }
+        self._recent_errors = deque(maxlen=self.RECENT_ERRORS)
+
+    def notify(self):
+        """有新的修改：喚醒背景執行緒（必要時啟動；同時呼叫時只會啟動一個）"""
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                app = current_app._get_current_object() if has_app_context() else None
+                self._thread = threading.Thread(target=self._run, args=(app,), daemon=True,
+                                                name=f"journal-writer-{os.path.basename(self.workbook)}")
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self, app):
+        if app is not None:
+            with app.app_context():
+                self._loop()
+        else:
+            self._loop()
+
+    def _loop(self):
+        while True:
+            self._wakeup.wait()
+            time.sleep(self.FLUSH_DELAY)
+            self._wakeup.clear()
+            try:
+                if self.run:
+                    self.run(self.flush)
+                else:
+                    self.flush()
+            except Exception as e:
+                # 修改仍在日誌中，稍後重試
+                print(f"[Journal] 寫回 {os.path.basename(self.workbook)} 失敗，稍後重試: {e}")
+                time.sleep(5)
+                self._wakeup.set()
+
+    def flush(self):
+        """把所有尚未寫回的修改一次寫入檔案，回傳寫回筆數"""
+        with self.lock:
+            entries = self.journal.pending(self.workbook)
+            if not entries:
+                return 0
+            t0 = time.perf_counter()
+
+            def write():
+                errors = self.apply_fn(self.workbook, entries)
+                self.journal.mark_flushed(self.workbook, [e['id'] for e in entries], errors)
+                return errors
+
+            try:
+                errors = self.wrap_flush(self.workbook, write) if self.wrap_flush else write()
+            except Exception as e:
+                self._record_failure(e)
+                raise
+            self._record_flush(entries, errors or {})
+            print(f"[Journal] 寫回 {os.path.basename(self.workbook)} {len(entries)} 筆修改 "
+                  f"({(time.perf_counter() - t0) * 1000:.0f} ms)")
+            for entry_id, error in (errors or {}).items():
+                print(f"[Journal] 修改 #{entry_id} 無法套用: {error}")
+            if self.on_flushed:
+                self.on_flushed(self.workbook)
+            return len(entries)
+
+    def _record_flush(self, entries, errors):
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        by_id = {e['id']: e for e in entries}
+        with self._stats_lock:
+            s = self._stats
+            s['flushes'] += 1
+            s['flushed_edits'] += len(entries)
+            s['consecutive_failures'] = 0
+            s['last_flush_at'] = now
+            s['apply_errors'] += len(errors)
+            for entry_id, error in errors.items():
+                self._recent_errors.append({'id': entry_id, 'part': by_id.get(entry_id, {}).get('part'),
+                                            'error': str(error), 'at': now})
+
+    def _record_failure(self, error):
+        with self._stats_lock:
+            s = self._stats
+            s['failures'] += 1
+            s['consecutive_failures'] += 1
+            s['last_error'] = str(error)
+            s['last_error_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    def stats(self):
+        """寫回狀態：尚未寫回的筆數、寫回 / 失敗次數、最後的錯誤與最近無法套用的修改"""
+        with self._stats_lock:
+            result = dict(self._stats)
+            result['recent_apply_errors'] = list(self._recent_errors)
+        result['pending'] = len(self.journal.pending(self.workbook))
+        result['healthy'] = result['consecutive_failures'] == 0
+        return result
+
+    @contextmanager
+    def exclusive(self):
+        """直接讀寫檔案前使用：先寫回日誌中的修改，期間背景執行緒不會存檔
+
+        寫回失敗時仍繼續（修改留在日誌中，之後寫回並覆蓋在本次操作之後）
+        """
+        with self.lock:
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[Journal] 寫回 {os.path.basename(self.workbook)} 失敗: {e}")
+            yield
+
+
+# {db_path: EditJournal}
+_JOURNALS = {}
+_JOURNALS_LOCK = threading.Lock()
+
+
+def get_journal(db_path):
+    db_path = os.path.abspath(db_path)
+    with _JOURNALS_LOCK:
+        journal = _JOURNALS.get(db_path)
+        if journal is None:
+            journal = _JOURNALS[db_path] = EditJournal(db_path)
+        return journal
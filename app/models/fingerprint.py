@@ -0,0 +1,112 @@
+"""
+資料檔案指紋
+先比對檔案大小與 mtime，只有變動時才重新計算內容雜湊。
+快取一律以內容雜湊判斷是否失效，內容相同的重新下載或 touch 不會觸發重建。
+每個檔案另有世代編號：內容雜湊每變更一次加一，供快取與統計判斷讀到的是哪一版檔案。
+"""
+import hashlib
+import os
+import threading
+import time
+
+
+# {abspath: (size, mtime_ns, digest)}
+_STAT_MEMO = {}
+# {abspath: (digest, 世代編號)}
+_GENERATIONS = {}
+_MEMO_LOCK = threading.Lock()
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _hash_file(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_fingerprint(path):
+    """回傳檔案內容雜湊（檔案不存在時拋出 FileNotFoundError，與 os.path.getmtime 相同）"""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    memo = _STAT_MEMO.get(path)
+    if memo is not None and memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+        return memo[2]
+
+    digest = _hash_file(path)
+    _remember(path, st, digest)
+    return digest
+
+
+def _remember(path, st, digest):
+    """記錄檔案狀態與雜湊，內容變更時世代編號加一；回傳世代編號"""
+    with _MEMO_LOCK:
+        _STAT_MEMO[path] = (st.st_size, st.st_mtime_ns, digest)
+        last = _GENERATIONS.get(path)
+        if last is None or last[0] != digest:
+            last = _GENERATIONS[path] = (digest, last[1] + 1 if last else 1)
+        return last[1]
+
+
+def read_generation(path, validate=None, retries=3, delay=0.2):
+    """一次讀入整個檔案，確保內容屬於同一個世代
+
+    讀取前後的大小與 mtime 不同（有人正在原地覆寫）或 validate(data) 失敗（讀到不完整的檔案）時，
+    稍候重試，重試用盡才拋出最後的錯誤。讀取者之後只解析回傳的內容，不再重新開檔。
+
+    Returns:
+        tuple: (檔案內容 bytes, 內容雜湊, 世代編號)
+    """
+    path = os.path.abspath(path)
+    last_error = None
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(delay)
+        st = os.stat(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        after = os.stat(path)
+        if (st.st_size, st.st_mtime_ns) != (after.st_size, after.st_mtime_ns) or len(data) != st.st_size:
+            last_error = OSError(f'{os.path.basename(path)} 讀取期間被修改')
+            continue
+        if validate is not None:
+            try:
+                validate(data)
+            except Exception as e:
+                last_error = e
+                continue
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        return data, digest, _remember(path, st, digest)
+    print(f"[Fingerprint] {os.path.basename(path)} 重試 {retries} 次仍無法讀到完整內容: {last_error}")
+    raise last_error
+
+
+def file_generation(path):
+    """檔案目前內容的世代編號（內容未變更時不變）"""
+    path = os.path.abspath(path)
+    file_fingerprint(path)  # 內容變更時在此更新世代
+    with _MEMO_LOCK:
+        return _GENERATIONS[path][1]
+
+
+def known_generation(path):
+    """最近一次比對或讀取時記錄的世代編號（不重新 stat 檔案；尚未記錄時為 None）"""
+    with _MEMO_LOCK:
+        last = _GENERATIONS.get(os.path.abspath(path))
+    return last[1] if last else None
+
+
+def file_generations():
+    """已讀取過的各檔案世代 {檔名: 世代編號}"""
+    with _MEMO_LOCK:
+        return {os.path.basename(path): generation for path, (_, generation) in _GENERATIONS.items()}
+
+
+def optional_fingerprint(path):
+    """檔案不存在時回傳 None（用於可選的輸入檔，如 未加工機型.xlsx）"""
+    try:
+        return file_fingerprint(path)
+    except FileNotFoundError:
+        return None
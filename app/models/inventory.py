@@ -1,372 +1,821 @@
 import pandas as pd
-from flask import current_app
+import numpy as np
+from flask import current_app, has_app_context
 from openpyxl import load_workbook
 from datetime import datetime
-import json
 import os
-import pickle
-
-
-# ── 快取 ────────────────────────────────────────────────────────────
-_INVENTORY_CACHE = {'mtime': 0, 'data': None}
-_MASTER_MODEL_CACHE = {'mtime': 0, 'data': None}
-
-def normalize_model_name(model_name):
-    """標準化機型名稱，移除後綴變體，用於匹配"""
-    import re
-    if not model_name:
-        return model_name
-    
-    normalized = str(model_name).strip().upper() # 轉大寫
-    
-    # 移除常見後綴（僅移除「底座」，保留「主底座/副底座」作為區分）
-    normalized = re.sub(r'底座$', '', normalized)
-    
-    # 移除括號內容（如 (工作台-鑽孔)）- 暫時停用避免誤刪關鍵區分資訊
-    # normalized = re.sub(r'\([^)]*\)$', '', normalized)
-    
-    # 僅移除符號與空格，保留中文字以便區分（如主/副底座）
-    normalized = re.sub(r'[-_\s/.\(\)]', '', normalized)
-    
-    return normalized
-
-def _get_master_model_list(xl=None):
+import threading
+import zipfile
+from functools import partial, wraps
+from .workbook import get_casting_snapshot, casting_file_path, casting_sheet_key, casting_overlay_key, set_overlay_source, SheetChange, DEFAULT_READER_ENGINES
+from .cache_registry import registry, FileInput, FilePartInput, DatasetInput, TagInput
+from .edit_journal import get_journal, JournalWriter
+from .edit_history import get_history
+from .snapshot_store import SnapshotCodec
+from .model_names import normalize_model_name, get_model_index
+from .xlsx_patch import WorkbookPatch, PatchUnsupported
+from .casting_store import get_store
+from .write_queue import get_write_queue, WriteQueueFull
+from .atomic_file import save_workbook
+from .fingerprint import known_generation
+
+def _build_master_model_list():
     """從所有零件工作表收集完整機型清單（保留原始名稱，智能分組排序）"""
-    global _MASTER_MODEL_CACHE
-    try:
-        casting_file = current_app.config['CASTING_FILE']
-        mtime = os.path.getmtime(casting_file)
+    snapshot = get_casting_snapshot()
 
-        # 若快取仍有效，直接回傳
-        if _MASTER_MODEL_CACHE['mtime'] == mtime and _MASTER_MODEL_CACHE['data'] is not None:
-            return _MASTER_MODEL_CACHE['data']
+    all_models = {}
+    normalized_seen = set()
 
-        # 嘗試讀取持久化快取
-        cache_dir = os.path.join(os.getcwd(), 'app', 'cache')
-        os.makedirs(cache_dir, exist_ok=True)
-        cache_file = os.path.join(cache_dir, 'master_models.pkl')
-        if os.path.exists(cache_file):
-            try:
-                with open(cache_file, 'rb') as f:
-                    cached = pickle.load(f)
-                if cached.get('mtime') == mtime:
-                    _MASTER_MODEL_CACHE['mtime'] = mtime
-                    _MASTER_MODEL_CACHE['data'] = cached['data']
-                    return cached['data']
-            except:
-                pass
-
-        if xl is None:
-            # 使用更穩定的 openpyxl 引擎
-            xl = pd.ExcelFile(casting_file, engine='openpyxl')
-
-        all_models = {}
-        normalized_seen = set()
+    # 優先從第一個分頁「總數」(index 0) 抓取機型順序
+    try:
+        df_summary = snapshot.sheet(0)
+        if not df_summary.empty:
+            # 假設機型在第一欄或名為「機型」的欄位
+            model_col = '機型' if '機型' in df_summary.columns else df_summary.columns[0]
+            models = df_summary[model_col].dropna().unique()
+            for m in models:
+                model_str = str(m).strip()
+                if 'VW-X340' in model_str:
+                    continue
+                if model_str and model_str not in ['nan', '品號', '機型']:
+                    norm = normalize_model_name(model_str)
+                    if norm not in normalized_seen:
+                        all_models[model_str] = True
+                        normalized_seen.add(norm)
+    except Exception as e:
+        print(f"Error reading Summary sheet: {e}")
 
-        # 優先從第一個分頁「總數」(index 0) 抓取機型順序
+    # 如果總數分頁沒抓到，再從其他零件分頁補充 (確保不遺漏)
+    for sheet_name, sheet_idx in [('底座', 1), ('工作台', 2), ('橫樑', 3), ('立柱', 4), ('定樑', 7)]:
         try:
-            df_summary = pd.read_excel(xl, sheet_name=0)
-            if not df_summary.empty:
-                # 假設機型在第一欄或名為「機型」的欄位
-                model_col = '機型' if '機型' in df_summary.columns else df_summary.columns[0]
-                models = df_summary[model_col].dropna().unique()
+            df = snapshot.sheet(sheet_idx)
+            if len(df.columns) > 1:
+                model_col = df.columns[1]
+                models = df[model_col].dropna().unique()
                 for m in models:
                     model_str = str(m).strip()
+                    # 排除特定不正確的項目
                     if 'VW-X340' in model_str:
                         continue
+                        
                     if model_str and model_str not in ['nan', '品號', '機型']:
                         norm = normalize_model_name(model_str)
                         if norm not in normalized_seen:
                             all_models[model_str] = True
                             normalized_seen.add(norm)
         except Exception as e:
-            print(f"Error reading Summary sheet: {e}")
+            print(f"Error reading {sheet_name}: {e}")
 
-        # 如果總數分頁沒抓到，再從其他零件分頁補充 (確保不遺漏)
-        for sheet_name, sheet_idx in [('底座', 1), ('工作台', 2), ('橫樑', 3), ('立柱', 4), ('定樑', 7)]:
-            try:
-                df = pd.read_excel(xl, sheet_name=sheet_idx)
-                if len(df.columns) > 1:
-                    model_col = df.columns[1]
-                    models = df[model_col].dropna().unique()
-                    for m in models:
-                        model_str = str(m).strip()
-                        # 排除特定不正確的項目
-                        if 'VW-X340' in model_str:
-                            continue
-                            
-                        if model_str and model_str not in ['nan', '品號', '機型']:
-                            norm = normalize_model_name(model_str)
-                            if norm not in normalized_seen:
-                                all_models[model_str] = True
-                                normalized_seen.add(norm)
-            except Exception as e:
-                print(f"Error reading {sheet_name}: {e}")
+    # 直接照著收集到的順序回傳
+    return list(all_models.keys())
 
-        # 直接照著收集到的順序回傳
-        result = list(all_models.keys())
 
-        # 更新快取
-        _MASTER_MODEL_CACHE['mtime'] = mtime
-        _MASTER_MODEL_CACHE['data'] = result
-        
+_MASTER_MODELS_SNAPSHOT = SnapshotCodec(
+    'master_models.snap', 1,
+    encode=lambda models: ({'models': [{'機型': m} for m in models]}, None),
+    decode=lambda reader: reader.column('models', '機型') if reader.rows('models') else []
+)
+
+def _appends_rows(change):
+    return any(positions and max(positions) >= len(change.before.sheet(sheet_idx))
+               for sheet_idx, positions in change.rows.items())
+
+def _master_models_delta(models, change):
+    """修改既有列不影響機型清單；新增列時重建"""
+    return None if _appends_rows(change) else models
+
+
+registry.register('master_models', _build_master_model_list,
+                  inputs=[FileInput(casting_file_path), TagInput(casting_overlay_key)], persist=_MASTER_MODELS_SNAPSHOT,
+                  delta=_master_models_delta)
+
+
+def _coerce_quantities(block):
+    """將製程欄位一次轉為整數矩陣（等同逐格 int(float(val))，無法轉換者視為 0）"""
+    values = np.zeros(block.shape, dtype='float64')
+    for i in range(block.shape[1]):
+        col = block.iloc[:, i]
+        if pd.api.types.is_numeric_dtype(col) and not pd.api.types.is_timedelta64_dtype(col):
+            values[:, i] = col.to_numpy(dtype='float64', na_value=np.nan)
+        elif col.dtype == object:
+            values[:, i] = pd.to_numeric(col, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+        # 日期等其他型別無法轉為數量，維持 0
+    values[~np.isfinite(values)] = 0
+    return np.trunc(values).astype('int64')
+
+
+def _aggregate_part_frame(df, part_name):
+    """以欄為單位彙總單一零件分頁
+
+    Returns:
+        dict: {'total': 總數, 'semi': 半品, 'finished': 成品,
+               'models': [(標準化鍵, 首見機型名稱, 數量), ...]（依首次出現順序）}
+    """
+    result = {'total': 0, 'semi': 0, 'finished': 0, 'models': []}
+    if '機型' not in df.columns:
+        return result
+
+    config = CONFIGS.get(part_name, [])
+    n_cols = df.shape[1]
+    field_to_idx = {label: idx for label, idx in config}
+
+    # 欄位索引超出分頁寬度者略過（與舊版 col_idx < len(row) 相同）
+    process_idx = [idx for label, idx in config if label != '總數' and idx < n_cols]
+    semi_idx = [field_to_idx[f] for f in SEMI_FINISHED_FIELDS.get(part_name, [])
+                if f in field_to_idx and field_to_idx[f] < n_cols]
+    finished_idx = [field_to_idx[f] for f in FINISHED_FIELDS.get(part_name, [])
+                    if f in field_to_idx and field_to_idx[f] < n_cols]
+
+    # 排除無效機型（空白、表頭重複的「品號」）
+    models = df['機型']
+    model_str = models.astype(str).str.strip()
+    mask = (models.notna() & (model_str != '') & (model_str != '品號')).to_numpy()
+    if not mask.any():
+        return result
+
+    used_idx = sorted(set(process_idx) | set(semi_idx) | set(finished_idx))
+    pos = {idx: i for i, idx in enumerate(used_idx)}
+    qty = _coerce_quantities(df.iloc[mask, used_idx])
+
+    row_total = qty[:, [pos[i] for i in process_idx]].sum(axis=1)
+    result['total'] = int(row_total.sum())
+    result['semi'] = int(qty[:, [pos[i] for i in semi_idx]].sum())
+    result['finished'] = int(qty[:, [pos[i] for i in finished_idx]].sum())
+
+    # 依標準化機型分組；標準化後為空字串者以原名稱各自成組
+    raw = model_str[mask].to_numpy()
+    norm = np.array([normalize_model_name(m) for m in raw], dtype=object)
+    key = np.where(norm != '', norm, '\x00' + raw)
+    codes, uniques = pd.factorize(key, sort=False)
+    group_qty = np.bincount(codes, weights=row_total, minlength=len(uniques)).astype('int64')
+    _, first_pos = np.unique(codes, return_index=True)
+    result['models'] = [
+        ('' if k.startswith('\x00') else k, raw[first], int(q))
+        for k, first, q in zip(uniques, first_pos, group_qty)
+    ]
+    return result
+
+
+def _merge_part_models(part_name, part_models, all_models, normalized_map):
+    """將單一分頁的機型彙總累加到總表（新機型依出現順序加入並登錄標準化對照）"""
+    for norm_key, raw_name, qty in part_models:
+        model_str = normalized_map.get(norm_key, raw_name) if norm_key else raw_name
+        if model_str not in all_models:
+            all_models[model_str] = {'機型': model_str, '底座': 0, '工作台': 0, '橫樑': 0, '立柱': 0, '定樑': 0}
+            # 更新 mapping 避免重複建立
+            if norm_key: normalized_map[norm_key] = model_str
+        # 累加到總表 (使用 += 處理重複出現的機型)
+        all_models[model_str][part_name] += qty
+
+
+def _build_casting_inventory():
+    """從各個鑄件工作表彙總庫存"""
+    # 共用已解析的活頁簿快照
+    snapshot = get_casting_snapshot()
+
+    # 從各個鑄件工作表計算總數
+    inventory = {}
+    semi_finished = {}  # 半品總數
+    finished = {}  # 成品總數
+    all_models = {}  # 儲存所有機型的數據
+
+    # 1. 建立完整機型清單（從所有零件分頁收集）
+    master_models = registry.get('master_models')
+    
+    for model_str in master_models:
+        all_models[model_str] = {'機型': model_str, '底座': 0, '工作台': 0, '橫樑': 0, '立柱': 0, '定樑': 0}
+    # normalized -> canonical name（複製共用索引，合併時會補上只出現在零件分頁的機型）
+    normalized_map = dict(get_model_index())
+    
+    for part_name, sheet_idx in [('底座', 1), ('工作台', 2), ('橫樑', 3), ('立柱', 4), ('定樑', 7)]:
         try:
-            with open(cache_file, 'wb') as f:
-                pickle.dump({'mtime': mtime, 'data': result}, f)
-        except:
-            pass
+            # 分頁未變更時直接沿用上一版快照的彙總結果
+            part = snapshot.derived(sheet_idx, 'aggregate', partial(_aggregate_part_frame, part_name=part_name))
+            _merge_part_models(part_name, part['models'], all_models, normalized_map)
             
-        return result
+            # 儲存該料件的加總結果
+            inventory[part_name] = part['total']
+            semi_finished[part_name] = part['semi']
+            finished[part_name] = part['finished']
+            
+        except Exception as e:
+            print(f"Error reading {part_name} details: {e}")
+    
+    # 確保順序：底座、工作台、橫樑、立柱
+    PART_ORDER = ['底座', '工作台', '橫樑', '立柱', '定樑']
+    
+    inventory = { k: inventory.get(k, 0) for k in PART_ORDER }
+    semi_finished = { k: semi_finished.get(k, 0) for k in PART_ORDER }
+    finished = { k: finished.get(k, 0) for k in PART_ORDER }
+    
+    # 轉換機型數據為列表 (包含零庫存機型)，保留原本 Excel 中的順序
+    details = list(all_models.values())
+    
+    return {
+        'summary': inventory,
+        'semi_finished': semi_finished,
+        'finished': finished,
+        'details': details,
+        'all_models': all_models
+    }
+
+
+def _inventory_model(all_models, model_index, norm_key, raw_name):
+    """彙總結果中對應的機型名稱（與 _merge_part_models 的對應規則相同），找不到時為 None"""
+    if not norm_key:
+        return raw_name if raw_name in all_models else None
+    if norm_key in model_index:
+        return model_index[norm_key]
+    # 只出現在零件分頁的機型，以首次出現的名稱加入總表
+    return next((name for name in all_models if normalize_model_name(name) == norm_key), None)
+
+def _inventory_delta(data, change):
+    """寫入後的增量更新：只以修改的列計算各總數與機型數量的差額（彙總對列是線性的）"""
+    if _appends_rows(change):
+        return None
+    result = {k: dict(data[k]) for k in ('summary', 'semi_finished', 'finished')}
+    all_models = dict(data['all_models'])
+    model_index = get_model_index()
+    for part_name, sheet_idx in SHEET_MAP.items():
+        positions = change.rows.get(sheet_idx)
+        if not positions:
+            continue
+        old = _aggregate_part_frame(change.before.sheet(sheet_idx).iloc[positions], part_name)
+        new = _aggregate_part_frame(change.after.sheet(sheet_idx).iloc[positions], part_name)
+        result['summary'][part_name] += new['total'] - old['total']
+        result['semi_finished'][part_name] += new['semi'] - old['semi']
+        result['finished'][part_name] += new['finished'] - old['finished']
+        for sign, part in ((-1, old), (1, new)):
+            for norm_key, raw_name, qty in part['models']:
+                model_str = _inventory_model(all_models, model_index, norm_key, raw_name)
+                if model_str is None:
+                    return None
+                row = all_models[model_str]
+                if row is data['all_models'].get(model_str):
+                    # 舊版本仍由讀取者共用，修改前先複製
+                    row = all_models[model_str] = dict(row)
+                row[part_name] += sign * qty
+    result['details'] = list(all_models.values())
+    result['all_models'] = all_models
+    return result
+
+
+def _encode_inventory(data):
+    meta = {k: data[k] for k in ('summary', 'semi_finished', 'finished')}
+    return {'details': data['details']}, meta
+
+def _decode_inventory(reader):
+    result = dict(reader.meta)
+    result['details'] = reader.records('details')
+    # all_models 與 details 共用同一批 dict
+    result['all_models'] = {d['機型']: d for d in result['details']}
+    return result
+
+
+registry.register('inventory', _build_casting_inventory,
+                  inputs=[FileInput(casting_file_path), TagInput(casting_overlay_key),
+                          DatasetInput('master_models'), DatasetInput('model_index')],
+                  persist=SnapshotCodec('inventory.snap', 1, _encode_inventory, _decode_inventory),
+                  delta=_inventory_delta)
 
-    except Exception as e:
-        print(f"Error loading master model list: {e}")
-        return []
 
 def load_casting_inventory():
-    """載入鑄件庫存資料（含快取：只有 Excel 修改時才重新讀取）"""
-    global _INVENTORY_CACHE
+    """載入鑄件庫存資料（含快取：只有 Excel 內容變更時才重新讀取）"""
     try:
-        casting_file = current_app.config['CASTING_FILE']
-        mtime = os.path.getmtime(casting_file)
+        return registry.get('inventory')
+    except Exception as e:
+        print(f"Error loading casting inventory: {e}")
+        return {'summary': {}, 'semi_finished': {}, 'finished': {}, 'details': [], 'all_models': {}, 'error': str(e)}
 
-        # 若快取仍有效，直接回傳
-        if _INVENTORY_CACHE['mtime'] == mtime and _INVENTORY_CACHE['data'] is not None:
-            return _INVENTORY_CACHE['data']
+# ── 儲存格修改的寫入日誌 ─────────────────────────────────────────
+# update_cell 把修改寫入日誌後立即回應，讀取端以覆蓋層看到新值，背景寫入執行緒合併寫回 Excel。
+# 覆蓋層（DataFrame）與寫回（openpyxl）使用同一套找列與總數規則，兩者結果一致且可重複套用。
+
+def _plain_value(val):
+    """DataFrame 儲存格轉回 openpyxl 的表示：NaN 為 None，整數值的浮點數為 int"""
+    if val is None or (isinstance(val, float) and np.isnan(val)):
+        return None
+    if isinstance(val, (float, np.floating)) and float(val).is_integer():
+        return int(val)
+    if isinstance(val, np.integer):
+        return int(val)
+    return val
+
+def _clean_item_id(val):
+    text = str(val).strip()
+    return text[:-2] if text.endswith('.0') else text
+
+class RowIndex:
+    """分頁的找列索引：品號 / 機型 -> 列位置（依品號、再依機型找列，同值取第一列）
+
+    每個分頁版本只建立一次；新增列時以 append() 更新。
+    fork() 回傳以本索引為基礎的新索引，新增的列只記在新索引上，共用的索引不會被修改。
+    """
 
-        # 嘗試讀取持久化快取
-        cache_dir = os.path.join(os.getcwd(), 'app', 'cache')
-        cache_file = os.path.join(cache_dir, 'inventory_cache.pkl')
-        if os.path.exists(cache_file):
+    def __init__(self, ids=(), models=(), parent=None):
+        self._parent = parent
+        self._base = len(parent) if parent is not None else 0
+        self._ids = []
+        self._models = []
+        self._by_id = {}
+        self._by_model = {}
+        for item_id, model_name in zip(ids, models):
+            self.append(item_id, model_name)
+
+    @classmethod
+    def from_frame(cls, df):
+        ids = [_plain_value(v) for v in df.iloc[:, 0]]
+        models = [_plain_value(v) for v in df.iloc[:, 1]] if df.shape[1] > 1 else [None] * len(df)
+        return cls(ids, models)
+
+    @classmethod
+    def from_worksheet(cls, ws):
+        ids, models = [], []
+        for row in ws.iter_rows(min_row=2, max_row=ws.max_row, max_col=2, values_only=True):
+            ids.append(row[0])
+            models.append(row[1] if len(row) > 1 else None)
+        return cls(ids, models)
+
+    def __len__(self):
+        return self._base + len(self._ids)
+
+    def fork(self):
+        return RowIndex(parent=self)
+
+    def append(self, item_id, model_name):
+        """新增一列，回傳其列位置"""
+        pos = len(self)
+        self._ids.append(item_id)
+        self._models.append(model_name)
+        self._by_id.setdefault(_clean_item_id(item_id), pos)
+        if model_name:
+            self._by_model.setdefault(str(model_name).strip(), pos)
+        return pos
+
+    def item_id_at(self, pos):
+        if pos < self._base:
+            return self._parent.item_id_at(pos)
+        return self._ids[pos - self._base]
+
+    def model_at(self, pos):
+        if pos < self._base:
+            return self._parent.model_at(pos)
+        return self._models[pos - self._base]
+
+    def _find(self, attr, key):
+        if self._parent is not None:
+            pos = self._parent._find(attr, key)
+            if pos is not None:
+                return pos
+        return getattr(self, attr).get(key)
+
+    def find_item(self, item_id):
+        return self._find('_by_id', _clean_item_id(item_id))
+
+    def find_model(self, model_name):
+        return self._find('_by_model', str(model_name).strip())
+
+    def locate(self, item_id, model_name, row=None):
+        return locate_row(self, item_id, model_name, row)
+
+def locate_row(index, item_id, model_name, row=None):
+    """依品號、再依機型找列（index 提供 find_item / find_model / item_id_at / model_at，如 RowIndex）
+
+    row 為規劃修改時的列位置：該列的品號 / 機型仍與 (item_id, model_name) 相同時直接使用，
+    品號為 N/A 且機型重複的列才能寫回規劃的那一列，而不是第一個同機型的列。
+
+    Returns:
+        tuple: (列位置 (找不到為 None), 實際品號)
+    """
+    if row is not None and 0 <= row < len(index) and \
+            _edit_key(index.item_id_at(row), index.model_at(row)) == _edit_key(item_id, model_name):
+        return row, index.item_id_at(row) or 'N/A'
+    # 方式1: 依品號搜尋 (僅當 item_id 不是 'N/A' 時)
+    if item_id and item_id != 'N/A':
+        pos = index.find_item(item_id)
+        if pos is not None:
+            return pos, item_id
+    # 方式2: 依機型搜尋 (如果 item_id 找不到或為 'N/A')，同時取得該列品號以便記錄
+    if model_name:
+        pos = index.find_model(model_name)
+        if pos is not None:
+            return pos, index.item_id_at(pos) or 'N/A'
+    return None, item_id
+
+def sheet_row_index(snapshot, sheet_idx):
+    """快照中分頁的找列索引（跟著分頁版本沿用，呼叫者需新增列時請先 fork()）"""
+    return snapshot.derived(sheet_idx, 'row_index', RowIndex.from_frame)
+
+def _row_total(config, value_at):
+    """計算總數 (不含總數欄本身)"""
+    total = 0
+    for label, idx in config:
+        if label != '總數':
+            cell_val = value_at(idx)
+            total += int(cell_val) if cell_val else 0
+    return total
+
+def _total_col(config):
+    return next((idx for label, idx in config if label == '總數'), None)
+
+def _apply_edit_to_worksheet(ws, index, edit):
+    config = CONFIGS[edit['part']]
+    col_idx = dict(config)[edit['field']]
+
+    pos, _ = index.locate(edit['item_id'], edit['model_name'], edit.get('row'))
+    if pos is None:
+        if not edit['model_name']:
+            raise ValueError('找不到對應的品號或機型')
+        # 找不到但有機型名稱，新增一行（品號設為 N/A）
+        target_row = ws.max_row + 1
+        ws.cell(row=target_row, column=1, value='N/A')
+        ws.cell(row=target_row, column=2, value=edit['model_name'])
+        index.append('N/A', edit['model_name'])
+    else:
+        target_row = pos + 2
+
+    # openpyxl column is 1-indexed
+    ws.cell(row=target_row, column=col_idx + 1, value=edit['value'])
+    total_col = _total_col(config)
+    if total_col is not None:
+        total = _row_total(config, lambda idx: ws.cell(row=target_row, column=idx + 1).value)
+        ws.cell(row=target_row, column=total_col + 1, value=total)
+
+def _set_frame_value(df, pos, col, value):
+    if col >= df.shape[1]:
+        return
+    value = _plain_value(value)
+    column = df.iloc[:, col]
+    kind = column.dtype.kind
+    is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+    fits = (kind == 'O' or (kind == 'f' and (value is None or is_number))
+            or (kind in 'iu' and isinstance(value, int) and not isinstance(value, bool)))
+    if not fits:
+        # 與重新讀檔後的結果相同：數值欄寫入文字或空值時改為 object / float 欄
+        column = column.astype('float64') if is_number or value is None else column.map(_plain_value).astype(object)
+        df.isetitem(col, column)
+    df.iat[pos, col] = np.nan if value is None else value
+
+def _apply_edit_to_frame(df, index, config, edit):
+    """套用一筆修改，回傳修改的列位置"""
+    col_idx = dict(config)[edit['field']]
+
+    pos, _ = index.locate(edit['item_id'], edit['model_name'], edit.get('row'))
+    if pos is None:
+        if not edit['model_name']:
+            raise ValueError('找不到對應的品號或機型')
+        pos = index.append('N/A', edit['model_name'])
+        df.loc[pos] = [np.nan] * df.shape[1]
+        _set_frame_value(df, pos, 0, 'N/A')
+        _set_frame_value(df, pos, 1, edit['model_name'])
+
+    _set_frame_value(df, pos, col_idx, edit['value'])
+    total_col = _total_col(config)
+    if total_col is not None:
+        total = _row_total(config, lambda idx: _plain_value(df.iat[pos, idx]) if idx < df.shape[1] else None)
+        _set_frame_value(df, pos, total_col, total)
+    return pos
+
+def _apply_edits_to_frame(part_type, edits, df):
+    """覆蓋層：把尚未寫回的修改套用到分頁 DataFrame 副本"""
+    config = CONFIGS[part_type]
+    index = RowIndex.from_frame(df)
+    for edit in edits:
+        try:
+            _apply_edit_to_frame(df, index, config, edit)
+        except Exception as e:
+            print(f"[Journal] 修改 #{edit['id']} 無法套用到 {part_type}: {e}")
+    return df
+
+def _patch_edit(sheet, index, edit):
+    """直接修補分頁 XML：只改寫該儲存格與總數；需要新增列時拋出 PatchUnsupported"""
+    config = CONFIGS[edit['part']]
+    col_idx = dict(config)[edit['field']]
+
+    pos, _ = index.locate(edit['item_id'], edit['model_name'], edit.get('row'))
+    if pos is None:
+        if not edit['model_name']:
+            raise ValueError('找不到對應的品號或機型')
+        raise PatchUnsupported(f"需要新增機型 {edit['model_name']} 的列")
+
+    target_row = pos + 2
+    sheet.set(target_row, col_idx + 1, edit['value'])
+    total_col = _total_col(config)
+    if total_col is not None:
+        sheet.set(target_row, total_col + 1, _row_total(config, lambda idx: sheet.value(target_row, idx + 1)))
+
+def _patch_cell_edits(casting_file, edits):
+    errors = {}
+    with WorkbookPatch(casting_file) as wb:
+        indexes = {}
+        for edit in edits:
             try:
-                with open(cache_file, 'rb') as f:
-                    cached = pickle.load(f)
-                if cached.get('mtime') == mtime:
-                    _INVENTORY_CACHE['mtime'] = mtime
-                    _INVENTORY_CACHE['data'] = cached['data']
-                    return cached['data']
-            except:
-                pass
+                sheet_idx = SHEET_MAP[edit['part']]
+                sheet = wb.sheet(sheet_idx)
+                if sheet_idx not in indexes:
+                    indexes[sheet_idx] = RowIndex(sheet.column(1), sheet.column(2))
+                _patch_edit(sheet, indexes[sheet_idx], edit)
+            except PatchUnsupported:
+                raise
+            except Exception as e:
+                errors[edit['id']] = str(e)
+        wb.save()
+    return errors
 
-        # 使用更穩定的 openpyxl 引擎 
-        xl = pd.ExcelFile(casting_file, engine='openpyxl')
+def _flush_cell_edits(casting_file, edits):
+    """背景寫入：一次套用所有修改並存檔，回傳無法套用的 {id: 錯誤訊息}
 
-        
-        # 從各個鑄件工作表計算總數
-        inventory = {}
-        semi_finished = {}  # 半品總數
-        finished = {}  # 成品總數
-        all_models = {}  # 儲存所有機型的數據
-
-        # 定義半品和成品的欄位映射
-        semi_finished_fields = {
-            '底座': ['素材', 'M4', 'M3'],
-            '工作台': ['素材', 'W1', 'W2', 'W4'],
-            '橫樑': ['素材', 'M6', 'M5'],
-            '立柱': ['素材', '半品', '成品銑工'],
-            '定樑': ['素材']
-        }
-        
-        finished_fields = {
-            '底座': ['成品研磨'],
-            '工作台': ['成品'],
-            '橫樑': ['成品研磨'],
-            '立柱': ['成品研磨'],
-            '定樑': ['成品']
-        }
+    只修改既有列時直接修補分頁 XML；需要新增列等結構性修改時改以 openpyxl 開檔
+    """
+    try:
+        return _patch_cell_edits(casting_file, edits)
+    except PatchUnsupported as e:
+        print(f"[Journal] 改用 openpyxl 寫回: {e}")
+    except (OSError, zipfile.BadZipFile):
+        raise
+    except Exception as e:
+        print(f"[Journal] 無法直接修補 {os.path.basename(casting_file)}，改用 openpyxl 寫回: {e}")
 
-        # 1. 建立完整機型清單（從所有零件分頁收集）
-        master_models = _get_master_model_list(xl=xl)
-        
-        normalized_map = {} # normalized -> canonical name
-        for model_str in master_models:
-            all_models[model_str] = {'機型': model_str, '底座': 0, '工作台': 0, '橫樑': 0, '立柱': 0, '定樑': 0}
-            norm = normalize_model_name(model_str)
-            if norm and norm not in normalized_map:
-                normalized_map[norm] = model_str
-        
-        for part_name, sheet_idx in [('底座', 1), ('工作台', 2), ('橫樑', 3), ('立柱', 4), ('定樑', 7)]:
+    errors = {}
+    wb = load_workbook(casting_file)
+    indexes = {}  # 分頁索引 -> 找列索引（每個分頁只掃描一次）
+    try:
+        for edit in edits:
             try:
-                df = pd.read_excel(xl, sheet_name=sheet_idx)
-                
-                # 取得所有製程欄位的索引（排除總數欄位）
-                config = CONFIGS.get(part_name, [])
-                process_col_indices = [idx for label, idx in config if label != '總數']
-                
-                # 建立欄位名稱到索引的映射
-                field_to_idx = {label: idx for label, idx in config}
-                
-                # 初始化該料件的總數
-                part_total = 0
-                part_semi = 0
-                part_finished = 0
-
-                # 提取機型詳細資料並累加總數
-                if '機型' in df.columns:
-                    for _, row in df.iterrows():
-                        model = row.get('機型', '')
-                        # 排除無效機型
-                        if pd.notna(model) and str(model).strip() and str(model).strip() != '品號':
-                            model_str = str(model).strip()
-                            # 嘗試使用標準化匹配
-                            norm_key = normalize_model_name(model_str)
-                            if norm_key in normalized_map:
-                                model_str = normalized_map[norm_key]
-                            
-                            # 初始化該機型的數據
-                            if model_str not in all_models:
-                                all_models[model_str] = {'機型': model_str, '底座': 0, '工作台': 0, '橫樑': 0, '立柱': 0, '定樑': 0}
-                                # 更新 mapping 避免重複建立
-                                if norm_key: normalized_map[norm_key] = model_str
-                            
-                            # 加總所有製程欄位的數量
-                            row_total = 0
-                            row_semi = 0
-                            row_finished = 0
-                            
-                            for col_idx in process_col_indices:
-                                if col_idx < len(row):
-                                    val = row.iloc[col_idx]
-                                    if pd.notna(val):
-                                        try:
-                                            qty = int(float(val))
-                                            row_total += qty
-                                        except:
-                                            pass
-                            
-                            # 計算半品數量
-                            for field_name in semi_finished_fields.get(part_name, []):
-                                if field_name in field_to_idx:
-                                    col_idx = field_to_idx[field_name]
-                                    if col_idx < len(row):
-                                        val = row.iloc[col_idx]
-                                        if pd.notna(val):
-                                            try:
-                                                row_semi += int(float(val))
-                                            except:
-                                                pass
-                            
-                            # 計算成品數量
-                            for field_name in finished_fields.get(part_name, []):
-                                if field_name in field_to_idx:
-                                    col_idx = field_to_idx[field_name]
-                                    if col_idx < len(row):
-                                        val = row.iloc[col_idx]
-                                        if pd.notna(val):
-                                            try:
-                                                row_finished += int(float(val))
-                                            except:
-                                                pass
-                            
-                            # 累加到總表 (使用 += 處理重複出現的機型)
-                            all_models[model_str][part_name] += row_total
-                            
-                            # 累加到該料件總數
-                            part_total += row_total
-                            part_semi += row_semi
-                            part_finished += row_finished
-                
-                # 儲存該料件的加總結果
-                inventory[part_name] = part_total
-                semi_finished[part_name] = part_semi
-                finished[part_name] = part_finished
-                
+                sheet_idx = SHEET_MAP[edit['part']]
+                ws = wb.worksheets[sheet_idx]
+                if sheet_idx not in indexes:
+                    indexes[sheet_idx] = RowIndex.from_worksheet(ws)
+                _apply_edit_to_worksheet(ws, indexes[sheet_idx], edit)
             except Exception as e:
-                print(f"Error reading {part_name} details: {e}")
-        
-        # 確保順序：底座、工作台、橫樑、立柱
-        PART_ORDER = ['底座', '工作台', '橫樑', '立柱', '定樑']
-        
-        inventory = { k: inventory.get(k, 0) for k in PART_ORDER }
-        semi_finished = { k: semi_finished.get(k, 0) for k in PART_ORDER }
-        finished = { k: finished.get(k, 0) for k in PART_ORDER }
-        
-        # 轉換機型數據為列表 (包含零庫存機型)，保留原本 Excel 中的順序
-        details = list(all_models.values())
-        
-        result = {
-            'summary': inventory,
-            'semi_finished': semi_finished,
-            'finished': finished,
-            'details': details,
-            'all_models': all_models
-        }
-
-        # 更新快取
-        _INVENTORY_CACHE['mtime'] = mtime
-        _INVENTORY_CACHE['data'] = result
-        
-        try:
-            with open(cache_file, 'wb') as f:
-                pickle.dump({'mtime': mtime, 'data': result}, f)
-        except:
-            pass
-            
-        
+                errors[edit['id']] = str(e)
+        save_workbook(wb, casting_file)
+    finally:
+        wb.close()
+    return errors
+
+
+def _edit_journal():
+    """鑄件盤點資料的寫入日誌（預設與修改歷程同在 logs 目錄）"""
+    db_path = current_app.config.get('EDIT_JOURNAL_FILE') or os.path.join(
+        os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'logs', 'edit_journal.db')
+    return get_journal(db_path)
+
+def _edit_history():
+    """修改歷程（只附加的 SQLite；第一次開啟時匯入舊版 logs/edit_history.json，並為舊紀錄補上機型）"""
+    log_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'logs')
+    db_path = (current_app.config.get('EDIT_HISTORY_FILE') if has_app_context() else None) or os.path.join(
+        log_dir, 'edit_history.db')
+    history = get_history(db_path, legacy_json=os.path.join(log_dir, 'edit_history.json'))
+    history.backfill_model_names(_lookup_model_name)
+    return history
+
+def _normalize_item_key(item_id):
+    """品號對照用的鍵（去除空白與 Excel 數值的 .0）"""
+    key = str(item_id if item_id is not None else '').strip()
+    return key[:-2] if key.endswith('.0') else key
+
+def _build_item_model_map(df):
+    """分頁的 品號→機型 對照（略過空白、nan 與重複表頭）"""
+    result = {}
+    if df.shape[1] < 2:
         return result
+    for p_id, model in df.iloc[:, :2].itertuples(index=False, name=None):
+        p_id, model = str(p_id).strip(), str(model).strip()
+        if p_id and p_id != 'nan' and p_id != '品號' and model and model != 'nan':
+            result[_normalize_item_key(p_id)] = model
+    return result
+
+def item_model_map(part_type):
+    """零件分頁的 品號→機型 對照；每個分頁版本只建立一次並沿用到下一版快照（呼叫者不可修改）"""
+    sheet_idx = SHEET_MAP.get(part_type)
+    if sheet_idx is None:
+        return {}
+    return get_casting_snapshot().derived(sheet_idx, 'item_models', _build_item_model_map)
+
+def _lookup_model_name(part_type, item_id):
+    return item_model_map(part_type).get(_normalize_item_key(item_id))
+
+def _history_model_name(part_type, item_id):
+    """記錄歷程時未提供機型：依目前分頁的對照表補上（查不到為 None）"""
+    try:
+        return _lookup_model_name(part_type, item_id)
+    except Exception as e:
+        print(f"[History] 無法查詢 {part_type} {item_id} 的機型: {e}")
+        return None
+
+# {(日誌路徑, 活頁簿路徑): JournalWriter}
+_WRITERS = {}
+_WRITERS_LOCK = threading.Lock()
+
+def _casting_writer():
+    journal = _edit_journal()
+    casting_file = os.path.abspath(current_app.config['CASTING_FILE'])
+    with _WRITERS_LOCK:
+        writer = _WRITERS.get((journal.db_path, casting_file))
+        if writer is None:
+            # 寫回在活頁簿的寫入執行緒上執行；寫回的內容已反映在快取（覆蓋層）中，寫回後只更新快取鍵
+            writer = JournalWriter(journal, casting_file, _flush_cell_edits, wrap_flush=registry.apply_change,
+                                   run=get_write_queue(casting_file).call)
+            _WRITERS[(journal.db_path, casting_file)] = writer
+        return writer
+
+def journal_writer_stats():
+    """各活頁簿寫入日誌的寫回狀態 {檔名: stats}"""
+    with _WRITERS_LOCK:
+        writers = list(_WRITERS.values())
+    return {os.path.basename(w.workbook): w.stats() for w in writers}
+
+def _casting_overlays(path):
+    """供活頁簿快照使用：{分頁索引: (待寫回修改 id, 套用函式)}"""
+    if not has_app_context() or os.path.abspath(path) != os.path.abspath(current_app.config['CASTING_FILE']):
+        return {}
+    store = _casting_store()
+    if store is not None:
+        # 資料庫模式：零件分頁整頁以資料庫內容取代；活頁簿換了世代（可能被直接編輯）時才檢查並重新匯入
+        try:
+            store.sync(known_generation(path))
+        except Exception as e:
+            print(f"[Store] 無法同步 {os.path.basename(path)}: {e}")
+        return {idx: (('db', store.version(idx)), lambda df, idx=idx: store.frame(idx))
+                for idx in store.sheets if store.version(idx) is not None}
+    by_part = {}
+    for edit in _edit_journal().pending(path):
+        by_part.setdefault(edit['part'], []).append(edit)
+    return {SHEET_MAP[part]: (tuple(e['id'] for e in edits), partial(_apply_edits_to_frame, part, edits))
+            for part, edits in by_part.items() if part in SHEET_MAP}
+
+set_overlay_source(_casting_overlays)
+
+
+def _casting_queue():
+    """鑄件盤點資料的寫入佇列：所有修改（含背景寫回）在同一個寫入執行緒依序執行"""
+    return get_write_queue(current_app.config['CASTING_FILE'])
+
+def flush_casting_edits():
+    """立即把日誌中尚未寫回的修改寫入 Excel，回傳寫回筆數"""
+    return _casting_queue().call(_casting_writer().flush)
+
+def replay_casting_edits():
+    """啟動時呼叫：上次結束前未寫回的修改交給背景寫入執行緒重新套用"""
+    writer = _casting_writer()
+    pending = writer.journal.pending(writer.workbook)
+    if pending:
+        print(f"[Journal] 發現 {len(pending)} 筆未寫回的修改，背景重新套用")
+        writer.notify()
+    return len(pending)
+
+# ── 資料庫模式（CASTING_STORE = 'sqlite'）────────────────────────
+# 零件分頁以資料庫為準：讀取者經由覆蓋層取得資料庫的分頁內容，寫入直接修改資料庫，活頁簿由背景寫回。
+# 資料庫的修改與寫入日誌使用相同的找列與總數規則。
+
+def _model_key(model_name):
+    return str(model_name).strip() if model_name else None
+
+def _casting_store():
+    """資料庫模式時回傳鑄件盤點資料的資料庫，否則為 None"""
+    if current_app.config.get('CASTING_STORE', 'excel') != 'sqlite':
+        return None
+    db_path = current_app.config.get('CASTING_DB_FILE') or os.path.join(
+        os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'logs', 'casting_store.db')
+    return get_store(db_path, current_app.config['CASTING_FILE'], sorted(SHEET_MAP.values()),
+                     item_key=_clean_item_id, model_key=_model_key,
+                     engines=current_app.config.get('CASTING_READER_ENGINES', DEFAULT_READER_ENGINES))
+
+def _set_store_value(sheet, config, pos, col_idx, value):
+    sheet.set(pos, col_idx, value)
+    total_col = _total_col(config)
+    if total_col is not None:
+        sheet.set(pos, total_col, _row_total(config, lambda idx: sheet.value(pos, idx)))
+
+def _apply_edits_to_store(items, sheet):
+    """資料庫模式的寫入：與寫入日誌的修改相同格式 [(part, edit), ...]"""
+    for part, edit in items:
+        config = CONFIGS[part]
+        store_sheet = sheet(SHEET_MAP[part])
+        pos, _ = locate_row(store_sheet, edit['item_id'], edit['model_name'], edit.get('row'))
+        if pos is None:
+            if not edit['model_name']:
+                raise ValueError('找不到對應的品號或機型')
+            pos = store_sheet.append({0: 'N/A', 1: edit['model_name']})
+        _set_store_value(store_sheet, config, pos, dict(config)[edit['field']], edit['value'])
+
+def _casting_change(casting_file, before, items, store):
+    """本次修改後的快照：只在修改的分頁上套用本次的修改（與重新建立快照時套用覆蓋層的結果相同）"""
+    overlays = _casting_overlays(casting_file)
+    by_sheet = {}
+    for part, edit in items:
+        by_sheet.setdefault(SHEET_MAP[part], []).append((part, edit))
+
+    frames, rows = {}, {}
+    for sheet_idx, sheet_items in by_sheet.items():
+        df = before.sheet(sheet_idx).copy()
+        index = sheet_row_index(before, sheet_idx).fork()
+        positions = set()
+        for part, edit in sheet_items:
+            try:
+                positions.add(_apply_edit_to_frame(df, index, CONFIGS[part], edit))
+            except Exception as e:
+                print(f"[Journal] 修改無法套用到 {part}: {e}")
+        if store is not None:
+            df = store.frame(sheet_idx)
+        frames[sheet_idx] = (overlays[sheet_idx][0] if sheet_idx in overlays else None, df)
+        rows[sheet_idx] = sorted(positions)
+    return SheetChange(before, before.with_sheets(frames), rows)
+
+def _record_cell_edits(casting_file, items):
+    """寫入已規劃好的儲存格修改（在寫入執行緒上執行）：資料庫模式寫入資料庫，否則寫入日誌由背景寫回
 
+    快取以本次修改增量更新（不重新彙總整本活頁簿），下一次讀取立即反映本次修改
+    """
+    store = _casting_store()
+    before = get_casting_snapshot(fresh=True)
+
+    def write():
+        if store is not None:
+            store.edit(partial(_apply_edits_to_store, items))
+        else:
+            _edit_journal().append_many(casting_file, items)
+            _casting_writer().notify()
+
+    registry.apply_change(casting_file, write, change=lambda: _casting_change(casting_file, before, items, store))
+
+def init_casting_store():
+    """啟動時呼叫：資料庫模式下先把日誌中的修改寫回活頁簿，再同步資料庫（首次啟用時匯入）"""
+    store = _casting_store()
+    if store is None:
+        return None
+    flush_casting_edits()
+    try:
+        store.sync()
+        store.notify()
     except Exception as e:
-        print(f"Error loading casting inventory: {e}")
-        return {'summary': {}, 'semi_finished': {}, 'finished': {}, 'details': [], 'all_models': {}, 'error': str(e)}
+        print(f"[Store] 無法同步 {os.path.basename(store.workbook)}: {e}")
+    return store
+
+
+def _exclusive_casting_write(fn):
+    """直接讀寫鑄件盤點資料的操作：在寫入執行緒上先寫回日誌中的修改再執行，與其他修改依序進行"""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        writer = _casting_writer()
+
+        def run():
+            with writer.exclusive():
+                return fn(*args, **kwargs)
+        return _casting_queue().call(run)
+    return wrapper
+
 
 def update_history_note(part, item_id, timestamp, field, new_note, new_qty=None):
     """更新歷史紀錄中的備註資訊與數量（不同步 Excel，僅供網頁顯示修正）"""
     try:
-        log_file = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'logs', 'edit_history.json')
-        
-        if not os.path.exists(log_file):
+        history = _edit_history()
+        # 使用 part, item_id, timestamp, field 作為複合鍵尋找紀錄
+        target = history.find(part, item_id, timestamp, field)
+        if target is None:
             return False
-        
-        with open(log_file, 'r', encoding='utf-8') as f:
-            history = json.load(f)
-        
-        updated = False
-        for h in history:
-            # 使用 part, item_id, timestamp, field 作為複合鍵尋找紀錄
-            if (h.get('part') == part and 
-                str(h.get('item_id')) == str(item_id) and 
-                h.get('timestamp') == timestamp and 
-                h.get('field') == field):
-                
-                h['note'] = new_note
-                if new_qty is not None:
-                    h['new_value'] = int(new_qty)
-                updated = True
-                break
-        
-        if updated:
-            with open(log_file, 'w', encoding='utf-8') as f:
-                json.dump(history, f, ensure_ascii=False, indent=2)
-            return True
-            
-        return False
+
+        values = {'note': new_note}
+        if new_qty is not None:
+            values['new_value'] = int(new_qty)
+        history.update(target['id'], **values)
+        return True
     
     except Exception as e:
         print(f"Error updating history note: {e}")
         return False
 
 
+def _history_target_row(sheet_idx, item_id, model_name, index=None):
+    """歷程修正要回寫的 Excel 列號：依品號、再依機型（N/A 與空值不比對品號）"""
+    if index is None:
+        index = sheet_row_index(get_casting_snapshot(fresh=True), sheet_idx)
+    check_id = _clean_item_id(item_id)
+    pos = None
+    if check_id and check_id not in ('N/A', 'nan', 'None'):
+        pos = index.find_item(check_id)
+    if pos is None and model_name:
+        pos = index.find_model(model_name)
+    return pos + 2 if pos is not None else None
+
+def _row_matches(ws, row_num, item_id, model_name):
+    check_id = _clean_item_id(item_id)
+    if check_id and check_id not in ('N/A', 'nan', 'None') and _clean_item_id(ws.cell(row=row_num, column=1).value) == check_id:
+        return True
+    model_value = ws.cell(row=row_num, column=2).value
+    return bool(model_name and model_value and str(model_value).strip() == str(model_name).strip())
+
+
+@_exclusive_casting_write
 def update_history_record(part, item_id, timestamp, field, new_note, new_qty, model_name=None):
     """更新歷史紀錄的備註與數量，並同步回寫 Excel（限製程轉換欄位）
     
     Returns: (success: bool, error_msg: str or None)
     """
     try:
-        log_file = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'logs', 'edit_history.json')
-        if not os.path.exists(log_file):
-            return False, '找不到歷史紀錄檔'
-
-        with open(log_file, 'r', encoding='utf-8') as f:
-            history = json.load(f)
-
-        target = None
-        for h in history:
-            if (h.get('part') == part and
-                str(h.get('item_id')) == str(item_id) and
-                h.get('timestamp') == timestamp and
-                h.get('field') == field):
-                target = h
-                break
-
+        history = _edit_history()
+        target = history.find(part, item_id, timestamp, field)
         if target is None:
             return False, '找不到對應的歷史紀錄'
 
@@ -394,58 +843,62 @@ def update_history_record(part, item_id, timestamp, field, new_note, new_qty, mo
                 if col_idx is None:
                     return False, f'無效的欄位: {field}'
 
-                wb = load_workbook(casting_file)
-                ws = wb.worksheets[sheet_idx]
-
-                target_row = None
-                check_id = str(item_id).strip()
-                if check_id.endswith('.0'): check_id = check_id[:-2]
-
-                if check_id and check_id not in ('N/A', 'nan'):
-                    for row_num in range(2, ws.max_row + 1):
-                        cell_value = str(ws.cell(row=row_num, column=1).value or '').strip()
-                        if cell_value.endswith('.0'): cell_value = cell_value[:-2]
-                        if cell_value == check_id:
-                            target_row = row_num
-                            break
-
-                if target_row is None and model_name:
-                    for row_num in range(2, ws.max_row + 1):
-                        mv = ws.cell(row=row_num, column=2).value
-                        if mv and str(mv).strip() == str(model_name).strip():
-                            target_row = row_num
-                            break
-
-                if target_row is not None:
-                    ws.cell(row=target_row, column=col_idx + 1, value=int(new_qty))
-                    # 重新計算總數
-                    total = 0
-                    for label, idx in config:
-                        if label != '總數':
-                            cv = ws.cell(row=target_row, column=idx + 1).value
-                            total += int(cv) if cv else 0
-                    for label, idx in config:
-                        if label == '總數':
-                            ws.cell(row=target_row, column=idx + 1, value=total)
-                            break
-                    wb.save(casting_file)
-                wb.close()
+                store = _casting_store()
+                if store is not None:
+                    # 資料庫模式：修改資料庫，活頁簿由背景寫回
+                    target_row = _history_target_row(sheet_idx, item_id, model_name)
+                    if target_row is not None:
+                        store.edit(lambda sheet: _set_store_value(sheet(sheet_idx), config, target_row - 2,
+                                                                  col_idx, int(new_qty)))
+                        registry.invalidate_file(casting_file)
+                else:
+                    target_row = _history_target_row(sheet_idx, item_id, model_name)
+
+                    wb = load_workbook(casting_file)
+                    try:
+                        ws = wb.worksheets[sheet_idx]
+
+                        # 索引與檔案內容不一致（例如分頁有表頭以外的空白列）時退回逐列比對
+                        if target_row is not None and not _row_matches(ws, target_row, item_id, model_name):
+                            target_row = _history_target_row(sheet_idx, item_id, model_name, RowIndex.from_worksheet(ws))
+
+                        if target_row is not None:
+                            ws.cell(row=target_row, column=col_idx + 1, value=int(new_qty))
+                            # 重新計算總數
+                            total = 0
+                            for label, idx in config:
+                                if label != '總數':
+                                    cv = ws.cell(row=target_row, column=idx + 1).value
+                                    total += int(cv) if cv else 0
+                            for label, idx in config:
+                                if label == '總數':
+                                    ws.cell(row=target_row, column=idx + 1, value=total)
+                                    break
+                            save_workbook(wb, casting_file)
+                            registry.invalidate_file(casting_file)
+                    finally:
+                        wb.close()
+            except WriteQueueFull:
+                raise
             except Exception as ex:
                 print(f"[update_history_record] Excel update failed: {ex}")
                 return False, f'Excel 同步失敗：{ex}'
 
+        values = {}
+        if qty_changed:
             # 更新歷史記錄的 new_value
-            target['new_value'] = int(new_qty)
+            values['new_value'] = int(new_qty)
 
         # 更新備註
         if new_note is not None:
-            target['note'] = new_note
+            values['note'] = new_note
 
-        with open(log_file, 'w', encoding='utf-8') as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
+        history.update(target['id'], **values)
 
         return True, None
 
+    except WriteQueueFull:
+        raise
     except Exception as e:
         print(f"Error updating history record: {e}")
         return False, str(e)
@@ -455,29 +908,7 @@ def update_history_record(part, item_id, timestamp, field, new_note, new_qty, mo
 def delete_history_record(part, item_id, timestamp, field):
     """從歷史紀錄中刪除特定紀錄"""
     try:
-        log_file = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'logs', 'edit_history.json')
-        
-        if not os.path.exists(log_file):
-            return False
-        
-        with open(log_file, 'r', encoding='utf-8') as f:
-            history = json.load(f)
-        
-        # 尋找並過濾掉要刪除的紀錄
-        original_len = len(history)
-        history = [h for h in history if not (
-            h.get('part') == part and 
-            str(h.get('item_id')) == str(item_id) and 
-            h.get('timestamp') == timestamp and 
-            h.get('field') == field
-        )]
-        
-        if len(history) < original_len:
-            with open(log_file, 'w', encoding='utf-8') as f:
-                json.dump(history, f, ensure_ascii=False, indent=2)
-            return True
-            
-        return False
+        return _edit_history().delete(part, item_id, timestamp, field)
     
     except Exception as e:
         print(f"Error deleting history record: {e}")
@@ -521,62 +952,118 @@ CONFIGS = {
 
 SHEET_MAP = {'底座': 1, '工作台': 2, '橫樑': 3, '立柱': 4, '定樑': 7}
 
-_PART_DETAILS_CACHE = {}
+# 半品和成品的欄位映射
+SEMI_FINISHED_FIELDS = {
+    '底座': ['素材', 'M4', 'M3'],
+    '工作台': ['素材', 'W1', 'W2', 'W4'],
+    '橫樑': ['素材', 'M6', 'M5'],
+    '立柱': ['素材', '半品', '成品銑工'],
+    '定樑': ['素材']
+}
 
-def get_part_details(part_type):
-    """載入特定鑄件的詳細製程資料 (顯示所有原始機型名稱)"""
-    try:
-        casting_file = current_app.config['CASTING_FILE']
-        sheet_idx = SHEET_MAP.get(part_type)
-        if sheet_idx is None: return {"headers": [], "rows": []}
+FINISHED_FIELDS = {
+    '底座': ['成品研磨'],
+    '工作台': ['成品'],
+    '橫樑': ['成品研磨'],
+    '立柱': ['成品研磨'],
+    '定樑': ['成品']
+}
 
-        mtime = os.path.getmtime(casting_file)
-        if part_type in _PART_DETAILS_CACHE:
-            cached = _PART_DETAILS_CACHE[part_type]
-            if cached['mtime'] == mtime:
-                return cached['data']
+def _build_part_details(part_type):
+    """整理特定鑄件分頁的製程資料 (顯示所有原始機型名稱)"""
+    sheet_idx = SHEET_MAP[part_type]
+    snapshot = get_casting_snapshot()
+    return snapshot.derived(sheet_idx, 'part_details',
+                            lambda df: _part_details_from_rows(part_type, snapshot.rows(sheet_idx)))
 
-        config = CONFIGS.get(part_type, [])
-        headers = ['品號', '機型'] + [c[0] for c in config]
-        
-        df = pd.read_excel(casting_file, sheet_name=sheet_idx)
-        
-        # 建立現有數據索引
-        existing_rows = []
-        for _, row in df.iterrows():
-            if pd.isna(row.iloc[0]) and pd.isna(row.iloc[1]): 
-                continue
-            existing_rows.append(row)
-
-        def to_int(val):
-            try: 
-                return int(float(val)) if pd.notna(val) else 0
-            except: 
-                return 0
-                
-        rows = []
-        for row in existing_rows:
-            model_name = str(row.iloc[1]).strip()
-            if model_name in ['nan', 'N/A', 'None']:
-                model_name = ''
-            part_number = str(row.iloc[0]).strip()
-            
-            # 處理浮點數被轉成字串的 .0 尾巴 (例如 "12345.0" -> "12345")
-            if part_number.endswith('.0'):
-                part_number = part_number[:-2]
+
+def _part_details_from_rows(part_type, sheet_rows):
+    config = CONFIGS.get(part_type, [])
+    headers = ['品號', '機型'] + [c[0] for c in config]
+    
+    # 建立現有數據索引
+    existing_rows = []
+    for row in sheet_rows:
+        if pd.isna(row[0]) and pd.isna(row[1]): 
+            continue
+        existing_rows.append(row)
+
+    def to_int(val):
+        try: 
+            return int(float(val)) if pd.notna(val) else 0
+        except: 
+            return 0
             
-            # 若品號為空、nan 或 N/A，改回空字串，但不跳過該機型
-            if part_number in ['nan', 'N/A', 'None']:
-                part_number = ''
-                
-            data_row = {'機型': model_name, '品號': part_number}
-            for label, idx in config:
-                data_row[label] = to_int(row.iloc[idx])
-            rows.append(data_row)
+    rows = []
+    for row in existing_rows:
+        model_name = str(row[1]).strip()
+        if model_name in ['nan', 'N/A', 'None']:
+            model_name = ''
+        part_number = str(row[0]).strip()
+        
+        # 處理浮點數被轉成字串的 .0 尾巴 (例如 "12345.0" -> "12345")
+        if part_number.endswith('.0'):
+            part_number = part_number[:-2]
+        
+        # 若品號為空、nan 或 N/A，改回空字串，但不跳過該機型
+        if part_number in ['nan', 'N/A', 'None']:
+            part_number = ''
             
-        result = {"headers": headers, "rows": rows}
-        _PART_DETAILS_CACHE[part_type] = {'mtime': mtime, 'data': result}
-        return result
+        data_row = {'機型': model_name, '品號': part_number}
+        for label, idx in config:
+            data_row[label] = to_int(row[idx])
+        rows.append(data_row)
+        
+    return {"headers": headers, "rows": rows}
+
+
+def _changed_detail_rows(part_type, change):
+    """修改的列整理後的明細 [(列位置, 明細列或 None)]（品號與機型皆空的列不列入明細）"""
+    sheet_idx = SHEET_MAP[part_type]
+    df = change.after.sheet(sheet_idx)
+    result = []
+    for pos in change.rows.get(sheet_idx, ()):
+        rows = _part_details_from_rows(part_type, df.iloc[[pos]].itertuples(index=False, name=None))['rows']
+        result.append((pos, rows[0] if rows else None))
+    return result
+
+def changed_part_numbers(change):
+    """分頁變更涉及的品號（與零件明細相同的整理方式）"""
+    return {row['品號'] for part_type in SHEET_MAP for _, row in _changed_detail_rows(part_type, change)
+            if row is not None and row['品號']}
+
+def _part_details_delta(part_type, data, change):
+    """寫入後的增量更新：只替換修改的列，新增的列加在最後"""
+    sheet_idx = SHEET_MAP[part_type]
+    if not change.rows.get(sheet_idx):
+        return data
+    before = change.before.sheet(sheet_idx)
+    kept = (before.iloc[:, 0].notna() | before.iloc[:, 1].notna()).to_numpy()
+    offsets = np.cumsum(kept) - 1  # 列位置 -> 明細中的位置
+    rows = list(data['rows'])
+    for pos, row in _changed_detail_rows(part_type, change):
+        if pos >= len(before):
+            if row is not None:
+                rows.append(row)
+        elif kept[pos] and row is not None:
+            rows[offsets[pos]] = row
+        elif kept[pos] or row is not None:
+            return None
+    return {'headers': data['headers'], 'rows': rows}
+
+
+# 每個零件分頁各自一筆快取項目（只存在記憶體），只在自己的分頁變更時失效
+for _part, _sheet_idx in SHEET_MAP.items():
+    registry.register(f'part_details:{_part}', partial(_build_part_details, _part),
+                      inputs=[FilePartInput(casting_file_path, casting_sheet_key(_sheet_idx))],
+                      delta=partial(_part_details_delta, _part))
+
+
+def get_part_details(part_type):
+    """載入特定鑄件的詳細製程資料 (顯示所有原始機型名稱)"""
+    try:
+        if part_type not in SHEET_MAP: return {"headers": [], "rows": []}
+        return registry.get(f'part_details:{part_type}')
     except Exception as e:
         print(f"Error loading {part_type} details: {e}")
         import traceback
@@ -584,117 +1071,138 @@ def get_part_details(part_type):
         return {"headers": [], "rows": []}
 
 
-def update_cell(part_type, item_id, field, new_value, user_id, model_name=None):
-    """更新 Excel 儲存格並記錄歷程 (支援依機型更新及自動新增列)"""
+def update_cells(part_type, rows, user_id):
+    """批次更新儲存格：以同一份內容找列、單一交易寫入日誌、一次寫入歷程
+
+    修改寫入日誌後即回應（讀取端立即看到新值），由背景寫入執行緒合併寫回 Excel。
+    每列的所有欄位一起成功或失敗；失敗的列不影響其他列。
+
+    Args:
+        rows: [{'item_id': 品號, 'model_name': 機型, 'updates': {欄位: 新值}}, ...]
+
+    Returns:
+        dict: {'success': 是否全部成功, 'results': [每列結果, ...]}
+              每列結果含 success、item_id（實際品號）、model_name、total、
+              changes [{'field', 'old_value', 'new_value', 'total'}, ...] 或 error
+    """
     try:
         casting_file = current_app.config['CASTING_FILE']
         sheet_idx = SHEET_MAP.get(part_type)
         config = CONFIGS.get(part_type, [])
         
         if sheet_idx is None:
-            return {'success': False, 'error': '無效的鑄件類型'}
-        
-        # 找出欄位索引
-        col_idx = None
-        for label, idx in config:
-            if label == field:
-                col_idx = idx
-                break
-        
-        if col_idx is None:
-            return {'success': False, 'error': f'無效的欄位: {field}'}
-        
-        # 使用 openpyxl 開啟並修改
-        wb = load_workbook(casting_file)
-        ws = wb.worksheets[sheet_idx]
-        
-        # 找出對應行
-        target_row = None
-        old_value = None
-        
-        # 方式1: 依品號搜尋 (僅當 item_id 不是 'N/A' 時)
-        if item_id and item_id != 'N/A':
-            for row_num in range(2, ws.max_row + 1):
-                cell_value = str(ws.cell(row=row_num, column=1).value).strip()
-                if cell_value.endswith('.0'): cell_value = cell_value[:-2]
-                
-                check_id = str(item_id).strip()
-                if check_id.endswith('.0'): check_id = check_id[:-2]
-                
-                if cell_value == check_id:
-                    target_row = row_num
-                    break
-        
-        
-        # 方式2: 依機型搜尋 (如果 item_id 找不到或為 'N/A')
-        if target_row is None and model_name:
-            for row_num in range(2, ws.max_row + 1):
-                model_cell_value = ws.cell(row=row_num, column=2).value
-                if model_cell_value and str(model_cell_value).strip() == str(model_name).strip():
-                    target_row = row_num
-                    # 同時更新 item_id 以便後續記錄
-                    item_id = ws.cell(row=row_num, column=1).value or 'N/A'
-                    break
-        
-        # 如果還是找不到，且有機型名稱，則新增一行
-        if target_row is None and model_name:
-            target_row = ws.max_row + 1
-            ws.cell(row=target_row, column=1, value='N/A')  # 新增列品號設為 N/A
-            ws.cell(row=target_row, column=2, value=model_name)
-            item_id = 'N/A'
-            print(f"[INFO] Appended new row for model: {model_name}")
-        
-        if target_row is None:
-            return {'success': False, 'error': '找不到對應的品號或機型'}
-        
-        # 取得舊值
-        old_value = ws.cell(row=target_row, column=col_idx + 1).value
-        
-        # 更新儲存格 (openpyxl column is 1-indexed)
-        ws.cell(row=target_row, column=col_idx + 1, value=new_value)
-        
-        # 計算並更新總數 (不含總數欄本身)
-        total = 0
-        for label, idx in config:
-            if label != '總數':
-                cell_val = ws.cell(row=target_row, column=idx + 1).value
-                total += int(cell_val) if cell_val else 0
-        
-        # 找出總數欄索引
-        total_col_idx = None
-        for label, idx in config:
-            if label == '總數':
-                total_col_idx = idx
-                break
-        
-        if total_col_idx is not None:
-            ws.cell(row=target_row, column=total_col_idx + 1, value=total)
-        
-        wb.save(casting_file)
-        wb.close()
-        
-        # 記錄歷程
-        log_edit(part_type, str(item_id) if item_id else model_name, field, old_value, new_value, user_id, model_name=model_name)
-        
-        return {'success': True, 'old_value': old_value, 'total': total, 'item_id': item_id}
+            return {'success': False, 'error': '無效的鑄件類型', 'results': []}
+        columns = dict(config)
+
+        results = []
+        journal_items = []
+
+        def stage():
+            # 找列、取舊值、寫入日誌在寫入執行緒上一起完成，後一筆修改才會看到前一筆
+            # 以目前內容（檔案 + 尚未寫回的修改）找出對應行、舊值與總數
+            snapshot = get_casting_snapshot(fresh=True)
+            df = snapshot.sheet(sheet_idx)
+            index = sheet_row_index(snapshot, sheet_idx).fork()
+            row_values = {}  # 列位置 -> {欄位索引: 本批次套用後的值}
+
+            for row in rows:
+                item_id = row.get('item_id')
+                model_name = row.get('model_name')
+                updates = row.get('updates') or {}
+                result = {'success': False, 'item_id': item_id, 'model_name': model_name}
+                results.append(result)
+
+                # 找出欄位索引
+                invalid = [field for field in updates if field not in columns]
+                if invalid:
+                    result['error'] = f'無效的欄位: {invalid[0]}'
+                    continue
+
+                pos, found_item_id = index.locate(item_id, model_name)
+                if pos is None and not model_name:
+                    result['error'] = '找不到對應的品號或機型'
+                    continue
+
+                if pos is None:
+                    values = {}
+                    found_item_id = 'N/A'
+                else:
+                    values = row_values.get(pos)
+                    if values is None:
+                        values = {idx: _plain_value(df.iat[pos, idx]) for idx in columns.values() if idx < df.shape[1]}
+                    values = dict(values)
+
+                try:
+                    changes = []
+                    for field, new_value in updates.items():
+                        col_idx = columns[field]
+                        old_value = values.get(col_idx)
+                        values[col_idx] = new_value
+                        changes.append({'field': field, 'old_value': old_value, 'new_value': new_value,
+                                        'total': _row_total(config, values.get)})
+                except Exception as e:
+                    result['error'] = str(e)
+                    continue
+
+                if pos is None:
+                    # 如果還是找不到，且有機型名稱，則新增一行（本批次後續的列也找得到）
+                    pos = index.append('N/A', model_name)
+                    print(f"[INFO] Appended new row for model: {model_name}")
+                row_values[pos] = values
+
+                # 日誌保存原始的品號/機型，寫回時以相同規則找列
+                for change in changes:
+                    journal_items.append((part_type, {
+                        'item_id': item_id, 'model_name': model_name, 'field': change['field'],
+                        'value': change['new_value'], 'user_id': user_id
+                    }))
+                result.update(success=True, item_id=found_item_id, changes=changes,
+                              total=changes[-1]['total'] if changes else _row_total(config, values.get))
+
+            if journal_items:
+                _record_cell_edits(casting_file, journal_items)
+
+        _casting_queue().call(stage)
+
+        # 記錄歷程（一次寫入）
+        log_edits([
+            {'part_type': part_type, 'item_id': str(r['item_id']) if r['item_id'] else r['model_name'],
+             'field': c['field'], 'old_value': c['old_value'], 'new_value': c['new_value'], 'model_name': r['model_name']}
+            for r in results if r['success'] for c in r['changes']
+        ], user_id)
+
+        return {'success': all(r['success'] for r in results), 'results': results}
     
+    except WriteQueueFull:
+        raise
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return {'success': False, 'error': str(e)}
+        return {'success': False, 'error': str(e), 'results': []}
 
-def log_edit(part_type, item_id, field, old_value, new_value, user_id, note=None, model_name=None):
-    """記錄編輯歷程"""
+
+def update_cell(part_type, item_id, field, new_value, user_id, model_name=None):
+    """更新 Excel 儲存格並記錄歷程 (支援依機型更新及自動新增列)"""
+    result = update_cells(part_type, [{'item_id': item_id, 'model_name': model_name, 'updates': {field: new_value}}], user_id)
+    if not result['results']:
+        return {'success': False, 'error': result.get('error')}
+    row = result['results'][0]
+    if not row['success']:
+        return {'success': False, 'error': row['error']}
+    change = row['changes'][0]
+    return {'success': True, 'old_value': change['old_value'], 'total': change['total'], 'item_id': row['item_id']}
+
+
+def log_edits(edits, user_id, transaction=None):
+    """一次記錄多筆編輯歷程（依發生順序傳入，最新的排在最前面）
+
+    Args:
+        edits: [{'part_type', 'item_id', 'field', 'old_value', 'new_value', 'note'?, 'model_name'?}, ...]
+        transaction: 交易編號；同一筆多零件出入庫的各筆歷程記錄相同的 transaction，可歸為一組
+    """
+    if not edits:
+        return
     try:
-        log_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'logs')
-        os.makedirs(log_dir, exist_ok=True)
-        log_file = os.path.join(log_dir, 'edit_history.json')
-        
-        history = []
-        if os.path.exists(log_file):
-            with open(log_file, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-        
         from .user import User
         name_map = User.get_name_map()
         user_display = name_map.get(user_id)
@@ -705,44 +1213,42 @@ def log_edit(part_type, item_id, field, old_value, new_value, user_id, note=None
             else:
                 user_display = user_id
 
-        entry = {
-            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'user': user_display,
-            'part': part_type,
-            'item_id': item_id,
-            'model_name': model_name, # 新增
-            'field': field,
-            'old_value': old_value,
-            'new_value': new_value
-        }
-        
-        if note:
-            entry['note'] = note
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        entries = []
+        for edit in edits:
+            entry = {
+                'timestamp': timestamp,
+                'user': user_display,
+                'part': edit['part_type'],
+                'item_id': edit['item_id'],
+                'model_name': edit.get('model_name') or _history_model_name(edit['part_type'], edit['item_id']),
+                'field': edit['field'],
+                'old_value': edit['old_value'],
+                'new_value': edit['new_value']
+            }
             
-        history.insert(0, entry)
-        
-        # 只保留最近 500 筆
-        history = history[:500]
-        
-        with open(log_file, 'w', encoding='utf-8') as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
+            if edit.get('note'):
+                entry['note'] = edit['note']
+            if transaction:
+                entry['transaction'] = transaction
+            entries.append(entry)
+
+        # 只附加新的歷程（不重寫既有紀錄，也不刪除舊紀錄）
+        _edit_history().append_many(entries)
     
     except Exception as e:
         print(f"Error logging edit: {e}")
 
+def log_edit(part_type, item_id, field, old_value, new_value, user_id, note=None, model_name=None):
+    """記錄編輯歷程"""
+    log_edits([{'part_type': part_type, 'item_id': item_id, 'field': field, 'old_value': old_value,
+                'new_value': new_value, 'note': note, 'model_name': model_name}], user_id)
+
 def get_edit_history(part_type, limit=50):
     """取得特定鑄件的修改歷程"""
     try:
-        log_file = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'logs', 'edit_history.json')
-        
-        if not os.path.exists(log_file):
-            return []
-        
-        with open(log_file, 'r', encoding='utf-8') as f:
-            history = json.load(f)
-        
-        # 過濾該鑄件的歷程
-        filtered = [h for h in history if h.get('part') == part_type]
+        # 該鑄件的歷程（依零件索引查詢）
+        filtered = _edit_history().query(part=part_type, limit=limit)
         
         # 轉換使用者名稱為中文名
         from .user import User
@@ -750,29 +1256,10 @@ def get_edit_history(part_type, limit=50):
         for h in filtered:
             if h.get('user') in name_map:
                 h['user'] = name_map[h['user']]
-        # 建立品號與機型對照表，用於回補舊有紀錄
-        _ITEM_MODEL_MAP = {}
-        try:
-            casting_file = current_app.config['CASTING_FILE']
-            xl = pd.ExcelFile(casting_file, engine='openpyxl')
-            sheet_idx = SHEET_MAP.get(part_type)
-            if sheet_idx is not None:
-                df = pd.read_excel(xl, sheet_name=sheet_idx)
-                for _, row in df.iterrows():
-                    p_id = str(row.iloc[0]).strip()
-                    model = str(row.iloc[1]).strip()
-                    if p_id and p_id != 'nan' and p_id != '品號' and model and model != 'nan':
-                        if p_id.endswith('.0'): p_id = p_id[:-2]
-                        _ITEM_MODEL_MAP[p_id] = model
-        except Exception as ex:
-            print(f"Error building model map in get_edit_history: {ex}")
-
-        # 回補機型資訊
+        # 機型已在記錄時（舊紀錄在遷移時）寫入歷程；查不到機型的以品號顯示
         for h in filtered:
             if not h.get('model_name'):
-                item_id = str(h.get('item_id', '')).strip()
-                if item_id.endswith('.0'): item_id = item_id[:-2]
-                h['model_name'] = _ITEM_MODEL_MAP.get(item_id, item_id)
+                h['model_name'] = _normalize_item_key(h.get('item_id'))
 
         return filtered[:limit]
     
@@ -783,16 +1270,8 @@ def get_edit_history(part_type, limit=50):
 def get_item_history(part_type, item_id, limit=100):
     """取得特定品號的完整修改歷程"""
     try:
-        log_file = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'logs', 'edit_history.json')
-        
-        if not os.path.exists(log_file):
-            return []
-        
-        with open(log_file, 'r', encoding='utf-8') as f:
-            history = json.load(f)
-        
-        # 過濾該品號的歷程
-        filtered = [h for h in history if h.get('part') == part_type and str(h.get('item_id')) == str(item_id)]
+        # 該品號的歷程（依品號索引查詢）
+        filtered = _edit_history().query(part=part_type, item_id=item_id, limit=limit)
         
         # 轉換使用者名稱為中文名
         from .user import User
@@ -800,30 +1279,9 @@ def get_item_history(part_type, item_id, limit=100):
         for h in filtered:
             if h.get('user') in name_map:
                 h['user'] = name_map[h['user']]
-        # 取得機型名稱備回補
-        target_model = ""
-        try:
-            casting_file = current_app.config['CASTING_FILE']
-            xl = pd.ExcelFile(casting_file, engine='openpyxl')
-            sheet_idx = SHEET_MAP.get(part_type)
-            if sheet_idx is not None:
-                df = pd.read_excel(xl, sheet_name=sheet_idx)
-                for _, row in df.iterrows():
-                    p_id = str(row.iloc[0]).strip()
-                    if p_id.endswith('.0'): p_id = p_id[:-2]
-                    check_id = str(item_id).strip()
-                    if check_id.endswith('.0'): check_id = check_id[:-2]
-                    
-                    if p_id == check_id:
-                        target_model = str(row.iloc[1]).strip()
-                        break
-        except:
-            pass
-
+        # 機型已寫入歷程，查不到機型的以品號顯示
         for h in filtered:
-                item_id_norm = str(h.get('item_id', '')).strip()
-                if item_id_norm.endswith('.0'): item_id_norm = item_id_norm[:-2]
-                h['model_name'] = target_model or h.get('item_id', '')
+            h['model_name'] = h.get('model_name') or h.get('item_id', '')
 
         return filtered[:limit]
     
@@ -834,20 +1292,9 @@ def get_item_history(part_type, item_id, limit=100):
 def get_history_stats(part_type):
     """取得歷程統計資訊"""
     try:
-        log_file = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'logs', 'edit_history.json')
-        
-        if not os.path.exists(log_file):
-            return {'total_edits': 0, 'unique_items': 0, 'recent_activity': []}
-        
-        with open(log_file, 'r', encoding='utf-8') as f:
-            history = json.load(f)
-        
-        # 過濾該鑄件的歷程
-        filtered = [h for h in history if h.get('part') == part_type]
-        
-        # 統計資訊
-        unique_items = set(h.get('item_id') for h in filtered)
-        unique_users = set(h.get('user') for h in filtered)
+        history = _edit_history()
+        # 統計資訊（寫入時增量維護的計數）
+        stats = history.stats(part_type, days=7)
         
         # 最近活動（最近7天）
         from datetime import datetime, timedelta
@@ -855,7 +1302,7 @@ def get_history_stats(part_type):
         week_ago = now - timedelta(days=7)
         
         recent = []
-        for h in filtered[:20]:  # 最近20筆
+        for h in history.query(part=part_type, limit=20):  # 最近20筆
             try:
                 ts = datetime.strptime(h.get('timestamp', ''), '%Y-%m-%d %H:%M:%S')
                 if ts >= week_ago:
@@ -864,9 +1311,10 @@ def get_history_stats(part_type):
                 pass
         
         return {
-            'total_edits': len(filtered),
-            'unique_items': len(unique_items),
-            'unique_users': len(unique_users),
+            'total_edits': stats['total_edits'],
+            'unique_items': stats['unique_items'],
+            'unique_users': stats['unique_users'],
+            'edits_last_7_days': stats['recent_edits'],
             'recent_activity': recent
         }
     
@@ -875,7 +1323,15 @@ def get_history_stats(part_type):
         return {'total_edits': 0, 'unique_items': 0, 'recent_activity': []}
 
 
-def get_stock_history(operation_type=None, part_type=None, date_from=None, date_to=None, keyword=None, limit=200):
+def _date_bound(text, end=False):
+    """YYYY-MM-DD 轉為 timestamp 的比較邊界（當日 00:00:00 / 23:59:59）；格式錯誤時不篩選"""
+    try:
+        day = datetime.strptime(text, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+    return day.strftime('%Y-%m-%d 23:59:59' if end else '%Y-%m-%d 00:00:00')
+
+def get_stock_history(operation_type=None, part_type=None, date_from=None, date_to=None, keyword=None, limit=200, cursor=None):
     """查詢入庫/出庫歷史記錄
     
     Args:
@@ -884,86 +1340,24 @@ def get_stock_history(operation_type=None, part_type=None, date_from=None, date_
         date_from: 開始日期 (YYYY-MM-DD)
         date_to: 結束日期 (YYYY-MM-DD)
         keyword: 關鍵字搜尋 (品號、備註等)
-        limit: 最大回傳筆數
+        limit: 每頁筆數
+        cursor: 上一頁回傳的 next_cursor，取下一頁（統計 stats 只在第一頁回傳，後續頁為 None）
     """
     try:
-        log_file = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'logs', 'edit_history.json')
-        
-        if not os.path.exists(log_file):
-            return {'records': [], 'stats': {'total': 0, 'stock_in': 0, 'stock_out': 0}}
-        
-        with open(log_file, 'r', encoding='utf-8') as f:
-            history = json.load(f)
+        # 篩選與分頁在歷程索引上完成，只轉換本頁的紀錄
+        history, next_cursor, stats = _edit_history().stock_query(
+            operation=operation_type, part=part_type, date_from=date_from and _date_bound(date_from),
+            date_to=date_to and _date_bound(date_to, end=True), keyword=keyword, cursor=cursor, limit=limit)
         
         records = []
-        stats = {'total': 0, 'stock_in': 0, 'stock_out': 0}
         
-
-        # 加裝機型查找表
-        _ITEM_MODEL_MAP = {}
-        try:
-            casting_file = current_app.config['CASTING_FILE']
-            import pandas as pd
-            xl = pd.ExcelFile(casting_file, engine='openpyxl')
-            for part_name, sheet_idx in [('底座', 1), ('工作台', 2), ('橫樑', 3), ('立柱', 4)]:
-                df = pd.read_excel(xl, sheet_name=sheet_idx)
-                for _, row in df.iterrows():
-                    p_id = str(row.iloc[0]).strip()
-                    model = str(row.iloc[1]).strip()
-                    if p_id and p_id != 'nan' and p_id != '品號' and model and model != 'nan':
-                        if p_id.endswith('.0'): p_id = p_id[:-2]
-                        _ITEM_MODEL_MAP[p_id] = model
-        except Exception as ex:
-            print(f"Error building model map: {ex}")
-
         for h in history:
             field = h.get('field', '')
             note_text = h.get('note', '')
             
             # 判斷是否為入庫或出庫記錄
             is_stock_in = '入庫' in field
-            is_stock_out = '出庫' in field
-            
-            if not is_stock_in and not is_stock_out:
-                continue
-            
-            # 過濾操作類型
-            if operation_type == 'in' and not is_stock_in:
-                continue
-            if operation_type == 'out' and not is_stock_out:
-                continue
-            
-            # 過濾零件類型
-            if part_type and h.get('part') != part_type:
-                continue
-            
-            # 過濾日期範圍
-            if date_from or date_to:
-                try:
-                    ts = datetime.strptime(h.get('timestamp', ''), '%Y-%m-%d %H:%M:%S')
-                    if date_from:
-                        from_dt = datetime.strptime(date_from, '%Y-%m-%d')
-                        if ts < from_dt:
-                            continue
-                    if date_to:
-                        to_dt = datetime.strptime(date_to, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
-                        if ts > to_dt:
-                            continue
-                except:
-                    pass
-            
-            # 關鍵字搜尋 (品號、備註、field)
-            if keyword:
-                kw = keyword.lower()
-                searchable = ' '.join([
-                    str(h.get('item_id', '')),
-                    str(h.get('note', '')),
-                    str(h.get('field', '')),
-                    str(h.get('user', '')),
-                    str(h.get('part', ''))
-                ]).lower()
-                if kw not in searchable:
-                    continue
+            is_stock_out = not is_stock_in
             
             # 解析工單編碼 (從 note 或 field 中解析)
             order_code = ''
@@ -984,7 +1378,7 @@ def get_stock_history(operation_type=None, part_type=None, date_from=None, date_
                 'user': h.get('user', ''),
                 'part': h.get('part', ''),
                 'item_id': h.get('item_id', ''),
-                'model': _ITEM_MODEL_MAP.get(str(h.get('item_id', '')).replace('.0', '').strip(), h.get('model_name', '')),
+                'model': h.get('model_name') or '',
                 'field': field,
                 'old_value': h.get('old_value', 0),
                 'new_value': h.get('new_value', 0),
@@ -1034,335 +1428,451 @@ def get_stock_history(operation_type=None, part_type=None, date_from=None, date_
                 record['order_code'] = parsed_wo
             
             records.append(record)
-            
-            # 更新統計
-            if is_stock_in:
-                stats['stock_in'] += 1
-            if is_stock_out:
-                stats['stock_out'] += 1
-        
-        stats['total'] = len(records)
         
         return {
-            'records': records[:limit],
-            'stats': stats
+            'records': records,
+            'stats': stats,
+            'next_cursor': next_cursor
         }
     
     except Exception as e:
         print(f"Error getting stock history: {e}")
         import traceback
         traceback.print_exc()
-        return {'records': [], 'stats': {'total': 0, 'stock_in': 0, 'stock_out': 0}}
+        return {'records': [], 'stats': {'total': 0, 'stock_in': 0, 'stock_out': 0}, 'next_cursor': None}
+
 
 
+def _find_part_no(index, part_no):
+    """出入庫依品號找列（N/A 與空值視為沒有品號）"""
+    if not part_no or part_no in ('nan', 'N/A', 'None') or _clean_item_id(part_no) != part_no:
+        return None
+    return index.find_item(part_no)
 
-def stock_in_material(part_name, quantity, model=None, supplier=None, user=None, work_order_code=None, barcode=None, purchase_order=None):
+def _valid_model_rows(df):
+    """機型欄有效（非空白、非重複表頭「品號」）的列位置"""
+    if '機型' not in df.columns:
+        return []
+    models = df['機型']
+    model_str = models.astype(str).str.strip()
+    return np.flatnonzero((models.notna() & (model_str != '') & (model_str != '品號')).to_numpy()).tolist()
+
+def _edit_key(item_id, model_name):
+    item_id = _clean_item_id(_plain_value(item_id))
+    model_name = _plain_value(model_name)
+    if item_id in ('', 'nan', 'N/A', 'None'):
+        item_id = 'N/A'
+    return item_id, str(model_name).strip() if model_name is not None else None
+
+def _row_edit_key(df, pos):
+    """日誌用的品號/機型：寫回時依相同規則找回同一列（另記列位置，見 locate_row）"""
+    return _edit_key(df.iat[pos, 0], df.iat[pos, 1] if df.shape[1] > 1 else None)
+
+def _stock_lines(quantity, lines, **defaults):
+    """出入庫明細：未傳 lines 時為單筆；各筆未指定的欄位沿用呼叫參數"""
+    if not lines:
+        lines = [{'model': defaults.get('model'), 'quantity': quantity}]
+    return [dict(defaults, **{k: v for k, v in line.items() if v is not None and k != 'quantity'},
+                 quantity=int(line.get('quantity') or 0)) for line in lines]
+
+def _stage_stock_transaction(steps, user_id):
+    """以同一份目前內容規劃多個零件 / 欄位的出入庫並一起寫入日誌（與 update_cell 相同路徑，只修改該欄與總數）
+
+    所有步驟在寫入執行緒上以同一個快照規劃，任一步驟失敗時不寫入任何修改；
+    全部成功時以一批日誌寫入（一次寫回、一次快取增量更新）。
+
+    Args:
+        steps: [(零件名稱, 欄位索引, plan), ...]；plan(df, index, value_at, set_value) -> 結果 dict，回傳 error 表示失敗
+
+    Returns:
+        list: 各步驟 plan 的結果（失敗時到失敗的步驟為止）
+    """
+    casting_file = current_app.config['CASTING_FILE']
+
+    def stage():
+        # 與 update_cells 相同：規劃與寫入日誌在寫入執行緒上一起完成
+        snapshot = get_casting_snapshot(fresh=True)
+        staged = {}  # (零件, 欄位索引) -> {列位置: 本次套用後的值}（同一列多筆明細依序累計）
+        results = []
+        for part_name, col_idx, plan in steps:
+            sheet_idx = SHEET_MAP[part_name]
+            df = snapshot.sheet(sheet_idx)
+            cells = staged.setdefault((part_name, col_idx), {})
+
+            def value_at(pos, df=df, col_idx=col_idx, cells=cells):
+                if pos in cells:
+                    return cells[pos]
+                val = df.iat[pos, col_idx] if col_idx < df.shape[1] else None
+                return int(float(val)) if pd.notna(val) else 0
+
+            def set_value(pos, value, cells=cells):
+                cells[pos] = value
+
+            result = plan(df, sheet_row_index(snapshot, sheet_idx), value_at, set_value)
+            results.append(result)
+            if result.get('error'):
+                return results
+
+        journal_items = []
+        for (part_name, col_idx), cells in staged.items():
+            df = snapshot.sheet(SHEET_MAP[part_name])
+            field = next(label for label, idx in CONFIGS[part_name] if idx == col_idx)
+            for pos, value in cells.items():
+                item_id, model_name = _row_edit_key(df, pos)
+                journal_items.append((part_name, {'item_id': item_id, 'model_name': model_name, 'row': pos,
+                                                  'field': field, 'value': value, 'user_id': user_id}))
+        if journal_items:
+            _record_cell_edits(casting_file, journal_items)
+        return results
+
+    return _casting_queue().call(stage)
+
+def _stage_stock_movements(part_name, col_idx, plan, user_id):
+    """單一零件、單一欄位的出入庫（_stage_stock_transaction 的單一步驟）
+
+    Returns:
+        dict: plan 的結果
+    """
+    return _stage_stock_transaction([(part_name, col_idx, plan)], user_id)[0]
+
+
+# 可出入庫的零件
+STOCK_PARTS = ('底座', '工作台', '橫樑', '立柱')
+
+def _material_column(part_name):
+    """入庫的素材欄位索引"""
+    for label, idx in CONFIGS.get(part_name, []):
+        if label == '素材':
+            return idx
+    return 2  # 預設值
+
+def _product_column(part_name):
+    """出庫的成品欄位 (索引, 名稱)；沒有成品欄位時索引為 None"""
+    for label, idx in CONFIGS.get(part_name, []):
+        if label in ['成品', '成品研磨']:
+            return idx, label
+    return None, '成品'
+
+def _stock_in_plan(lines):
+    def plan(df, index, value_at, set_value):
+        log_data = []
+        for line in lines:
+            # 根據品號 (model) 更新
+            if line['model']:
+                search_part_no = str(line['model']).strip()
+                idx = _find_part_no(index, search_part_no)
+                if idx is None:
+                    return {'error': f'找不到指定的品號: {line["model"]}'}
+                item_id = search_part_no
+                row_model = df.iat[idx, 1] if df.shape[1] > 1 else ''
+                row_model = str(row_model).strip() if pd.notna(row_model) else ''
+            # 如果沒有指定品號，則使用舊邏輯 (找第一個有效機型)
+            else:
+                valid_rows = _valid_model_rows(df)
+                if not valid_rows:
+                    return {'error': '找不到有效的機型可以入庫'}
+                idx = valid_rows[0]
+                item_id = str(df['機型'].iat[idx]).strip()  # 如果沒有品號，用機型名暫代
+                row_model = None
+
+            old_v = value_at(idx)
+            new_val = old_v + line['quantity']
+            set_value(idx, new_val)
+            log_data.append({'line': line, 'item_id': item_id, 'model_name': row_model,
+                             'old_value': old_v, 'new_value': new_val})
+        return {'log_data': log_data}
+    return plan
+
+def _stock_in_entries(part_name, log_data, supplier):
+    """入庫的履歷"""
+    entries = []
+    for data in log_data:
+        line = data['line']
+        field_name = '素材'
+        if supplier:
+            field_name += f' (入庫: {supplier}'
+            if line['purchase_order']:
+                field_name += f', 採購單 {line["purchase_order"]}'
+            field_name += ')'
+        else:
+            field_name += ' (入庫'
+            if line['purchase_order']:
+                field_name += f': 採購單 {line["purchase_order"]}'
+            field_name += ')'
+
+        note = None
+        note_parts = []
+        if line['work_order_code']:
+            note_parts.append(f"工單編碼: {line['work_order_code']}")
+        if line['barcode']:
+            note_parts.append(f"鑄件編號: {line['barcode']}")
+        if line['purchase_order']:
+            note_parts.append(f"採購單: {line['purchase_order']}")
+        if note_parts:
+            note = ', '.join(note_parts)
+
+        entries.append({'part_type': part_name, 'item_id': data['item_id'], 'field': field_name,
+                        'old_value': data['old_value'], 'new_value': data['new_value'], 'note': note,
+                        'model_name': data['model_name']})
+    return entries
+
+def _stock_out_plan(lines):
+    def plan(df, index, value_at, set_value):
+        log_data = []
+        for line in lines:
+            # 邏輯 A: 指定品號出庫
+            if line['model']:
+                search_part_no = str(line['model']).strip()
+
+                # 尋找目標行
+                target_idx = _find_part_no(index, search_part_no)
+                if target_idx is None:
+                    return {'error': f'找不到指定的品號: {line["model"]}'}
+
+                current_stock = value_at(target_idx)
+                if current_stock < line['quantity']:
+                    return {'error': f'庫存不足！品號 {line["model"]} 當前成品: {current_stock}，需要: {line["quantity"]}'}
+
+                # 執行扣除
+                new_val = current_stock - line['quantity']
+                set_value(target_idx, new_val)
+
+                row_model = df.iat[target_idx, 1] if df.shape[1] > 1 else ''
+
+                log_data.append({
+                    'line': line,
+                    'item_id': search_part_no,
+                    'model_name': str(row_model).strip() if pd.notna(row_model) else '',
+                    'old_value': current_stock,
+                    'new_value': new_val
+                })
+
+            # 邏輯 B: 未指定品號
+            else:
+                # 省略舊邏輯的 log，因為現在都強制選機型了
+                # 如果真的跑進來這裡，我們就只記錄操作成功，數字可能不太精確因為是扣多行
+                # 無法轉為數量的儲存格略過
+                stocks = []
+                for idx in _valid_model_rows(df):
+                    try:
+                        stocks.append((idx, value_at(idx)))
+                    except (TypeError, ValueError):
+                        pass
+
+                # 計算總庫存
+                current_total = sum(qty for _, qty in stocks)
+                if current_total < line['quantity']:
+                    return {'error': f'該零件總成品數量不足！當前: {current_total}，需要: {line["quantity"]}'}
+
+                # 從成品中扣除數量
+                remaining = line['quantity']
+                for idx, _ in stocks:
+                    if remaining <= 0:
+                        break
+                    current_qty = value_at(idx)
+                    if current_qty > 0:
+                        deduct = min(current_qty, remaining)
+                        set_value(idx, current_qty - deduct)
+                        remaining -= deduct
+        return {'log_data': log_data}
+    return plan
+
+def _stock_out_entries(part_name, product_label, log_data, supplier):
+    """出庫的履歷（邏輯 A 有 log_data 時記錄精確值）"""
+    entries = []
+    for data in log_data:
+        line = data['line']
+        field_name = f'{product_label} (出庫: 工單 {line["work_order"]}'
+        if line['purchase_order']:
+            field_name += f', 採購單 {line["purchase_order"]}'
+        field_name += ')'
+
+        # 將鑄造商資訊也存入 note
+        note = f"工單編碼: {line['work_order']}"
+        if supplier:
+            note += f", 鑄造商: {supplier}"
+        if line['purchase_order']:
+            note += f", 採購單: {line['purchase_order']}"
+
+        entries.append({'part_type': part_name, 'item_id': data['item_id'], 'field': field_name,
+                        'old_value': data['old_value'], 'new_value': data['new_value'], 'note': note,
+                        'model_name': data['model_name']})
+    return entries
+
+def _result_lines(log_data):
+    return [{'model': d['line']['model'], 'quantity': d['line']['quantity'],
+             'old_value': d['old_value'], 'new_value': d['new_value']} for d in log_data]
+
+
+def stock_in_material(part_name, quantity, model=None, supplier=None, user=None, work_order_code=None, barcode=None, purchase_order=None, lines=None):
     """
     入庫操作 - 增加素材數量
+
+    lines 為多筆明細 [{'model', 'quantity', 'work_order_code'?, 'barcode'?, 'purchase_order'?}, ...]，
+    全部成功或全部不執行；未傳時以 quantity / model 為單筆。
     """
     try:
-        from flask import current_app, session
-        import pandas as pd
-        
-        # 嘗試在模組內引用 log_edit，如果不行的話可能需要重新組織代碼
-        # 由於 log_edit 就在同一個模組，應該可以直接使用，但因為我們是覆寫，
-        # 需要確保在函數內部能訪問到。
-        # 為了安全起見，如果此函數在 inventory.py 底部，它應該能看到上面的 log_edit
-        
-        casting_file = current_app.config['CASTING_FILE']
-        
-        # 零件對應的工作表索引
-        sheet_mapping = {
-            '底座': 1,
-            '工作台': 2,
-            '橫樑': 3,
-            '立柱': 4
-        }
-        
-        if part_name not in sheet_mapping:
+        from flask import session
+
+        if part_name not in STOCK_PARTS:
             return {'success': False, 'error': f'未知的零件名稱: {part_name}'}
-        
-        sheet_idx = sheet_mapping[part_name]
-        
-        # 動態決定素材欄位索引
-        config = CONFIGS.get(part_name, [])
-        material_col_idx = 2  # 預設值
-        for label, idx in config:
-            if label == '素材':
-                material_col_idx = idx
-                break
-        
-        # 讀取 Excel 檔案
-        xl = pd.ExcelFile(casting_file)
-        df = pd.read_excel(xl, sheet_name=sheet_idx)
-        
-        updated = False
-        log_data = None
-        
-        # 根據品號 (model) 更新
-        if model:
-            search_part_no = str(model).strip()
-            for idx, row in df.iterrows():
-                curr_part_no = str(row.iloc[0]).strip() if pd.notna(row.iloc[0]) else ''
-                if curr_part_no.endswith('.0'):
-                    curr_part_no = curr_part_no[:-2]
-                if curr_part_no in ['nan', 'N/A', 'None']:
-                    curr_part_no = ''
-                
-                # 如果品號匹配
-                if curr_part_no == search_part_no:
-                    current_val = row.iloc[material_col_idx]
-                    old_v = int(float(current_val)) if pd.notna(current_val) else 0
-                    new_val = old_v + quantity
-                    df.at[idx, df.columns[material_col_idx]] = new_val
-                    updated = True
-                    
-                    row_model = row.iloc[1] if len(row) > 1 else ''
-                    
-                    log_data = {
-                        'item_id': curr_part_no,
-                        'model_name': str(row_model).strip() if pd.notna(row_model) else '',
-                        'old_value': old_v,
-                        'new_value': new_val
-                    }
-                    break
-        
-        # 如果沒有指定品號，或找不到品號，則使用舊邏輯 (找第一個有效機型)
-        if not updated and not model:
-            for idx, row in df.iterrows():
-                model_val = row.get('機型', '')
-                if pd.notna(model_val) and str(model_val).strip() and str(model_val).strip() != '品號':
-                    current_val = row.iloc[material_col_idx]
-                    old_v = int(float(current_val)) if pd.notna(current_val) else 0
-                    new_val = old_v + quantity
-                    df.at[idx, df.columns[material_col_idx]] = new_val
-                    updated = True
-
-                    log_data = {
-                        'item_id': str(model_val).strip(), # 如果沒有品號，用機型名暫代
-                        'old_value': old_v,
-                        'new_value': new_val
-                    }
-                    break
-        
-        if not updated:
-            if model:
-                return {'success': False, 'error': f'找不到指定的品號: {model}'}
-            else:
-                return {'success': False, 'error': '找不到有效的機型可以入庫'}
-        
-        # 寫回 Excel
-        with pd.ExcelWriter(casting_file, engine='openpyxl', mode='a', if_sheet_exists='replace') as writer:
-            df.to_excel(writer, sheet_name=xl.sheet_names[sheet_idx], index=False)
-        
-        # 寫入履歷
-        if log_data:
-            user_id = user if user else session.get('user', 'System')
-            field_name = '素材'
-            if supplier:
-                field_name += f' (入庫: {supplier}'
-                if purchase_order:
-                    field_name += f', 採購單 {purchase_order}'
-                field_name += ')'
-            else:
-                field_name += ' (入庫'
-                if purchase_order:
-                    field_name += f': 採購單 {purchase_order}'
-                field_name += ')'
-                
-            note = None
-            note_parts = []
-            if work_order_code:
-                note_parts.append(f"工單編碼: {work_order_code}")
-            if barcode:
-                note_parts.append(f"鑄件編號: {barcode}")
-            if purchase_order:
-                note_parts.append(f"採購單: {purchase_order}")
-            if note_parts:
-                note = ', '.join(note_parts)
-                
-            try:
-                log_edit(part_name, log_data['item_id'], field_name, 
-                         log_data['old_value'], log_data['new_value'], user_id, note,
-                         model_name=log_data.get('model_name'))
-            except Exception as e:
-                print(f"Failed to log edit: {e}")
 
-        msg = f'{part_name} 入庫成功，已增加 {quantity} 件到素材'
-        if model:
-            msg += f' (品號: {model})'
+        lines = _stock_lines(quantity, lines, model=model, work_order_code=work_order_code,
+                             barcode=barcode, purchase_order=purchase_order)
+        user_id = user if user else session.get('user', 'System')
+
+        staged = _stage_stock_movements(part_name, _material_column(part_name), _stock_in_plan(lines), user_id)
+        if staged.get('error'):
+            return {'success': False, 'error': staged['error']}
+
+        # 寫入履歷（一次寫入）
+        try:
+            log_edits(_stock_in_entries(part_name, staged['log_data'], supplier), user_id)
+        except Exception as e:
+            print(f"Failed to log edit: {e}")
+
+        total_qty = sum(line['quantity'] for line in lines)
+        msg = f'{part_name} 入庫成功，已增加 {total_qty} 件到素材'
+        part_nos = [str(line['model']).strip() for line in lines if line['model']]
+        if part_nos:
+            msg += f' (品號: {", ".join(part_nos)})'
         if supplier:
             msg += f'，供應商: {supplier}'
-            
+
         return {
             'success': True,
             'message': msg,
-            'quantity': quantity
+            'quantity': total_qty,
+            'lines': _result_lines(staged['log_data'])
         }
-        
+
+    except WriteQueueFull:
+        raise
     except Exception as e:
         return {'success': False, 'error': str(e)}
 
 
-def stock_out_product(part_name, work_order, quantity, model=None, purchase_order=None, supplier=None, user=None):
+def stock_out_product(part_name, work_order, quantity, model=None, purchase_order=None, supplier=None, user=None, lines=None):
     """
     出庫操作 - 扣除成品數量
+
+    lines 為多筆明細 [{'model', 'quantity', 'work_order'?, 'purchase_order'?}, ...]，
+    任一筆庫存不足時全部不執行；未傳時以 quantity / model 為單筆。
     """
     try:
-        from flask import current_app, session
-        import pandas as pd
-        
-        casting_file = current_app.config['CASTING_FILE']
-        
-        sheet_mapping = {
-            '底座': 1,
-            '工作台': 2,
-            '橫樑': 3,
-            '立柱': 4
-        }
-        
-        if part_name not in sheet_mapping:
+        from flask import session
+
+        if part_name not in STOCK_PARTS:
             return {'success': False, 'error': f'未知的零件名稱: {part_name}'}
-        
-        sheet_idx = sheet_mapping[part_name]
-        
-        # 動態決定成品欄位索引
-        config = CONFIGS.get(part_name, [])
-        product_col_idx = None
-        product_label = '成品'
-        for label, idx in config:
-            if label in ['成品', '成品研磨']:
-                product_col_idx = idx
-                product_label = label
-                break
-        
+
+        product_col_idx, product_label = _product_column(part_name)
         if product_col_idx is None:
             return {'success': False, 'error': f'找不到 {part_name} 的成品欄位'}
 
-        xl = pd.ExcelFile(casting_file)
-        df = pd.read_excel(xl, sheet_name=sheet_idx)
-        
-        updated = False
-        log_data = None
-        
-        # 邏輯 A: 指定品號出庫
-        if model:
-            search_part_no = str(model).strip()
-            target_idx = -1
-            
-            # 尋找目標行
-            for idx, row in df.iterrows():
-                curr_part_no = str(row.iloc[0]).strip() if pd.notna(row.iloc[0]) else ''
-                if curr_part_no.endswith('.0'):
-                    curr_part_no = curr_part_no[:-2]
-                if curr_part_no in ['nan', 'N/A', 'None']:
-                    curr_part_no = ''
-                if curr_part_no == search_part_no:
-                    target_idx = idx
-                    val = row.iloc[product_col_idx]
-                    current_stock = int(float(val)) if pd.notna(val) else 0
-                    break
-            
-            if target_idx == -1:
-                return {'success': False, 'error': f'找不到指定的品號: {model}'}
-            
-            if current_stock < quantity:
-                return {'success': False, 'error': f'庫存不足！品號 {model} 當前成品: {current_stock}，需要: {quantity}'}
-            
-            # 執行扣除
-            new_val = current_stock - quantity
-            df.at[target_idx, df.columns[product_col_idx]] = new_val
-            updated = True
-            
-            row_model = df.iloc[target_idx, 1] if df.shape[1] > 1 else ''
-            
-            log_data = {
-                'item_id': search_part_no,
-                'model_name': str(row_model).strip() if pd.notna(row_model) else '',
-                'old_value': current_stock,
-                'new_value': new_val
-            }
-            
-        # 邏輯 B: 未指定品號
-        else:
-            # 省略舊邏輯的 log，因為現在都強制選機型了
-            # 如果真的跑進來這裡，我們就只記錄操作成功，數字可能不太精確因為是扣多行
-            
-            # 計算總庫存
-            current_total = 0
-            for _, row in df.iterrows():
-                m_val = row.get('機型', '')
-                if pd.notna(m_val) and str(m_val).strip() and str(m_val).strip() != '品號':
-                    val = row.iloc[product_col_idx]
-                    if pd.notna(val):
-                        try:
-                            current_total += int(float(val))
-                        except:
-                            pass
-            
-            if current_total < quantity:
-                return {'success': False, 'error': f'該零件總成品數量不足！當前: {current_total}，需要: {quantity}'}
-            
-            # 從成品中扣除數量
-            remaining = quantity
-            for idx, row in df.iterrows():
-                if remaining <= 0:
-                    break
-                    
-                m_val = row.get('機型', '')
-                if pd.notna(m_val) and str(m_val).strip() and str(m_val).strip() != '品號':
-                    current_val = row.iloc[product_col_idx]
-                    if pd.notna(current_val):
-                        try:
-                            current_qty = int(float(current_val))
-                            if current_qty > 0:
-                                deduct = min(current_qty, remaining)
-                                df.at[idx, df.columns[product_col_idx]] = current_qty - deduct
-                                remaining -= deduct
-                                updated = True
-                        except:
-                            pass
-        
-        if not updated:
-             return {'success': False, 'error': '出庫操作未能完成，請檢查庫存狀態'}
+        lines = _stock_lines(quantity, lines, model=model, work_order=work_order, purchase_order=purchase_order)
+        user_id = user if user else session.get('user', 'System')
 
-        # 寫回 Excel
-        with pd.ExcelWriter(casting_file, engine='openpyxl', mode='a', if_sheet_exists='replace') as writer:
-            df.to_excel(writer, sheet_name=xl.sheet_names[sheet_idx], index=False)
-            
-        # 寫入履歷
-        # 如果是邏輯A (有log_data)，我們記錄精確值
-        if log_data:
-            user_id = user if user else session.get('user', 'System')
-            field_name = f'{product_label} (出庫: 工單 {work_order}'
-            if purchase_order:
-                field_name += f', 採購單 {purchase_order}'
-            field_name += ')'
-            
-            # 將鑄造商資訊也存入 note
-            note = f"工單編碼: {work_order}"
-            if supplier:
-                note += f", 鑄造商: {supplier}"
-            if purchase_order:
-                note += f", 採購單: {purchase_order}"
-                
-            try:
-                log_edit(part_name, log_data['item_id'], field_name, 
-                         log_data['old_value'], log_data['new_value'], user_id, note,
-                         model_name=log_data.get('model_name'))
-            except Exception as e:
-                print(f"Failed to log edit: {e}")
-        
+        staged = _stage_stock_movements(part_name, product_col_idx, _stock_out_plan(lines), user_id)
+        if staged.get('error'):
+            return {'success': False, 'error': staged['error']}
+
+        # 寫入履歷（一次寫入）
         # 如果是邏輯B，我們目前沒辦法精確記錄單一 item_id 的變化，除非記錄多筆
         # 暫時不處理邏輯B的 Log，因為前端已經強制要選機型了。
-        
+        try:
+            log_edits(_stock_out_entries(part_name, product_label, staged['log_data'], supplier), user_id)
+        except Exception as e:
+            print(f"Failed to log edit: {e}")
+
+        total_qty = sum(line['quantity'] for line in lines)
         return {
             'success': True,
-            'message': f'{part_name} 出庫成功，工單 {work_order}，已扣除 {quantity} 件成品',
+            'message': f'{part_name} 出庫成功，工單 {work_order}，已扣除 {total_qty} 件成品',
             'work_order': work_order,
             'purchase_order': purchase_order,
-            'quantity': quantity
+            'quantity': total_qty,
+            'lines': _result_lines(staged['log_data'])
         }
-        
+
+    except WriteQueueFull:
+        raise
+    except Exception as e:
+        return {'success': False, 'error': str(e)}
+
+
+def stock_transaction(movements, user=None, work_order=None, supplier=None):
+    """
+    多零件出入庫交易 - 例如同一張工單一次領出底座與立柱
+
+    movements 為 [{'action': 'in' | 'out', 'part_name', 'model', 'quantity',
+                   'work_order'?, 'purchase_order'?, 'supplier'?, 'work_order_code'?, 'barcode'?}, ...]，
+    未指定的 work_order / supplier 沿用呼叫參數。全部以同一份目前內容檢查，任一筆失敗時全部不執行；
+    成功時一次寫入日誌（一次寫回活頁簿），履歷一次寫入並以相同的交易編號歸為一組。
+    """
+    try:
+        from flask import session
+
+        if not movements:
+            return {'success': False, 'error': '沒有出入庫明細'}
+
+        # 依 (動作, 零件, 供應商) 分組，各組即 stock_in_material / stock_out_product 的 lines
+        groups = {}
+        for n, movement in enumerate(movements, 1):
+            action, part_name = movement.get('action'), movement.get('part_name')
+            if action not in ('in', 'out'):
+                return {'success': False, 'error': f'第 {n} 筆: 未知的動作 {action}'}
+            if part_name not in STOCK_PARTS:
+                return {'success': False, 'error': f'第 {n} 筆: 未知的零件名稱: {part_name}'}
+            try:
+                qty = int(movement.get('quantity') or 0)
+            except (TypeError, ValueError):
+                qty = 0
+            if qty <= 0:
+                return {'success': False, 'error': f'第 {n} 筆: 數量必須為正整數'}
+            if action == 'out' and _product_column(part_name)[0] is None:
+                return {'success': False, 'error': f'找不到 {part_name} 的成品欄位'}
+            line_supplier = movement.get('supplier') or supplier
+            groups.setdefault((action, part_name, line_supplier), []).append(dict(movement, quantity=qty))
+
+        steps = []
+        for (action, part_name, _), group in groups.items():
+            if action == 'in':
+                lines = _stock_lines(0, group, model=None, work_order_code=None, barcode=None, purchase_order=None)
+                steps.append((part_name, _material_column(part_name), _stock_in_plan(lines)))
+            else:
+                lines = _stock_lines(0, group, model=None, work_order=work_order, purchase_order=None)
+                steps.append((part_name, _product_column(part_name)[0], _stock_out_plan(lines)))
+
+        user_id = user if user else session.get('user', 'System')
+        results = _stage_stock_transaction(steps, user_id)
+        if results[-1].get('error'):
+            action, part_name, _ = list(groups)[len(results) - 1]
+            label = '入庫' if action == 'in' else '出庫'
+            return {'success': False, 'error': f'{part_name} {label}: {results[-1]["error"]}'}
+
+        # 寫入履歷（整筆交易一次寫入，同一個交易編號）
+        transaction_id = datetime.now().strftime('TX%Y%m%d%H%M%S%f')
+        entries, summary = [], []
+        for ((action, part_name, line_supplier), _), result in zip(groups.items(), results):
+            if action == 'in':
+                entries += _stock_in_entries(part_name, result['log_data'], line_supplier)
+            else:
+                entries += _stock_out_entries(part_name, _product_column(part_name)[1], result['log_data'], line_supplier)
+            summary.append({'action': action, 'part_name': part_name, 'lines': _result_lines(result['log_data'])})
+        try:
+            log_edits(entries, user_id, transaction=transaction_id)
+        except Exception as e:
+            print(f"Failed to log edit: {e}")
+
+        return {
+            'success': True,
+            'message': f'出入庫交易完成，共 {len(movements)} 筆（{", ".join(dict.fromkeys(part for _, part, _ in groups))}）',
+            'transaction_id': transaction_id,
+            'work_order': work_order,
+            'movements': summary
+        }
+
+    except WriteQueueFull:
+        raise
     except Exception as e:
         return {'success': False, 'error': str(e)}
@@ -5,9 +5,12 @@ from datetime import datetime
 import json
 import os
 import glob
-
-# 快取
-_LIFTING_CACHE = {'mtime': 0, 'data': None}
+from .cache_registry import registry, FileInput
+from .snapshot_store import SnapshotCodec
+from .xlsx_patch import WorkbookPatch, PatchUnsupported
+from .write_queue import get_write_queue, WriteQueueFull
+from .atomic_file import save_workbook
+from .user import User
 
 def get_lifting_file_path():
     """尋找吊具清冊的路徑"""
@@ -33,119 +36,103 @@ def ensure_columns(df):
         df['借用日期'] = ''
     return df
 
-def load_lifting_inventory():
-    """載入吊具清單"""
+def _build_lifting_inventory():
+    """讀取吊具清冊各分頁"""
     file_path = get_lifting_file_path()
-    if not os.path.exists(file_path):
-        return {}
-
-    current_mtime = os.path.getmtime(file_path)
-    if _LIFTING_CACHE['mtime'] == current_mtime and _LIFTING_CACHE['data']:
-        return _LIFTING_CACHE['data']
-
-    # 嘗試讀取持久化快取
-    cache_dir = os.path.join(os.getcwd(), 'app', 'cache')
-    os.makedirs(cache_dir, exist_ok=True)
-    cache_file = os.path.join(cache_dir, 'lifting_cache.pkl')
-    if os.path.exists(cache_file):
-        try:
-            import pickle
-            with open(cache_file, 'rb') as f:
-                cached = pickle.load(f)
-            if cached.get('mtime') == current_mtime:
-                _LIFTING_CACHE['mtime'] = current_mtime
-                _LIFTING_CACHE['data'] = cached['data']
-                return cached['data']
-        except:
-            pass
-
-    try:
-        xl = pd.ExcelFile(file_path, engine='openpyxl')
-        data = {}
+    xl = pd.ExcelFile(file_path, engine='openpyxl')
+    data = {}
+    
+    # 輔助：放置位置排序關鍵值
+    def get_location_sort_val(loc_str):
+        loc = str(loc_str).strip()
+        # 正規化：去除換行、空白，統一「第1區」與「第一區」
+        loc = loc.replace('\n', '').replace(' ', '')
         
-        # 輔助：放置位置排序關鍵值
-        def get_location_sort_val(loc_str):
-            loc = str(loc_str).strip()
-            # 正規化：去除換行、空白，統一「第1區」與「第一區」
-            loc = loc.replace('\n', '').replace(' ', '')
+        mapping = {
+            '第一區': 1, '第1區': 1,
+            '第二區': 2, '第2區': 2,
+            '第三區': 3, '第3區': 3,
+            '第四區': 4, '第4區': 4,
+            '第五區': 5, '第5區': 5,
+            '第六區': 6, '第6區': 6,
+            '第七區': 7, '第7區': 7,
+            '第八區': 8, '第8區': 8,
+            '第九區': 9, '第9區': 9,
+            '第十區': 10, '第10區': 10
+        }
+        # 如果符合對照表則回傳對應數字，否則回傳一個極大值
+        return mapping.get(loc, 999), loc
+
+    for sheet in SHEET_NAMES:
+        if sheet in xl.sheet_names:
+            df = pd.read_excel(xl, sheet_name=sheet)
+            df = df.fillna('')
+            df = ensure_columns(df)
             
-            mapping = {
-                '第一區': 1, '第1區': 1,
-                '第二區': 2, '第2區': 2,
-                '第三區': 3, '第3區': 3,
-                '第四區': 4, '第4區': 4,
-                '第五區': 5, '第5區': 5,
-                '第六區': 6, '第6區': 6,
-                '第七區': 7, '第7區': 7,
-                '第八區': 8, '第8區': 8,
-                '第九區': 9, '第9區': 9,
-                '第十區': 10, '第10區': 10
-            }
-            # 如果符合對照表則回傳對應數字，否則回傳一個極大值
-            return mapping.get(loc, 999), loc
-
-        for sheet in SHEET_NAMES:
-            if sheet in xl.sheet_names:
-                df = pd.read_excel(xl, sheet_name=sheet)
-                df = df.fillna('')
-                df = ensure_columns(df)
-                
-                # Get name map
-                from .user import User
-                name_map = User.get_name_map()
+            # Get name map
+            name_map = User.get_name_map()
+            
+            # Convert DataFrame to list of dicts
+            items = []
+            for _, row in df.iterrows():
+                # 吊具編號是唯一識別
+                # 吊具編號是唯一識別
+                item_id = str(row.get('吊具編號', '')).strip()
+                if item_id.endswith('.0'):
+                    item_id = item_id[:-2]
+                if not item_id or item_id in ['nan', 'N/A', 'None']:
+                    continue
                 
-                # Convert DataFrame to list of dicts
-                items = []
-                for _, row in df.iterrows():
-                    # 吊具編號是唯一識別
-                    # 吊具編號是唯一識別
-                    item_id = str(row.get('吊具編號', '')).strip()
-                    if item_id.endswith('.0'):
-                        item_id = item_id[:-2]
-                    if not item_id or item_id in ['nan', 'N/A', 'None']:
-                        continue
+                loc_val = str(row.get('放置位置', '')).strip()
+                replace_map = {
+                    '第一區': '第1區', '第二區': '第2區', '第三區': '第3區', '第四區': '第4區', '第五區': '第5區',
+                    '第六區': '第6區', '第七區': '第7區', '第八區': '第8區', '第九區': '第9區', '第十區': '第10區'
+                }
+                for k, v in replace_map.items():
+                    loc_val = loc_val.replace(k, v)
                     
-                    loc_val = str(row.get('放置位置', '')).strip()
-                    replace_map = {
-                        '第一區': '第1區', '第二區': '第2區', '第三區': '第3區', '第四區': '第4區', '第五區': '第5區',
-                        '第六區': '第6區', '第七區': '第7區', '第八區': '第8區', '第九區': '第9區', '第十區': '第10區'
-                    }
-                    for k, v in replace_map.items():
-                        loc_val = loc_val.replace(k, v)
-                        
-                    raw_borrower = str(row.get('目前借用人', '')).strip()
-                    borrower_display = name_map.get(raw_borrower, raw_borrower)
-
-                    items.append({
-                        'category': sheet,
-                        'id': item_id,
-                        'spec': str(row.get('吊具規格 /重量/長度', '')),
-                        'location': loc_val,
-                        'status': str(row.get('使用狀態', '')),
-                        'borrower': borrower_display,
-                        'borrower_raw': raw_borrower,
-                        'borrow_date': str(row.get('借用日期', ''))
-                    })
-                
-                # 按是否借用中 (借用中排在最前面)，再按放置位置 (第1區、第2區...) 排序
-                items.sort(key=lambda x: (
-                    0 if x['status'] == '借用中' or x['borrower_raw'] else 1,
-                    get_location_sort_val(x['location'])[0]
-                ))
-                
-                data[sheet] = items
-                
-        _LIFTING_CACHE['mtime'] = current_mtime
-        _LIFTING_CACHE['data'] = data
-        
-        try:
-            import pickle
-            with open(cache_file, 'wb') as f:
-                pickle.dump({'mtime': current_mtime, 'data': data}, f)
-        except:
-            pass
+                raw_borrower = str(row.get('目前借用人', '')).strip()
+                borrower_display = name_map.get(raw_borrower, raw_borrower)
+
+                items.append({
+                    'category': sheet,
+                    'id': item_id,
+                    'spec': str(row.get('吊具規格 /重量/長度', '')),
+                    'location': loc_val,
+                    'status': str(row.get('使用狀態', '')),
+                    'borrower': borrower_display,
+                    'borrower_raw': raw_borrower,
+                    'borrow_date': str(row.get('借用日期', ''))
+                })
             
-        return data
+            # 按是否借用中 (借用中排在最前面)，再按放置位置 (第1區、第2區...) 排序
+            items.sort(key=lambda x: (
+                0 if x['status'] == '借用中' or x['borrower_raw'] else 1,
+                get_location_sort_val(x['location'])[0]
+            ))
+            
+            data[sheet] = items
+            
+    return data
+
+
+# 借用人顯示名稱來自 users.json，名稱異動時也要重建
+registry.register('lifting', _build_lifting_inventory,
+                  inputs=[FileInput(get_lifting_file_path), FileInput(User.get_users_file, optional=True)],
+                  persist=SnapshotCodec(
+                      'lifting.snap', 1,
+                      encode=lambda data: (dict(data), {'categories': list(data)}),
+                      decode=lambda reader: {c: reader.records(c) for c in reader.meta['categories']}
+                  ),
+                  cache_if=bool)
+
+
+def load_lifting_inventory():
+    """載入吊具清單"""
+    if not os.path.exists(get_lifting_file_path()):
+        return {}
+    try:
+        return registry.get('lifting')
     except Exception as e:
         print(f"Error loading lifting inventory: {e}")
         return {}
@@ -210,78 +197,125 @@ def get_lifting_history():
     return []
 
 
-def update_lifting_status(category, item_id, action, user_name):
-    """
-    更新吊具狀態
-    action: 'borrow' 或 'return'
-    """
-    file_path = get_lifting_file_path()
-    if not os.path.exists(file_path):
-        return False, "找不到吊具清冊檔案"
+def _lifting_row(rows, id_col, item_id):
+    """依吊具編號找列，rows 為自第 2 列起的值 tuple"""
+    for row_idx, row in enumerate(rows, start=2):
+        value = row[id_col] if id_col < len(row) else None
+        curr_id = str(value).strip() if value is not None else ''
+        if curr_id.endswith('.0'):
+            curr_id = curr_id[:-2]
+        if curr_id == str(item_id):
+            return row_idx
+    return None
 
-    try:
-        wb = load_workbook(file_path)
-        if category not in wb.sheetnames:
-            return False, f"找不到工作表: {category}"
 
-        ws = wb[category]
-        headers = {cell.value: idx for idx, cell in enumerate(ws[1])}
-        
-        # 確保新的兩欄存在
-        if '目前借用人' not in headers:
-            new_col_idx = len(headers) + 1
-            ws.cell(row=1, column=new_col_idx, value='目前借用人')
-            headers['目前借用人'] = new_col_idx - 1
-            
-        if '借用日期' not in headers:
-            new_col_idx = len(headers) + 1
-            ws.cell(row=1, column=new_col_idx, value='借用日期')
-            headers['借用日期'] = new_col_idx - 1
+def _lifting_values(action, user_name):
+    """借還後的 (使用狀態, 目前借用人, 借用日期)"""
+    if action == 'borrow':
+        return '借用中', user_name, datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    return '在庫', '', ''
 
+
+def _patch_lifting_status(file_path, category, item_id, action, user_name):
+    """直接修補分頁 XML（只改寫三個儲存格）；需要新增標題欄時拋出 PatchUnsupported"""
+    with WorkbookPatch(file_path) as wb:
+        if category not in wb.sheet_names:
+            return False, f"找不到工作表: {category}"
+        sheet = wb.sheet(category)
+        headers = {value: idx for idx, value in enumerate(sheet.row_values(1))}
+        if '目前借用人' not in headers or '借用日期' not in headers:
+            raise PatchUnsupported('需要新增借用人 / 借用日期欄位')
         if '吊具編號' not in headers or '使用狀態' not in headers:
             return False, "工作表缺少必要標題：'吊具編號' 或 '使用狀態'"
 
         id_col = headers['吊具編號']
-        status_col = headers['使用狀態']
-        borrower_col = headers['目前借用人']
-        date_col = headers['借用日期']
-
-        row_found = None
-        for row_idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
-            curr_id = str(row[id_col]).strip() if row[id_col] is not None else ''
-            if curr_id.endswith('.0'):
-                curr_id = curr_id[:-2]
-            if curr_id == str(item_id):
-                row_found = row_idx
-                break
-
+        rows = (sheet.row_values(row, id_col + 1) for row in range(2, sheet.max_row + 1))
+        row_found = _lifting_row(rows, id_col, item_id)
         if not row_found:
             return False, f"找不到吊具編號: {item_id}"
 
-        now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        for col, value in zip((headers['使用狀態'], headers['目前借用人'], headers['借用日期']),
+                              _lifting_values(action, user_name)):
+            sheet.set(row_found, col + 1, value)
+        wb.save()
+    return True, None
 
-        if action == 'borrow':
-            ws.cell(row=row_found, column=status_col + 1, value='借用中')
-            ws.cell(row=row_found, column=borrower_col + 1, value=user_name)
-            ws.cell(row=row_found, column=date_col + 1, value=now_str)
-        elif action == 'return':
-            ws.cell(row=row_found, column=status_col + 1, value='在庫')
-            ws.cell(row=row_found, column=borrower_col + 1, value='')
-            ws.cell(row=row_found, column=date_col + 1, value='')
-        else:
-            return False, "未知的操作"
 
-        wb.save(file_path)
-        
-        # 紀錄歷程
-        log_lifting_action(category, item_id, action, user_name)
+def _save_lifting_status(file_path, category, item_id, action, user_name):
+    """以 openpyxl 開檔修改（可新增標題欄）"""
+    wb = load_workbook(file_path)
+    if category not in wb.sheetnames:
+        return False, f"找不到工作表: {category}"
+
+    ws = wb[category]
+    headers = {cell.value: idx for idx, cell in enumerate(ws[1])}
+    
+    # 確保新的兩欄存在
+    if '目前借用人' not in headers:
+        new_col_idx = len(headers) + 1
+        ws.cell(row=1, column=new_col_idx, value='目前借用人')
+        headers['目前借用人'] = new_col_idx - 1
         
-        # 強制刷新快取
-        _LIFTING_CACHE['mtime'] = 0 
+    if '借用日期' not in headers:
+        new_col_idx = len(headers) + 1
+        ws.cell(row=1, column=new_col_idx, value='借用日期')
+        headers['借用日期'] = new_col_idx - 1
+
+    if '吊具編號' not in headers or '使用狀態' not in headers:
+        return False, "工作表缺少必要標題：'吊具編號' 或 '使用狀態'"
+
+    row_found = _lifting_row(ws.iter_rows(min_row=2, values_only=True), headers['吊具編號'], item_id)
+    if not row_found:
+        return False, f"找不到吊具編號: {item_id}"
+
+    for col, value in zip((headers['使用狀態'], headers['目前借用人'], headers['借用日期']),
+                          _lifting_values(action, user_name)):
+        ws.cell(row=row_found, column=col + 1, value=value)
+
+    save_workbook(wb, file_path)
+    return True, None
+
+
+def _write_lifting_status(file_path, category, item_id, action, user_name):
+    """在清冊的寫入執行緒上執行：修改檔案、紀錄歷程並刷新快取"""
+    try:
+        ok, error = _patch_lifting_status(file_path, category, item_id, action, user_name)
+    except PatchUnsupported as e:
+        print(f"[Lifting] 改用 openpyxl 寫入: {e}")
+        ok, error = _save_lifting_status(file_path, category, item_id, action, user_name)
+    if not ok:
+        return False, error
+
+    # 紀錄歷程
+    log_lifting_action(category, item_id, action, user_name)
+
+    # 強制刷新快取（下次讀取等待重建，立即看到借還狀態）
+    registry.invalidate_file(file_path)
+    return True, None
+
+
+def update_lifting_status(category, item_id, action, user_name):
+    """
+    更新吊具狀態
+    action: 'borrow' 或 'return'
+    """
+    file_path = get_lifting_file_path()
+    if not os.path.exists(file_path):
+        return False, "找不到吊具清冊檔案"
+    if action not in ('borrow', 'return'):
+        return False, "未知的操作"
+
+    try:
+        # 同一份清冊的借還依序寫入，不會互相覆蓋
+        ok, error = get_write_queue(file_path).call(_write_lifting_status, file_path, category, item_id, action, user_name)
+        if not ok:
+            return False, error
         return True, "更新成功"
 
     except PermissionError:
         return False, "檔案可能被另一個程式(如 Excel)開啟中，請先關閉。"
+    except WriteQueueFull:
+        raise
     except Exception as e:
         print(f"Error updating lifting status: {e}")
         return False, str(e)
@@ -0,0 +1,57 @@
+"""
+機型名稱標準化
+正規表示式只編譯一次，標準化結果以 LRU 表記憶（同一機型在每個分頁、每次重建都會出現）。
+標準機型索引（標準化鍵 → 總表機型名稱）依活頁簿版本建立一次，由庫存彙總、機型搜尋、缺料比對共用。
+"""
+import re
+from functools import lru_cache
+
+from .cache_registry import registry, DatasetInput
+
+# 僅移除「底座」後綴，保留「主底座/副底座」作為區分
+_SUFFIX_RE = re.compile(r'底座$')
+# 移除括號內容（如 (工作台-鑽孔)）暫時停用，避免誤刪關鍵區分資訊: r'\([^)]*\)$'
+# 僅移除符號與空格，保留中文字以便區分（如主/副底座）
+_SYMBOL_RE = re.compile(r'[-_\s/.\(\)]')
+
+
+@lru_cache(maxsize=8192)
+def _normalize(text):
+    normalized = text.strip().upper()  # 轉大寫
+    normalized = _SUFFIX_RE.sub('', normalized)
+    return _SYMBOL_RE.sub('', normalized)
+
+
+def normalize_model_name(model_name):
+    """標準化機型名稱，移除後綴變體，用於匹配"""
+    if not model_name:
+        return model_name
+    return _normalize(str(model_name))
+
+
+def _build_model_index():
+    """標準化鍵 → 總表機型名稱（同一鍵以最先出現者為準）"""
+    index = {}
+    for model_str in registry.get('master_models'):
+        norm = normalize_model_name(model_str)
+        if norm and norm not in index:
+            index[norm] = model_str
+    return index
+
+
+# master_models 依活頁簿內容重建，索引跟著重建；只存在記憶體
+registry.register('model_index', _build_model_index, inputs=[DatasetInput('master_models')])
+
+
+def get_model_index():
+    """取得標準機型索引，呼叫者不可修改回傳的 dict"""
+    from . import inventory  # noqa: F401  註冊 master_models（inventory 也匯入本模組，不能放在檔頭）
+    return registry.get('model_index')
+
+
+def canonical_model_name(model_name):
+    """回傳與輸入標準化後相同的總表機型名稱，找不到時回傳 None"""
+    norm = normalize_model_name(model_name)
+    if not norm:
+        return None
+    return get_model_index().get(norm)
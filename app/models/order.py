@@ -4,16 +4,10 @@ from datetime import datetime
 import os
 import urllib.request
 import json
-import pickle
 import hashlib
-
-
-# 全域快取（以 mtime 判斷是否需要重新讀取）
-PICKING_CACHE = {'mtime': 0, 'data': None, 'raw_df': None}
-
-
-# 工單快取
-ORDERS_CACHE = {'mtime': 0, 'data': None}
+from datetime import timedelta
+from .cache_registry import registry, FileInput, DatasetInput, TagInput
+from .snapshot_store import SnapshotCodec
 
 def clean_id(val):
     if pd.isna(val): return ""
@@ -31,366 +25,330 @@ def find_col(df, keywords):
             return col
     return None
 
-def get_picking_data():
-    """從 API 讀取成品撥料資料，回傳以訂單為 Key 的需求資料 (含快取)"""
-    global PICKING_CACHE
-
+def picking_time_tag():
+    """撥料資料的時間標記：每天早上 9:00 及下午 5:00 (17:00) 進行更新"""
+    now = datetime.now()
+    if now.hour >= 17:
+        return now.strftime('%Y%m%d_1700')
+    elif now.hour >= 9:
+        return now.strftime('%Y%m%d_0900')
+    else:
+        return (now - timedelta(days=1)).strftime('%Y%m%d_1700')
+
+def _build_picking_data():
+    """從 API 讀取成品撥料資料（失敗時退回本機 Excel）"""
+    api_url = current_app.config.get('PICKING_API_URL', 'http://192.168.6.119:5002/api/finished_materials')
+    print(f"Fetching Picking Data from API: {api_url}")
+
+    rows = []
     try:
-        api_url = current_app.config.get('PICKING_API_URL', 'http://192.168.6.119:5002/api/finished_materials')
-        
-        from datetime import datetime, timedelta
-        
-        # 使用雜湊或時間標記作為 mtime
-        # 每天早上 9:00 及下午 5:00 (17:00) 進行更新
-        now = datetime.now()
-        if now.hour >= 17:
-            current_time_tag = now.strftime('%Y%m%d_1700')
-        elif now.hour >= 9:
-            current_time_tag = now.strftime('%Y%m%d_0900')
+        # 1. 讀取成品物料清單
+        with urllib.request.urlopen(api_url, timeout=3.0) as response:
+            materials_data = json.loads(response.read().decode('utf-8'))
+            
+        # 2. 讀取所有需求明細
+        api_details_url = current_app.config.get('PICKING_DETAILS_API_URL', 'http://192.168.6.119:5002/api/demand_details/all')
+        try:
+            with urllib.request.urlopen(api_details_url, timeout=3.0) as response:
+                details_data = json.loads(response.read().decode('utf-8'))
+        except Exception as ed:
+            print(f"Failed to fetch demand details from {api_details_url}: {ed}. Using empty dict for details.")
+            details_data = {}
+            
+        # 將 JSON 扁平化，轉換為類似 Excel 的 DataFrame 結構
+        for mat_item in materials_data:
+            part_id = str(mat_item.get('物料', '')).strip()
+            part_desc_top = str(mat_item.get('物料說明', '')).strip()
+            un_stock = mat_item.get('unrestricted_stock', 0.0)
+            ins_stock = mat_item.get('inspection_stock', 0.0)
+            
+            # 如果 mat_item 中的 demand_details 為空，則從全域 details_data 中補充
+            details = mat_item.get('demand_details', [])
+            if not details or len(details) == 0:
+                details = details_data.get(part_id, [])
+            
+            for detail in details:
+                order_id = str(detail.get('訂單', '')).strip()
+                if not order_id: continue
+                
+                # 需求與領料 (API 若無提供需求數量，針對已領足項目(pending=0)預設為 1.0 確保顯示)
+                pending = float(detail.get('未結數量 (EINHEIT)', 0.0) or 0.0)
+                api_demand = detail.get('需求數量 (EINHEIT)')
+                
+                if api_demand is not None:
+                    demand = float(api_demand)
+                else:
+                    # 若 API 沒給需求量，且未結為 0，暗示已領，設為 1.0 供系統判定
+                    demand = pending if pending > 0 else 1.0
+                
+                picked = demand - pending
+
+                rows.append({
+                    '訂單': order_id,
+                    '物料': part_id,
+                    '需求數量 (EINHEIT)': demand,
+                    '領料數量 (EINHEIT)': picked,
+                    '未結數量 (EINHEIT)': pending,
+                    '物料說明': detail.get('物料說明', part_desc_top),
+                    '需求日期': detail.get('需求日期', ''),
+                    'unrestricted_stock': un_stock,
+                    'inspection_stock': ins_stock
+                })
+    except Exception as e:
+        print(f"API request failed: {e}. Will fall back to local Excel file.")
+        rows = []
+
+    if not rows:
+        print("API returned empty picking data or request failed. Falling back to local Excel file...")
+        picking_file = current_app.config['PICKING_FILE']
+        if os.path.exists(picking_file):
+            raw_df = pd.read_excel(picking_file, engine='calamine')
+            # 確保列存在
+            for col in ['unrestricted_stock', 'inspection_stock']:
+                if col not in raw_df.columns:
+                    raw_df[col] = 0.0
         else:
-            current_time_tag = (now - timedelta(days=1)).strftime('%Y%m%d_1700')
-        
-        # 內部的變數快取仍有效，直接回傳
-        if PICKING_CACHE['mtime'] == current_time_tag and PICKING_CACHE['data'] is not None:
-            return PICKING_CACHE['data']
-
-        # 嘗試讀取硬碟上的 pickle 快取 (持久化)，減少重啟後的首位使用者等待
-        cache_dir = os.path.join(os.getcwd(), 'app', 'cache')
-        os.makedirs(cache_dir, exist_ok=True)
-        cache_file = os.path.join(cache_dir, 'picking_cache.pkl')
-        
-        if os.path.exists(cache_file):
+            raw_df = pd.DataFrame(columns=[
+                '訂單', '物料', '需求數量 (EINHEIT)', '領料數量 (EINHEIT)', 
+                '未結數量 (EINHEIT)', '物料說明', '需求日期', 
+                'unrestricted_stock', 'inspection_stock'
+            ])
+    else:
+        raw_df = pd.DataFrame(rows)
+    
+    # 建立 picking_map (用於 order.py 其他邏輯)
+    picking_map = {}
+    for _, row in raw_df.iterrows():
+        order_id = clean_id(row['訂單'])
+        if not order_id: continue
+
+        qty = row['未結數量 (EINHEIT)']
+        if pd.isna(qty) or qty <= 0: continue
+
+        item_name = str(row['物料說明'])
+        need_date = row['需求日期']
+
+        if order_id not in picking_map:
+            picking_map[order_id] = {'底座': 0, '工作台': 0, '橫樑': 0, '立柱': 0, 'dates': []}
+
+        if '底座' in item_name and '馬達' not in item_name:
+            picking_map[order_id]['底座'] += qty
+        elif '工作台' in item_name:
+            picking_map[order_id]['工作台'] += qty
+        elif '橫樑' in item_name:
+            picking_map[order_id]['橫樑'] += qty
+        elif '立柱' in item_name:
+            picking_map[order_id]['立柱'] += qty
+
+        if pd.notna(need_date) and need_date != "":
             try:
-                with open(cache_file, 'rb') as f:
-                    cached_data = pickle.load(f)
-                # 若快取是在同一時間標記內建立的，則信任
-                if cached_data.get('time_tag') == current_time_tag:
-                    PICKING_CACHE['mtime'] = current_time_tag
-                    PICKING_CACHE['data'] = cached_data['data']
-                    PICKING_CACHE['raw_df'] = cached_data['raw_df']
-                    return cached_data['data']
+                # 轉換為 Timestamp 格式以保持相容性
+                dt = pd.to_datetime(need_date)
+                picking_map[order_id]['dates'].append(dt)
             except:
                 pass
 
-        print(f"Fetching Picking Data from API: {api_url}")
+    return {'data': picking_map, 'raw_df': raw_df}
 
-        rows = []
-        try:
-            # 1. 讀取成品物料清單
-            with urllib.request.urlopen(api_url, timeout=3.0) as response:
-                materials_data = json.loads(response.read().decode('utf-8'))
-                
-            # 2. 讀取所有需求明細
-            api_details_url = current_app.config.get('PICKING_DETAILS_API_URL', 'http://192.168.6.119:5002/api/demand_details/all')
-            try:
-                with urllib.request.urlopen(api_details_url, timeout=3.0) as response:
-                    details_data = json.loads(response.read().decode('utf-8'))
-            except Exception as ed:
-                print(f"Failed to fetch demand details from {api_details_url}: {ed}. Using empty dict for details.")
-                details_data = {}
-                
-            # 將 JSON 扁平化，轉換為類似 Excel 的 DataFrame 結構
-            for mat_item in materials_data:
-                part_id = str(mat_item.get('物料', '')).strip()
-                part_desc_top = str(mat_item.get('物料說明', '')).strip()
-                un_stock = mat_item.get('unrestricted_stock', 0.0)
-                ins_stock = mat_item.get('inspection_stock', 0.0)
-                
-                # 如果 mat_item 中的 demand_details 為空，則從全域 details_data 中補充
-                details = mat_item.get('demand_details', [])
-                if not details or len(details) == 0:
-                    details = details_data.get(part_id, [])
-                
-                for detail in details:
-                    order_id = str(detail.get('訂單', '')).strip()
-                    if not order_id: continue
-                    
-                    # 需求與領料 (API 若無提供需求數量，針對已領足項目(pending=0)預設為 1.0 確保顯示)
-                    pending = float(detail.get('未結數量 (EINHEIT)', 0.0) or 0.0)
-                    api_demand = detail.get('需求數量 (EINHEIT)')
-                    
-                    if api_demand is not None:
-                        demand = float(api_demand)
-                    else:
-                        # 若 API 沒給需求量，且未結為 0，暗示已領，設為 1.0 供系統判定
-                        demand = pending if pending > 0 else 1.0
-                    
-                    picked = demand - pending
-
-                    rows.append({
-                        '訂單': order_id,
-                        '物料': part_id,
-                        '需求數量 (EINHEIT)': demand,
-                        '領料數量 (EINHEIT)': picked,
-                        '未結數量 (EINHEIT)': pending,
-                        '物料說明': detail.get('物料說明', part_desc_top),
-                        '需求日期': detail.get('需求日期', ''),
-                        'unrestricted_stock': un_stock,
-                        'inspection_stock': ins_stock
-                    })
-        except Exception as e:
-            print(f"API request failed: {e}. Will fall back to local Excel file.")
-            rows = []
-
-        if not rows:
-            print("API returned empty picking data or request failed. Falling back to local Excel file...")
-            picking_file = current_app.config['PICKING_FILE']
-            if os.path.exists(picking_file):
-                raw_df = pd.read_excel(picking_file, engine='calamine')
-                # 確保列存在
-                for col in ['unrestricted_stock', 'inspection_stock']:
-                    if col not in raw_df.columns:
-                        raw_df[col] = 0.0
-            else:
-                raw_df = pd.DataFrame(columns=[
-                    '訂單', '物料', '需求數量 (EINHEIT)', '領料數量 (EINHEIT)', 
-                    '未結數量 (EINHEIT)', '物料說明', '需求日期', 
-                    'unrestricted_stock', 'inspection_stock'
-                ])
-        else:
-            raw_df = pd.DataFrame(rows)
-        
-        # 建立 picking_map (用於 order.py 其他邏輯)
-        picking_map = {}
-        for _, row in raw_df.iterrows():
-            order_id = clean_id(row['訂單'])
-            if not order_id: continue
-
-            qty = row['未結數量 (EINHEIT)']
-            if pd.isna(qty) or qty <= 0: continue
-
-            item_name = str(row['物料說明'])
-            need_date = row['需求日期']
-
-            if order_id not in picking_map:
-                picking_map[order_id] = {'底座': 0, '工作台': 0, '橫樑': 0, '立柱': 0, 'dates': []}
-
-            if '底座' in item_name and '馬達' not in item_name:
-                picking_map[order_id]['底座'] += qty
-            elif '工作台' in item_name:
-                picking_map[order_id]['工作台'] += qty
-            elif '橫樑' in item_name:
-                picking_map[order_id]['橫樑'] += qty
-            elif '立柱' in item_name:
-                picking_map[order_id]['立柱'] += qty
-
-            if pd.notna(need_date) and need_date != "":
-                try:
-                    # 轉換為 Timestamp 格式以保持相容性
-                    dt = pd.to_datetime(need_date)
-                    picking_map[order_id]['dates'].append(dt)
-                except:
-                    pass
-
-        # 持久化快取到硬碟
-        try:
-            with open(cache_file, 'wb') as f:
-                pickle.dump({'time_tag': current_time_tag, 'data': picking_map, 'raw_df': raw_df}, f)
-        except:
-            pass
 
-        # 更新快取
-        PICKING_CACHE['mtime'] = current_time_tag
-        PICKING_CACHE['data'] = picking_map
-        PICKING_CACHE['raw_df'] = raw_df
-        return picking_map
+def _encode_picking(picking):
+    rows = [{'訂單': order_id, **needs} for order_id, needs in picking['data'].items()]
+    return {'picking': rows, 'raw_df': picking['raw_df']}, None
+
+def _decode_picking(reader):
+    picking_map = {}
+    for row in reader.records('picking'):
+        picking_map[row.pop('訂單')] = row
+    return {'data': picking_map, 'raw_df': reader.frame('raw_df')}
+
 
+registry.register('picking', _build_picking_data,
+                  inputs=[TagInput(picking_time_tag)],
+                  persist=SnapshotCodec('picking.snap', 1, _encode_picking, _decode_picking))
+
+
+def _get_picking_entry():
+    try:
+        return registry.get('picking')
     except Exception as e:
         print(f"Error in get_picking_data wrapper: {e}")
         import traceback
         traceback.print_exc()
-        return PICKING_CACHE['data'] or {}
+        # 重建失敗時沿用上一版資料
+        return registry.peek('picking') or {'data': {}, 'raw_df': None}
 
+def get_picking_data():
+    """從 API 讀取成品撥料資料，回傳以訂單為 Key 的需求資料 (含快取)"""
+    return _get_picking_entry()['data']
 
-def load_orders():
-    """載入工單總表資料並整合撥料需求 (整合多分頁並解決亂碼)"""
-    global ORDERS_CACHE
-    try:
-        workorder_file = current_app.config['WORKORDER_FILE']
-        
-        # 檢查檔案最後修改時間
-        try:
-            mtime = os.path.getmtime(workorder_file)
-            if ORDERS_CACHE['data'] and ORDERS_CACHE['mtime'] == mtime:
-                # 若檔案未變更，直接回傳快取
-                return ORDERS_CACHE['data']
-        except:
-            mtime = 0
-
-        # 嘗試讀取持久化快取 (.pkl)
-        cache_dir = os.path.join(os.getcwd(), 'app', 'cache')
-        cache_file = os.path.join(cache_dir, 'orders_cache.pkl')
-        if mtime > 0 and os.path.exists(cache_file):
-            try:
-                with open(cache_file, 'rb') as f:
-                    cached_data = pickle.load(f)
-                if cached_data.get('mtime') == mtime:
-                    # 快取有效且檔案未變，直接秒回
-                    ORDERS_CACHE['data'] = cached_data['data']
-                    ORDERS_CACHE['mtime'] = mtime
-                    return cached_data['data']
-            except:
-                pass
+def get_picking_raw_df():
+    """取得撥料明細原始 DataFrame (與 get_picking_data 同一版本)"""
+    return _get_picking_entry()['raw_df']
 
 
-        picking_data = get_picking_data()
+def _build_orders():
+    """載入工單總表資料並整合撥料需求 (整合多分頁並解決亂碼)"""
+    workorder_file = current_app.config['WORKORDER_FILE']
+    picking_data = registry.get('picking')['data']
+    
+    xl = pd.ExcelFile(workorder_file, engine='calamine')
+    all_parsed_orders = []
+    seen_work_orders = set()
+    
+    # 關鍵字清單 (包含亂碼可能的樣子)
+    KW_WO = ["工單", "號碼", "u", "W", "序號", "編號", "u"]
+    KW_ORDER = ["訂單", "q", "q"]
+    KW_CUST = ["客戶", "U", "U"]
+    KW_MATERIAL = ["物料品號"]  # 精確匹配物料品號
+    KW_DESC = ["品號說明"]  # 精確匹配品號說明
+    KW_START = ["開始", "Ͳ", "Ͳ"]
+    KW_END = ["結束", "Term", "Ͳ"]
+
+    for i, sheet_name in enumerate(xl.sheet_names):
+        if i == 1: continue # 排除半品
         
-        xl = pd.ExcelFile(workorder_file, engine='calamine')
-        all_parsed_orders = []
-        seen_work_orders = set()
+        df = pd.read_excel(xl, sheet_name=sheet_name)
         
-        # 關鍵字清單 (包含亂碼可能的樣子)
-        KW_WO = ["工單", "號碼", "u", "W", "序號", "編號", "u"]
-        KW_ORDER = ["訂單", "q", "q"]
-        KW_CUST = ["客戶", "U", "U"]
-        KW_MATERIAL = ["物料品號"]  # 精確匹配物料品號
-        KW_DESC = ["品號說明"]  # 精確匹配品號說明
-        KW_START = ["開始", "Ͳ", "Ͳ"]
-        KW_END = ["結束", "Term", "Ͳ"]
-
-        for i, sheet_name in enumerate(xl.sheet_names):
-            if i == 1: continue # 排除半品
-            
-            df = pd.read_excel(xl, sheet_name=sheet_name)
-            
-            # 定位欄位 - 直接使用準確的欄位名稱
-            col_wo = find_col(df, KW_WO)
-            col_order = find_col(df, KW_ORDER)
-            col_cust = find_col(df, KW_CUST)
-            col_material = '物料品號' if '物料品號' in df.columns else None  # 直接指定
-            col_desc = '品號說明' if '品號說明' in df.columns else None  # 直接指定
-            col_start = '生產開始' if '生產開始' in df.columns else None  # 直接指定
-            col_end = '生產結束' if '生產結束' in df.columns else None  # 直接指定
-            col_note = '特規備註' if '特規備註' in df.columns else None  # 直接指定
-            col_elec = '電控外包' if '電控外包' in df.columns else None  # 工廠分類用
-            col_paint = '噴漆外包' if '噴漆外包' in df.columns else None  # 工廠分類用
-            
-            if col_start and col_start == col_end:
-                for c in df.columns:
-                    if c != col_start and any(k in str(c) for k in ["結束", "Term"]):
-                        col_end = c; break
-
-            for _, row in df.iterrows():
-                try:
-                    wo_val = row.get(col_wo) if col_wo else None
-                    order_val = row.get(col_order) if col_order else None
-                    
-                    wo_str = clean_id(wo_val)
-                    order_str = clean_id(order_val)
-                    
-                    if not wo_str and not order_str: continue
-                    
-                    # 過濾條件1：排除異常工單
-                    if wo_str.startswith("70000"): continue  # 排除 70000 開頭
-                    if any(k in wo_str for k in ['紅色', '黃色', '已出貨', '改單']): continue  # 排除顏色標記
-                    if not wo_str.replace('.', '').isdigit(): continue  # 只保留數字工單號碼
-                    
-                    # 過濾條件2：必須有訂單號碼或客戶名稱
-                    cust_val = row.get(col_cust) if col_cust else None
-                    if not order_str and (not cust_val or pd.isna(cust_val) or str(cust_val).strip() == ''):
-                        continue  # 沒有訂單號碼且沒有客戶名稱，跳過
-                    
-                    # 建立唯一識別碼
-                    id_key = wo_str
-                    if id_key in seen_work_orders: continue
-                    seen_work_orders.add(id_key)
-
-                    needs = {'底座': 0, '工作台': 0, '橫樑': 0, '立柱': 0}
-                    picking_dates = []
-                    if order_str and order_str in picking_data:
-                        picked = picking_data[order_str]
-                        needs.update({k: int(v) for k, v in picked.items() if k != 'dates'})
-                        picking_dates = picked['dates']
-                    
-                    def safe_date_str(val):
-                        if pd.isna(val) or str(val).strip() == "": return ""
-                        try:
-                            if isinstance(val, (datetime, pd.Timestamp)): return val.strftime('%Y-%m-%d')
-                            return str(val).split(' ')[0]
-                        except: return ""
-
-                    need_date_display = ""
-                    if picking_dates:
-                        try: need_date_display = min(picking_dates).strftime('%Y-%m-%d')
-                        except: pass
-
-                    # 提取物料品號（正確格式化，避免科學記號）
-                    material_id = ""
-                    if col_material and pd.notna(row.get(col_material)):
-                        try:
-                            val = row.get(col_material)
-                            # 轉換為整數再轉字串，避免科學記號
-                            material_id = str(int(float(val)))
-                        except:
-                            material_id = str(val)[:20]
-                    
-                    # 提取品號說明
-                    material_desc = ""
-                    if col_desc and pd.notna(row.get(col_desc)):
-                        material_desc = str(row.get(col_desc))
-                    
-                    # 工廠分類邏輯
-                    # 三廠：電控外包='裝三課' 或 噴漆外包='噴6'
-                    # 本廠：其他所有工單
-                    factory = 'main'  # 預設為本廠
-                    elec_val = str(row.get(col_elec)) if col_elec and pd.notna(row.get(col_elec)) else ''
-                    paint_val = str(row.get(col_paint)) if col_paint and pd.notna(row.get(col_paint)) else ''
-                    
-                    if '裝三課' in elec_val or '噴6' in paint_val:
-                        factory = 'factory3'
-                    
-                    all_parsed_orders.append({
-                        '工單': wo_str if wo_str else "-",
-                        '訂單': order_str,
-                        '客戶': str(row.get(col_cust))[:20] if col_cust and pd.notna(row.get(col_cust)) else "",
-                        '工廠': factory,  # 新增工廠欄位
-                        '物料品號': material_id,
-                        '品號說明': material_desc,
-                        '生產開始': safe_date_str(row.get(col_start)) if col_start else "",
-                        '生產結束': safe_date_str(row.get(col_end)) if col_end else "",
-                        '需求日期': need_date_display,
-                        '特規備註': str(row.get(col_note)).strip() if col_note and pd.notna(row.get(col_note)) else "",
-                        '需求_底座': needs['底座'],
-                        '需求_工作台': needs['工作台'],
-                        '需求_橫樑': needs['橫樑'],
-                        '需求_立柱': needs['立柱']
-                    })
-                except: continue
-
-        # 排序：按工單號碼升序排列（舊工單在前，數字小在前）
-        all_parsed_orders.sort(key=lambda o: o['工單'], reverse=False)
+        # 定位欄位 - 直接使用準確的欄位名稱
+        col_wo = find_col(df, KW_WO)
+        col_order = find_col(df, KW_ORDER)
+        col_cust = find_col(df, KW_CUST)
+        col_material = '物料品號' if '物料品號' in df.columns else None  # 直接指定
+        col_desc = '品號說明' if '品號說明' in df.columns else None  # 直接指定
+        col_start = '生產開始' if '生產開始' in df.columns else None  # 直接指定
+        col_end = '生產結束' if '生產結束' in df.columns else None  # 直接指定
+        col_note = '特規備註' if '特規備註' in df.columns else None  # 直接指定
+        col_elec = '電控外包' if '電控外包' in df.columns else None  # 工廠分類用
+        col_paint = '噴漆外包' if '噴漆外包' in df.columns else None  # 工廠分類用
         
-        # 計算統計資料
-        today_str = datetime.now().strftime('%Y-%m-%d')
+        if col_start and col_start == col_end:
+            for c in df.columns:
+                if c != col_start and any(k in str(c) for k in ["結束", "Term"]):
+                    col_end = c; break
 
-        total_demand = {'底座': 0, '工作台': 0, '橫樑': 0, '立柱': 0}
-        for o in all_parsed_orders:
-            total_demand['底座'] += o['需求_底座']
-            total_demand['工作台'] += o['需求_工作台']
-            total_demand['橫樑'] += o['需求_橫樑']
-            total_demand['立柱'] += o['需求_立柱']
+        for _, row in df.iterrows():
+            try:
+                wo_val = row.get(col_wo) if col_wo else None
+                order_val = row.get(col_order) if col_order else None
+                
+                wo_str = clean_id(wo_val)
+                order_str = clean_id(order_val)
+                
+                if not wo_str and not order_str: continue
+                
+                # 過濾條件1：排除異常工單
+                if wo_str.startswith("70000"): continue  # 排除 70000 開頭
+                if any(k in wo_str for k in ['紅色', '黃色', '已出貨', '改單']): continue  # 排除顏色標記
+                if not wo_str.replace('.', '').isdigit(): continue  # 只保留數字工單號碼
+                
+                # 過濾條件2：必須有訂單號碼或客戶名稱
+                cust_val = row.get(col_cust) if col_cust else None
+                if not order_str and (not cust_val or pd.isna(cust_val) or str(cust_val).strip() == ''):
+                    continue  # 沒有訂單號碼且沒有客戶名稱，跳過
+                
+                # 建立唯一識別碼
+                id_key = wo_str
+                if id_key in seen_work_orders: continue
+                seen_work_orders.add(id_key)
+
+                needs = {'底座': 0, '工作台': 0, '橫樑': 0, '立柱': 0}
+                picking_dates = []
+                if order_str and order_str in picking_data:
+                    picked = picking_data[order_str]
+                    needs.update({k: int(v) for k, v in picked.items() if k != 'dates'})
+                    picking_dates = picked['dates']
+                
+                def safe_date_str(val):
+                    if pd.isna(val) or str(val).strip() == "": return ""
+                    try:
+                        if isinstance(val, (datetime, pd.Timestamp)): return val.strftime('%Y-%m-%d')
+                        return str(val).split(' ')[0]
+                    except: return ""
+
+                need_date_display = ""
+                if picking_dates:
+                    try: need_date_display = min(picking_dates).strftime('%Y-%m-%d')
+                    except: pass
+
+                # 提取物料品號（正確格式化，避免科學記號）
+                material_id = ""
+                if col_material and pd.notna(row.get(col_material)):
+                    try:
+                        val = row.get(col_material)
+                        # 轉換為整數再轉字串，避免科學記號
+                        material_id = str(int(float(val)))
+                    except:
+                        material_id = str(val)[:20]
+                
+                # 提取品號說明
+                material_desc = ""
+                if col_desc and pd.notna(row.get(col_desc)):
+                    material_desc = str(row.get(col_desc))
+                
+                # 工廠分類邏輯
+                # 三廠：電控外包='裝三課' 或 噴漆外包='噴6'
+                # 本廠：其他所有工單
+                factory = 'main'  # 預設為本廠
+                elec_val = str(row.get(col_elec)) if col_elec and pd.notna(row.get(col_elec)) else ''
+                paint_val = str(row.get(col_paint)) if col_paint and pd.notna(row.get(col_paint)) else ''
+                
+                if '裝三課' in elec_val or '噴6' in paint_val:
+                    factory = 'factory3'
+                
+                all_parsed_orders.append({
+                    '工單': wo_str if wo_str else "-",
+                    '訂單': order_str,
+                    '客戶': str(row.get(col_cust))[:20] if col_cust and pd.notna(row.get(col_cust)) else "",
+                    '工廠': factory,  # 新增工廠欄位
+                    '物料品號': material_id,
+                    '品號說明': material_desc,
+                    '生產開始': safe_date_str(row.get(col_start)) if col_start else "",
+                    '生產結束': safe_date_str(row.get(col_end)) if col_end else "",
+                    '需求日期': need_date_display,
+                    '特規備註': str(row.get(col_note)).strip() if col_note and pd.notna(row.get(col_note)) else "",
+                    '需求_底座': needs['底座'],
+                    '需求_工作台': needs['工作台'],
+                    '需求_橫樑': needs['橫樑'],
+                    '需求_立柱': needs['立柱']
+                })
+            except: continue
+
+    # 排序：按工單號碼升序排列（舊工單在前，數字小在前）
+    all_parsed_orders.sort(key=lambda o: o['工單'], reverse=False)
+    
+    # 計算統計資料
+    today_str = datetime.now().strftime('%Y-%m-%d')
+
+    total_demand = {'底座': 0, '工作台': 0, '橫樑': 0, '立柱': 0}
+    for o in all_parsed_orders:
+        total_demand['底座'] += o['需求_底座']
+        total_demand['工作台'] += o['需求_工作台']
+        total_demand['橫樑'] += o['需求_橫樑']
+        total_demand['立柱'] += o['需求_立柱']
+
+    in_progress = sum(1 for o in all_parsed_orders if o['生產結束'] and o['生產結束'] >= today_str)
+    
+    return {
+        'orders': all_parsed_orders,
+        'stats': {'total': len(all_parsed_orders), 'completed': len(all_parsed_orders) - in_progress, 'in_progress': in_progress},
+        'demand': total_demand
+    }
+
+
+# 工單依賴工單總表內容與撥料資料（撥料更新時需求數量也要跟著重算）
+registry.register('orders', _build_orders,
+                  inputs=[FileInput(lambda: current_app.config['WORKORDER_FILE']), DatasetInput('picking')],
+                  persist=SnapshotCodec(
+                      'orders.snap', 1,
+                      encode=lambda data: ({'orders': data['orders']}, {'stats': data['stats'], 'demand': data['demand']}),
+                      decode=lambda reader: {'orders': reader.records('orders'), **reader.meta}
+                  ))
 
-        in_progress = sum(1 for o in all_parsed_orders if o['生產結束'] and o['生產結束'] >= today_str)
-        
-        result = {
-            'orders': all_parsed_orders,
-            'stats': {'total': len(all_parsed_orders), 'completed': len(all_parsed_orders) - in_progress, 'in_progress': in_progress},
-            'demand': total_demand
-        }
-        
-        # 持久化結果到硬碟
-        try:
-            with open(cache_file, 'wb') as f:
-                pickle.dump({'mtime': mtime, 'data': result}, f)
-        except:
-            pass
-
-        # 更新快取
-        ORDERS_CACHE['mtime'] = mtime
-        ORDERS_CACHE['data'] = result
-        
-        return result
 
+def load_orders():
+    """載入工單總表資料並整合撥料需求 (含快取)"""
+    try:
+        return registry.get('orders')
     except Exception as e:
         print(f"Error loading all orders: {e}")
         return {'orders': [], 'stats': {}, 'demand': {}}
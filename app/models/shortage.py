@@ -8,19 +8,42 @@ from flask import current_app
 from datetime import datetime, timedelta
 import os
 import json
-import pickle
+from .cache_registry import registry, FileInput, DatasetInput
+from .snapshot_store import records_codec
+from .inventory import SHEET_MAP, changed_part_numbers
+from .model_names import normalize_model_name
+from .order import get_picking_raw_df
 
-# 缺料分析結果快取
-SHORTAGE_CACHE = {
-    'mtimes': (0, 0, 0),  # (casting_mtime, workorder_mtime, picking_mtime)
-    'data': None
-}
 
-# 未加工機型清單快取
-_UNPROCESSED_CACHE = {
-    'mtime': 0,
-    'data': {}  # {零件類型: set(機型名稱)}
-}
+def _unprocessed_file():
+    return os.path.join(os.getcwd(), '未加工機型.xlsx')
+
+def _overrides_file():
+    return os.path.join(os.path.dirname(__file__), 'shortage_overrides.json')
+
+def _build_unprocessed_models():
+    """讀取 未加工機型.xlsx（檔案不存在時為空）"""
+    excel_path = _unprocessed_file()
+    if not os.path.exists(excel_path):
+        return {}
+
+    result = {}
+    xls = pd.ExcelFile(excel_path, engine='openpyxl')
+    for sheet_name in xls.sheet_names:
+        df = xls.parse(sheet_name)
+        if df.empty or '機型' not in df.columns:
+            continue
+        models = set(str(v).strip() for v in df['機型'].dropna() if str(v).strip())
+        if models:
+            result[sheet_name.strip()] = models
+    
+    print(f"[未加工機型] 載入完成: {', '.join(f'{k}({len(v)}筆)' for k, v in result.items())}")
+    return result
+
+
+registry.register('unprocessed_models', _build_unprocessed_models,
+                  inputs=[FileInput(_unprocessed_file, optional=True)])
+
 
 def load_unprocessed_models():
     """從 未加工機型.xlsx 載入各零件類型的未加工機型清單
@@ -28,29 +51,8 @@ def load_unprocessed_models():
     Returns:
         dict: {零件類型: set(機型名稱)}，例如 {'底座': {'LG-500', 'MVP-11', ...}, '立柱': {...}}
     """
-    global _UNPROCESSED_CACHE
-    excel_path = os.path.join(os.getcwd(), '未加工機型.xlsx')
-    if not os.path.exists(excel_path):
-        return {}
     try:
-        mtime = os.path.getmtime(excel_path)
-        if _UNPROCESSED_CACHE['mtime'] == mtime and _UNPROCESSED_CACHE['data']:
-            return _UNPROCESSED_CACHE['data']
-        
-        result = {}
-        xls = pd.ExcelFile(excel_path, engine='openpyxl')
-        for sheet_name in xls.sheet_names:
-            df = xls.parse(sheet_name)
-            if df.empty or '機型' not in df.columns:
-                continue
-            models = set(str(v).strip() for v in df['機型'].dropna() if str(v).strip())
-            if models:
-                result[sheet_name.strip()] = models
-        
-        _UNPROCESSED_CACHE['mtime'] = mtime
-        _UNPROCESSED_CACHE['data'] = result
-        print(f"[未加工機型] 載入完成: {', '.join(f'{k}({len(v)}筆)' for k, v in result.items())}")
-        return result
+        return registry.get('unprocessed_models')
     except Exception as e:
         print(f"[未加工機型] 載入失敗: {e}")
         return {}
@@ -117,13 +119,9 @@ def get_workorder_picking_mapping(casting_inventory=None):
                 '零件需求': {}
             }
 
-        # ── 2. 撥料資料：呼叫 get_picking_data() 確保快取已填充 ──────
-        from ..models.order import PICKING_CACHE, get_picking_data
+        # ── 2. 撥料資料：與 get_picking_data() 共用同一版快取 ──────
         picking_file = current_app.config['PICKING_FILE']
-
-        # 先確保 PICKING_CACHE 已被填充（無論是否已初始化）
-        get_picking_data()
-        raw_df = PICKING_CACHE.get('raw_df')
+        raw_df = get_picking_raw_df()
         if raw_df is None or raw_df.empty:
             raw_df = pd.read_excel(picking_file, engine='calamine')
 
@@ -237,6 +235,205 @@ def get_casting_inventory():
         traceback.print_exc()
         return {}
 
+def _load_shortage_overrides():
+    """載入缺料手動排除清單"""
+    overrides_file = _overrides_file()
+    if os.path.exists(overrides_file):
+        try:
+            with open(overrides_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Error loading shortage_overrides: {e}")
+    return {}
+
+def _unprocessed_model_keys():
+    """未加工機型清單（用於標記），以標準化鍵比對，與鑄件盤點的機型寫法差異不影響判斷"""
+    return {part: {normalize_model_name(m) for m in models}
+            for part, models in load_unprocessed_models().items()}
+
+def _stock_fields(wo_number, part_type, special_note, demand_qty, picked_qty, stock, shortage_overrides, unprocessed_models):
+    """缺料紀錄中依鑄件庫存計算的欄位（庫存、缺料數量、狀態、未加工標記）
+
+    Args:
+        stock: 鑄件盤點中該品號的資料（get_casting_inventory 的值），不在盤點中為 None
+    """
+    # 從鑄件庫存取得現有庫存、在製品與素材
+    current_stock = 0
+    current_semi = 0
+    current_material = 0
+    if stock is not None:
+        current_stock = stock['庫存']
+        current_semi = stock.get('在製品', 0)
+        current_material = stock.get('素材', 0)
+    
+    # 計算目前缺料：需求數量 - 已領料（未考慮庫存）
+    current_shortage = demand_qty - picked_qty
+    
+    # 計算最終缺料：需求數量 - 已領料 - 現有庫存
+    final_shortage = demand_qty - picked_qty - current_stock
+
+    # 檢查是否有「手動排除」關鍵字（例如：工作台已給、工作台OK）
+    is_manually_cleared = False
+    if special_note:
+        note_upper = str(special_note).upper()
+        keywords = ["已給", "OK", "已領", "不必", "跳過", "免領"]
+        if any((part_type in note_upper and kw in note_upper) for kw in keywords) or \
+           any((f"{part_type}{kw}" in note_upper) for kw in keywords):
+            is_manually_cleared = True
+            
+    # 檢查 overrides.json 是否有手動銷帳
+    wo_str = str(wo_number)
+    if wo_str in shortage_overrides:
+        override_parts = shortage_overrides[wo_str].get("parts", [])
+        if "all" in override_parts or part_type in override_parts:
+            is_manually_cleared = True
+    
+    if is_manually_cleared:
+        final_shortage = 0
+        current_shortage = 0
+        status = '已領足'
+    else:
+        status = '已領足' if picked_qty >= demand_qty else ('庫存足' if final_shortage <= 0 else '缺料')
+
+    # 判斷是否為未加工機型
+    item_model = stock.get('機型', '') if stock is not None else ''
+    is_unprocessed = False
+    if unprocessed_models and item_model:
+        part_type_unprocessed = unprocessed_models.get(part_type, set())
+        # 支援機型欄位含逗號（多機型）的情況
+        for m in [x.strip() for x in item_model.split(',')]:
+            if normalize_model_name(m) in part_type_unprocessed:
+                is_unprocessed = True
+                break
+
+    return {
+        '機型': item_model,
+        '目前缺料': current_shortage if current_shortage > 0 else 0,
+        '現有庫存': current_stock,
+        '現有在製品': current_semi,
+        '現有素材': current_material,  # 素材數量，用於判斷是否為嚴重缺料
+        '缺料數量': final_shortage if final_shortage > 0 else 0,
+        '狀態': status,
+        '未加工': is_unprocessed
+    }
+
+def _sort_shortage(shortage_list):
+    """按生產開始日期升序（最早優先）、缺料數量降序、工單號碼升序排序"""
+    # 注意：有些生產開始可能是 NaT/None，需要處理
+    _FAR_FUTURE = datetime(9999, 12, 31)
+    def sort_key(x):
+        date_val = x['生產開始']
+        # 統一轉換成 datetime，空值排在最後
+        try:
+            if date_val is None or (hasattr(date_val, '__class__') and pd.isna(date_val)):
+                return (_FAR_FUTURE, -x['缺料數量'], x['工單號碼'])
+            dt = pd.Timestamp(date_val).to_pydatetime()
+            return (dt, -x['缺料數量'], x['工單號碼'])
+        except Exception:
+            return (_FAR_FUTURE, -x['缺料數量'], x['工單號碼'])
+
+    shortage_list.sort(key=sort_key)
+
+def _build_shortage():
+    """計算缺料清單（未經快取）"""
+    # 1. 先獲取鑄件庫存（作為品號過濾依據）
+    casting_inventory = get_casting_inventory()
+    
+    # 2. 獲取工單-撥料對應關係（只包含鑄件盤點中的品號）
+    workorder_map = get_workorder_picking_mapping(casting_inventory)
+    
+    print(f"鑄件庫存: {len(casting_inventory)} 個品號")
+    print(f"工單數量: {len(workorder_map)} 筆")
+    
+    shortage_overrides = _load_shortage_overrides()
+    unprocessed_models = _unprocessed_model_keys()
+
+    # 3. 計算缺料
+    shortage_list = []
+    
+    for wo_number, wo_data in workorder_map.items():
+        customer = wo_data['客戶名稱']
+        start_date = wo_data['生產開始']
+        end_date = wo_data['生產結束']
+        work_order_code = wo_data.get('工單編碼', '')
+        special_note = wo_data.get('特規備註', '')
+        
+        # 遍歷該工單的所有零件需求
+        for part_number, part_data in wo_data['零件需求'].items():
+            demand_qty = part_data['需求數量']
+            picked_qty = part_data['已領料']
+            
+            # 記錄所有有需求的項目
+            if demand_qty > 0:
+                part_type = part_data['零件類型']
+                record = {
+                    '工單號碼': wo_number,
+                    '工單編碼': work_order_code,
+                    '客戶名稱': customer,
+                    '生產開始': start_date,
+                    '生產結束': end_date,
+                    '品號': part_number,
+                    '機型': '',
+                    '物料說明': part_data['物料說明'],
+                    '零件類型': part_type,
+                    '需求數量': demand_qty,
+                    '已領料': picked_qty,
+                    '目前缺料': 0,
+                    '現有庫存': 0,
+                    '現有在製品': 0,
+                    '現有素材': 0,
+                    '缺料數量': 0,
+                    '特規備註': special_note,
+                    '狀態': '',
+                    '未加工': False
+                }
+                record.update(_stock_fields(wo_number, part_type, special_note, demand_qty, picked_qty,
+                                            casting_inventory.get(part_number), shortage_overrides, unprocessed_models))
+                shortage_list.append(record)
+    
+    _sort_shortage(shortage_list)
+    
+    print(f"缺料分析完成: 共 {len(shortage_list)} 筆記錄")
+    print(f"缺料項目: {len([x for x in shortage_list if x['缺料數量'] > 0])} 筆")
+    
+    return shortage_list
+
+
+def _shortage_delta(shortage_list, change):
+    """鑄件盤點寫入後的增量更新：只重算涉及品號的庫存欄位與狀態，工單與撥料資料沿用"""
+    part_numbers = changed_part_numbers(change)
+    if not any(record['品號'] in part_numbers for record in shortage_list):
+        return shortage_list
+
+    casting_inventory = get_casting_inventory()
+    shortage_overrides = _load_shortage_overrides()
+    unprocessed_models = _unprocessed_model_keys()
+    updated = []
+    for record in shortage_list:
+        if record['品號'] in part_numbers:
+            record = dict(record)
+            record.update(_stock_fields(record['工單號碼'], record['零件類型'], record['特規備註'],
+                                        record['需求數量'], record['已領料'], casting_inventory.get(record['品號']),
+                                        shortage_overrides, unprocessed_models))
+        updated.append(record)
+    _sort_shortage(updated)
+    return updated
+
+
+# 缺料分析依賴：各零件分頁明細、工單總表、撥料資料、未加工機型、手動排除清單
+registry.register('shortage', _build_shortage,
+                  inputs=[DatasetInput(f'part_details:{part}') for part in SHEET_MAP] + [
+                      FileInput(lambda: current_app.config['WORKORDER_FILE']),
+                      DatasetInput('picking'),
+                      DatasetInput('unprocessed_models'),
+                      FileInput(_overrides_file, optional=True)
+                  ],
+                  persist=records_codec('shortage.snap', 1),
+                  # 空 list 不快取，避免啟動競爭條件導致永久快取空結果
+                  cache_if=lambda data: len(data) > 0,
+                  delta=_shortage_delta)
+
+
 def calculate_shortage():
     """計算缺料清單（以工單號碼為主鍵）
     
@@ -257,196 +454,7 @@ def calculate_shortage():
         }]
     """
     try:
-        # 0. 檢查快取
-        casting_file = current_app.config['CASTING_FILE']
-        workorder_file = current_app.config['WORKORDER_FILE']
-        from ..models.order import PICKING_CACHE, get_picking_data
-        
-        # 確保撥料資料已載入 (這會觸發 API 抓取並更新 PICKING_CACHE['mtime'])
-        get_picking_data()
-        
-        current_mtimes = (0, 0, 0, 0)
-        try:
-            unprocessed_excel = os.path.join(os.getcwd(), '未加工機型.xlsx')
-            unprocessed_mtime = os.path.getmtime(unprocessed_excel) if os.path.exists(unprocessed_excel) else 0
-            current_mtimes = (
-                os.path.getmtime(casting_file),
-                os.path.getmtime(workorder_file),
-                PICKING_CACHE['mtime'],  # 使用 API 抓取時間標記
-                unprocessed_mtime        # 未加工機型 Excel 修改時間
-            )
-
-            
-            # 如果快取存在且有資料且檔案未修改，直接回傳
-            # 注意：空 list 不回傳快取，避免啟動競爭條件導致永久快取空結果
-            global SHORTAGE_CACHE
-            if (SHORTAGE_CACHE['data'] is not None and 
-                len(SHORTAGE_CACHE['data']) > 0 and
-                SHORTAGE_CACHE['mtimes'] == current_mtimes):
-                print("Returning cached shortage data")
-                return SHORTAGE_CACHE['data']
-            
-            # 嘗試讀取持久化快取
-            cache_dir = os.path.join(os.getcwd(), 'app', 'cache')
-            cache_file = os.path.join(cache_dir, 'shortage_cache.pkl')
-            if os.path.exists(cache_file):
-                try:
-                    with open(cache_file, 'rb') as f:
-                        cached = pickle.load(f)
-                    if cached.get('mtimes') == current_mtimes:
-                        SHORTAGE_CACHE['data'] = cached['data']
-                        SHORTAGE_CACHE['mtimes'] = current_mtimes
-                        return cached['data']
-                except:
-                    pass
-
-        except Exception as e:
-            print(f"Error checking mtimes: {e}")
-
-        # 1. 先獲取鑄件庫存（作為品號過濾依據）
-        casting_inventory = get_casting_inventory()
-        
-        # 2. 獲取工單-撥料對應關係（只包含鑄件盤點中的品號）
-        workorder_map = get_workorder_picking_mapping(casting_inventory)
-        
-        print(f"鑄件庫存: {len(casting_inventory)} 個品號")
-        print(f"工單數量: {len(workorder_map)} 筆")
-        
-        # 載入缺料手動排除清單
-        overrides_file = os.path.join(os.path.dirname(__file__), 'shortage_overrides.json')
-        shortage_overrides = {}
-        if os.path.exists(overrides_file):
-            try:
-                with open(overrides_file, 'r', encoding='utf-8') as f:
-                    shortage_overrides = json.load(f)
-            except Exception as e:
-                print(f"Error loading shortage_overrides: {e}")
-
-        # 載入未加工機型清單（用於標記）
-        unprocessed_models = load_unprocessed_models()
-
-        # 3. 計算缺料
-        shortage_list = []
-        
-        for wo_number, wo_data in workorder_map.items():
-            customer = wo_data['客戶名稱']
-            start_date = wo_data['生產開始']
-            end_date = wo_data['生產結束']
-            work_order_code = wo_data.get('工單編碼', '')
-            special_note = wo_data.get('特規備註', '')
-            
-            # 遍歷該工單的所有零件需求
-            for part_number, part_data in wo_data['零件需求'].items():
-                demand_qty = part_data['需求數量']
-                picked_qty = part_data['已領料']
-                part_desc = part_data['物料說明']
-                part_type = part_data['零件類型']
-                
-                # 從鑄件庫存取得現有庫存、在製品與素材
-                current_stock = 0
-                current_semi = 0
-                current_material = 0
-                if part_number in casting_inventory:
-                    current_stock = casting_inventory[part_number]['庫存']
-                    current_semi = casting_inventory[part_number].get('在製品', 0)
-                    current_material = casting_inventory[part_number].get('素材', 0)
-                
-                # 計算目前缺料：需求數量 - 已領料（未考慮庫存）
-                current_shortage = demand_qty - picked_qty
-                
-                # 計算最終缺料：需求數量 - 已領料 - 現有庫存
-                final_shortage = demand_qty - picked_qty - current_stock
-                
-                # 記錄所有有需求的項目
-                if demand_qty > 0:
-                    # 檢查是否有「手動排除」關鍵字（例如：工作台已給、工作台OK）
-                    is_manually_cleared = False
-                    if special_note:
-                        note_upper = str(special_note).upper()
-                        keywords = ["已給", "OK", "已領", "不必", "跳過", "免領"]
-                        if any((part_type in note_upper and kw in note_upper) for kw in keywords) or \
-                           any((f"{part_type}{kw}" in note_upper) for kw in keywords):
-                            is_manually_cleared = True
-                            
-                    # 檢查 overrides.json 是否有手動銷帳
-                    wo_str = str(wo_number)
-                    if wo_str in shortage_overrides:
-                        override_parts = shortage_overrides[wo_str].get("parts", [])
-                        if "all" in override_parts or part_type in override_parts:
-                            is_manually_cleared = True
-                    
-                    if is_manually_cleared:
-                        final_shortage = 0
-                        current_shortage = 0
-                        status = '已領足'
-                    else:
-                        status = '已領足' if picked_qty >= demand_qty else ('庫存足' if final_shortage <= 0 else '缺料')
-
-                    # 判斷是否為未加工機型
-                    item_model = casting_inventory[part_number].get('機型', '') if part_number in casting_inventory else ''
-                    is_unprocessed = False
-                    if unprocessed_models and item_model:
-                        part_type_unprocessed = unprocessed_models.get(part_type, set())
-                        # 支援機型欄位含逗號（多機型）的情況
-                        for m in [x.strip() for x in item_model.split(',')]:
-                            if m in part_type_unprocessed:
-                                is_unprocessed = True
-                                break
-
-                    shortage_list.append({
-                        '工單號碼': wo_number,
-                        '工單編碼': work_order_code,
-                        '客戶名稱': customer,
-                        '生產開始': start_date,
-                        '生產結束': end_date,
-                        '品號': part_number,
-                        '機型': item_model,
-                        '物料說明': part_desc,
-                        '零件類型': part_type,
-                        '需求數量': demand_qty,
-                        '已領料': picked_qty,
-                        '目前缺料': current_shortage if current_shortage > 0 else 0,
-                        '現有庫存': current_stock,
-                        '現有在製品': current_semi,
-                        '現有素材': current_material,  # 素材數量，用於判斷是否為嚴重缺料
-                        '缺料數量': final_shortage if final_shortage > 0 else 0,
-                        '特規備註': special_note,
-                        '狀態': status,
-                        '未加工': is_unprocessed
-                    })
-        
-        # 按生產開始日期升序（最早優先）、缺料數量降序、工單號碼升序排序
-        # 注意：有些生產開始可能是 NaT/None，需要處理
-        _FAR_FUTURE = datetime(9999, 12, 31)
-        def sort_key(x):
-            date_val = x['生產開始']
-            # 統一轉換成 datetime，空值排在最後
-            try:
-                if date_val is None or (hasattr(date_val, '__class__') and pd.isna(date_val)):
-                    return (_FAR_FUTURE, -x['缺料數量'], x['工單號碼'])
-                dt = pd.Timestamp(date_val).to_pydatetime()
-                return (dt, -x['缺料數量'], x['工單號碼'])
-            except Exception:
-                return (_FAR_FUTURE, -x['缺料數量'], x['工單號碼'])
-
-        shortage_list.sort(key=sort_key)
-        
-        print(f"缺料分析完成: 共 {len(shortage_list)} 筆記錄")
-        print(f"缺料項目: {len([x for x in shortage_list if x['缺料數量'] > 0])} 筆")
-        
-        # 更新快取
-        SHORTAGE_CACHE['mtimes'] = current_mtimes
-        SHORTAGE_CACHE['data'] = shortage_list
-        
-        try:
-            with open(cache_file, 'wb') as f:
-                pickle.dump({'mtimes': current_mtimes, 'data': shortage_list}, f)
-        except:
-            pass
-            
-        return shortage_list
-
-    
+        return registry.get('shortage')
     except Exception as e:
         print(f"Error calculating shortage: {e}")
         import traceback
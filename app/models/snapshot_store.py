@@ -0,0 +1,396 @@
+"""
+欄式快照檔 (.snap)
+取代 app/cache/*.pkl：不依賴 pandas / pickle 的內部格式，升級套件後仍可讀取。
+
+檔案結構：
+    MAGIC (8 bytes) | 表頭長度 (uint64) | 表頭 JSON | 各欄位資料區塊 (64 bytes 對齊)
+
+表頭記錄格式版本、資料集 schema 版本、來源指紋 (快取鍵)、metadata 及每個欄位的型別與位置。
+數值欄位以原始 little-endian 陣列存放；文字欄位存成一段 UTF-8 加上字元位移表。
+讀取時先只解析表頭確認版本與指紋，符合才由資料集的 decode 一次還原成 list / DataFrame（讀完即關閉檔案）；
+快取的使用者直接操作一般的 list of dict 與 DataFrame，因此不保留延遲解碼的物件。
+"""
+import json
+import mmap
+import os
+import struct
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+
+MAGIC = b'MESSNAP\x00'
+FORMAT_VERSION = 1
+_ALIGN = 64
+
+# 空值代碼：0 有值, 1 None, 2 NaN/NaT, 3 缺少此欄位 (僅 records)
+_VALUE, _NONE, _NAN, _MISSING = 0, 1, 2, 3
+
+
+class SnapshotCodec:
+    """資料集與快照檔之間的轉換
+
+    Args:
+        filename: app/cache 下的檔名
+        schema: 資料集結構版本，結構改變時遞增，舊檔會被視為失效
+        encode: data -> (tables, meta)；tables 為 {名稱: list of dict 或 DataFrame}，meta 需可轉為 JSON
+        decode: SnapshotReader -> data
+    """
+
+    def __init__(self, filename, schema, encode, decode):
+        self.filename = filename
+        self.schema = schema
+        self.encode = encode
+        self.decode = decode
+
+
+# ── 編碼 ─────────────────────────────────────────────────────────────
+
+def _is_nan(val):
+    return isinstance(val, float) and val != val
+
+
+def _json_safe(val):
+    if val is None or isinstance(val, (str, bool, int, float)):
+        return True
+    if isinstance(val, list):
+        return all(_json_safe(v) for v in val)
+    if isinstance(val, dict):
+        return all(isinstance(k, str) and _json_safe(v) for k, v in val.items())
+    return False
+
+
+def _null_code(val):
+    if val is _MISSING_SENTINEL:
+        return _MISSING
+    if val is None:
+        return _NONE
+    if _is_nan(val) or val is pd.NaT:
+        return _NAN
+    return _VALUE
+
+
+_MISSING_SENTINEL = object()
+
+
+def _infer_kind(values):
+    """依實際值決定欄位型別（空值不參與判斷）"""
+    types = set()
+    for v in values:
+        if _null_code(v) != _VALUE:
+            continue
+        types.add(type(v))
+    if not types:
+        return 'str'
+    if types == {bool}:
+        return 'bool'
+    if types <= {int, np.int64}:
+        return 'int'
+    if types <= {float, np.float64}:
+        return 'float'
+    if types <= {int, float, np.int64, np.float64}:
+        return 'num'
+    if types == {str}:
+        return 'str'
+    if types == {pd.Timestamp}:
+        return 'timestamp'
+    if types == {datetime}:
+        return 'datetime'
+    if types == {list} and all(isinstance(x, pd.Timestamp) for v in values if isinstance(v, list) for x in v):
+        return 'timestamp_list'
+    if all(_json_safe(v) for v in values if _null_code(v) == _VALUE):
+        return 'json'
+    raise TypeError(f"不支援的欄位型別: {sorted(t.__name__ for t in types)}")
+
+
+def _encode_strings(strings):
+    """[str] -> (字元位移 int64, UTF-8 bytes)"""
+    lengths = np.fromiter((len(s) for s in strings), dtype='int64', count=len(strings))
+    offsets = np.zeros(len(strings) + 1, dtype='int64')
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets, np.frombuffer(''.join(strings).encode('utf-8'), dtype='uint8')
+
+
+def _timestamp_ns(val):
+    return pd.Timestamp(val).value
+
+
+def _encode_values(kind, values):
+    """回傳 {部位名稱: ndarray}"""
+    nulls = np.fromiter((_null_code(v) for v in values), dtype='uint8', count=len(values))
+    present = nulls == _VALUE
+    parts = {}
+    if nulls.any():
+        parts['nulls'] = nulls
+
+    def fill(default):
+        return [v if ok else default for v, ok in zip(values, present)]
+
+    if kind == 'bool':
+        parts['values'] = np.array(fill(False), dtype='uint8')
+    elif kind == 'int':
+        parts['values'] = np.array(fill(0), dtype='int64')
+    elif kind == 'float':
+        parts['values'] = np.array(fill(0.0), dtype='float64')
+    elif kind == 'num':
+        filled = fill(0)
+        parts['values'] = np.array(filled, dtype='float64')
+        parts['is_int'] = np.array([isinstance(v, (int, np.int64)) for v in filled], dtype='uint8')
+        if not np.array_equal(parts['values'][parts['is_int'] == 1],
+                              np.array([v for v in filled if isinstance(v, (int, np.int64))], dtype='int64')):
+            raise TypeError("整數超出 float64 可精確表示的範圍")
+    elif kind in ('timestamp', 'datetime'):
+        parts['values'] = np.array([_timestamp_ns(v) if ok else 0 for v, ok in zip(values, present)], dtype='int64')
+    elif kind == 'timestamp_list':
+        lists = fill([])
+        lengths = np.fromiter((len(v) for v in lists), dtype='int64', count=len(lists))
+        offsets = np.zeros(len(lists) + 1, dtype='int64')
+        np.cumsum(lengths, out=offsets[1:])
+        parts['offsets'] = offsets
+        parts['values'] = np.array([x.value for v in lists for x in v], dtype='int64')
+    elif kind in ('str', 'json'):
+        strings = fill('')
+        if kind == 'json':
+            strings = [json.dumps(v, ensure_ascii=False) if ok else '' for v, ok in zip(values, present)]
+        uniques = {}
+        codes = [uniques.setdefault(v, len(uniques)) for v in strings]
+        if len(uniques) * 2 <= len(strings):
+            # 重複值多的文字欄 (例如物料說明) 改存字典 + 代碼，解碼時不必逐格切字串
+            parts['codes'] = np.array(codes, dtype='int32')
+            strings = list(uniques)
+        parts['offsets'], parts['data'] = _encode_strings(strings)
+    return parts
+
+
+def _encode_records(records):
+    """list of dict -> [(欄位名稱, 型別, 部位)]，欄位順序依第一次出現的順序"""
+    names = {}
+    for r in records:
+        for k in r:
+            names.setdefault(k, None)
+    columns = []
+    for name in names:
+        if not isinstance(name, str):
+            raise TypeError(f"欄位名稱必須為字串: {name!r}")
+        values = [r.get(name, _MISSING_SENTINEL) for r in records]
+        kind = _infer_kind(values)
+        columns.append((name, kind, _encode_values(kind, values)))
+    return columns
+
+
+def _encode_frame(df):
+    if not isinstance(df.index, pd.RangeIndex) or df.index.start != 0 or df.index.step != 1:
+        raise TypeError("DataFrame 需為預設 RangeIndex")
+    columns = []
+    for i, name in enumerate(df.columns):
+        if not isinstance(name, str):
+            raise TypeError(f"欄位名稱必須為字串: {name!r}")
+        col = df.iloc[:, i]
+        dtype = col.dtype
+        if dtype == 'bool':
+            columns.append((name, 'frame_bool', {'values': col.to_numpy(dtype='uint8')}))
+        elif dtype == 'int64':
+            columns.append((name, 'frame_int64', {'values': col.to_numpy()}))
+        elif dtype == 'float64':
+            columns.append((name, 'frame_float64', {'values': col.to_numpy()}))
+        elif dtype == 'datetime64[ns]':
+            columns.append((name, 'frame_datetime64', {'values': col.to_numpy().view('int64')}))
+        elif dtype == object:
+            values = col.tolist()
+            kind = _infer_kind(values)
+            columns.append((name, kind, _encode_values(kind, values)))
+        else:
+            raise TypeError(f"不支援的 DataFrame 欄位型別: {name} {dtype}")
+    return columns
+
+
+def write_snapshot(path, codec, key, data):
+    """將資料集寫成快照檔（先寫暫存檔再原子替換，讀取者不會看到寫一半的檔案）"""
+    tables, meta = codec.encode(data)
+    header = {
+        'format': FORMAT_VERSION, 'schema': codec.schema, 'key': key, 'meta': meta,
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'tables': {}
+    }
+    blobs = []
+    offset = 0
+    for table_name, table in tables.items():
+        if isinstance(table, pd.DataFrame):
+            table_type, rows, columns = 'frame', len(table), _encode_frame(table)
+        else:
+            table_type, rows, columns = 'records', len(table), _encode_records(table)
+        col_headers = []
+        for name, kind, parts in columns:
+            part_headers = {}
+            for part_name, arr in parts.items():
+                arr = np.ascontiguousarray(arr)
+                part_headers[part_name] = {'dtype': arr.dtype.str, 'count': int(arr.size), 'offset': offset}
+                blobs.append((offset, arr))
+                offset += -(-arr.nbytes // _ALIGN) * _ALIGN
+            col_headers.append({'name': name, 'kind': kind, 'parts': part_headers})
+        header['tables'][table_name] = {'type': table_type, 'rows': rows, 'columns': col_headers}
+
+    header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // _ALIGN) * _ALIGN
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for blob_offset, arr in blobs:
+            f.seek(data_start + blob_offset)
+            f.write(arr.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+# ── 解碼 ─────────────────────────────────────────────────────────────
+
+class SnapshotReader:
+    """唯讀快照；透過 mmap 直接從檔案解碼欄位（只解碼 decode 用到的欄位，不先讀入整個檔案）"""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self._mm[:len(MAGIC)] != MAGIC:
+                raise ValueError("不是快照檔 (magic 不符)")
+            (header_len,) = struct.unpack_from('<Q', self._mm, len(MAGIC))
+            header_start = len(MAGIC) + 8
+            self.header = json.loads(self._mm[header_start:header_start + header_len].decode('utf-8'))
+            self._data_start = -(-(header_start + header_len) // _ALIGN) * _ALIGN
+        except Exception:
+            self.close()
+            raise
+        self.key = self.header.get('key')
+        self.meta = self.header.get('meta')
+        self._columns = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        mm = getattr(self, '_mm', None)
+        if mm is not None:
+            self._mm = None
+            try:
+                mm.close()
+            except BufferError:
+                pass  # 仍有陣列參照 mmap，交由 GC 關閉
+        self._file.close()
+
+    def tables(self):
+        return list(self.header['tables'])
+
+    def rows(self, table):
+        return self.header['tables'][table]['rows']
+
+    def column_names(self, table):
+        return [c['name'] for c in self.header['tables'][table]['columns']]
+
+    def _part(self, part):
+        """回傳 mmap 上的陣列（不複製；只在解碼期間使用）"""
+        return np.frombuffer(self._mm, dtype=np.dtype(part['dtype']), count=part['count'],
+                             offset=self._data_start + part['offset'])
+
+    def _strings(self, parts):
+        offsets = self._part(parts['offsets']).tolist()
+        text = self._part(parts['data']).tobytes().decode('utf-8')
+        strings = [text[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+        if 'codes' in parts:
+            strings = np.array(strings, dtype=object)[self._part(parts['codes'])].tolist()
+        return strings
+
+    def _timestamps(self, part):
+        return pd.DatetimeIndex(self._part(part).view('datetime64[ns]')).tolist()
+
+    def column(self, table, name):
+        """解碼單一欄位為 Python list (records) 或 ndarray / list (frame)，結果會保留供重複存取"""
+        cache_key = (table, name)
+        if cache_key in self._columns:
+            return self._columns[cache_key]
+        spec = self.header['tables'][table]
+        col = next(c for c in spec['columns'] if c['name'] == name)
+        values = self._decode_column(col['kind'], col['parts'], spec['rows'])
+        self._columns[cache_key] = values
+        return values
+
+    def _decode_column(self, kind, parts, rows):
+        if kind.startswith('frame_'):
+            arr = self._part(parts['values']).copy()
+            if kind == 'frame_bool':
+                return arr.astype(bool)
+            if kind == 'frame_datetime64':
+                return arr.view('datetime64[ns]')
+            return arr
+
+        if kind in ('str', 'json'):
+            values = self._strings(parts)
+            if kind == 'json':
+                values = [json.loads(v) if v else None for v in values]
+        elif kind == 'bool':
+            values = [bool(v) for v in self._part(parts['values']).tolist()]
+        elif kind in ('int', 'float'):
+            values = self._part(parts['values']).tolist()
+        elif kind == 'num':
+            nums = self._part(parts['values']).tolist()
+            is_int = self._part(parts['is_int']).tolist()
+            values = [int(v) if flag else v for v, flag in zip(nums, is_int)]
+        elif kind == 'timestamp':
+            values = self._timestamps(parts['values'])
+        elif kind == 'datetime':
+            values = [v.to_pydatetime() for v in self._timestamps(parts['values'])]
+        elif kind == 'timestamp_list':
+            offsets = self._part(parts['offsets']).tolist()
+            flat = self._timestamps(parts['values'])
+            values = [flat[offsets[i]:offsets[i + 1]] for i in range(rows)]
+        else:
+            raise ValueError(f"未知的欄位型別: {kind}")
+
+        if 'nulls' in parts:
+            nulls = self._part(parts['nulls']).tolist()
+            fill = {_NONE: None, _NAN: pd.NaT if kind in ('timestamp', 'datetime') else float('nan'),
+                    _MISSING: _MISSING_SENTINEL}
+            values = [v if n == _VALUE else fill[n] for v, n in zip(values, nulls)]
+        return values
+
+    def records(self, table):
+        """還原 list of dict（欄位順序與寫入時相同，缺少的欄位不會出現）"""
+        names = self.column_names(table)
+        columns = [self.column(table, name) for name in names]
+        missing = _MISSING_SENTINEL
+        return [{name: v for name, v in zip(names, row) if v is not missing}
+                for row in zip(*columns)] if columns else [{} for _ in range(self.rows(table))]
+
+    def frame(self, table):
+        """還原 DataFrame（文字欄為 object dtype）"""
+        names = self.column_names(table)
+        data = {}
+        for name in names:
+            values = self.column(table, name)
+            data[name] = values if isinstance(values, np.ndarray) else pd.Series(values, dtype=object)
+        return pd.DataFrame(data, columns=names, index=pd.RangeIndex(self.rows(table)))
+
+
+def read_snapshot(path, codec, key):
+    """讀取快照；格式、schema 或來源指紋不符時回傳 None"""
+    with SnapshotReader(path) as reader:
+        header = reader.header
+        if header.get('format') != FORMAT_VERSION or header.get('schema') != codec.schema:
+            print(f"[Snapshot] {os.path.basename(path)} 版本不符 "
+                  f"(format {header.get('format')}, schema {header.get('schema')})，改為重建")
+            return None
+        if reader.key != key:
+            return None
+        return codec.decode(reader)
+
+
+def records_codec(filename, schema):
+    """list of dict 資料集（例如缺料清單）的快照轉換"""
+    return SnapshotCodec(filename, schema,
+                         encode=lambda data: ({'rows': data}, None),
+                         decode=lambda reader: reader.records('rows'))
@@ -0,0 +1,325 @@
+"""
+鑄件盤點資料.xlsx 共用解析快照
+同一版本（內容雜湊）的檔案只開啟、解析一次，所有讀取者（總表、零件明細、歷程回補、出入庫）共用
+檔案變更時以 zip 目錄中各分頁成員的 CRC / 大小判斷哪些分頁有變動，只重新解析變動的分頁
+尚未寫回檔案的修改（寫入日誌）以覆蓋層套用在對應分頁上，讀取者看到的是檔案加上待寫回修改的結果
+檔案只讀入一次：指紋、分頁目錄與解析都取自同一份內容（同一世代），不會讀到寫入中的不完整檔案
+"""
+import pandas as pd
+from flask import current_app
+import copy
+import io
+import os
+import posixpath
+import threading
+import zipfile
+from collections import namedtuple
+from functools import partial
+import xml.etree.ElementTree as ET
+from .fingerprint import file_fingerprint, read_generation
+from .cache_registry import registry, FileInput, TagInput
+
+# 讀取引擎依序嘗試：calamine 比 openpyxl 快數倍，讀取失敗時退回 openpyxl
+DEFAULT_READER_ENGINES = ('calamine', 'openpyxl')
+
+
+def _normalize_value(val):
+    """統一各引擎的儲存格表示：整數值的浮點數轉為 int，純空白字串視為空值"""
+    if isinstance(val, float) and val.is_integer():
+        return int(val)
+    if isinstance(val, str) and not val.strip():
+        return None
+    return val
+
+
+def _normalize_frame(df):
+    """消除引擎間的差異（表頭與文字欄的 NaN / 整數表示），數值欄維持原 dtype"""
+    df.columns = [_normalize_value(c) if isinstance(c, float) else c for c in df.columns]
+    for col_idx, dtype in enumerate(df.dtypes):
+        if dtype == object:
+            df.isetitem(col_idx, df.iloc[:, col_idx].map(_normalize_value))
+    return df
+
+
+def read_workbook_frames(path, engines=DEFAULT_READER_ENGINES, reuse=None, data=None):
+    """依序嘗試各讀取引擎解析所有分頁
+
+    Args:
+        reuse: {分頁索引: DataFrame}，這些分頁沿用既有結果不重新解析
+        data: 已讀入的檔案內容（read_generation），提供時解析這份內容而不重新開檔
+
+    Returns:
+        tuple: (使用的引擎, 分頁名稱 tuple, DataFrame tuple)
+    """
+    reuse = reuse or {}
+    last_error = None
+    for engine in engines:
+        try:
+            with pd.ExcelFile(io.BytesIO(data) if data is not None else path, engine=engine) as xl:
+                sheet_names = tuple(xl.sheet_names)
+                frames = tuple(reuse[idx] if idx in reuse else _normalize_frame(pd.read_excel(xl, sheet_name=name))
+                               for idx, name in enumerate(sheet_names))
+            return engine, sheet_names, frames
+        except Exception as e:
+            print(f"[Workbook] {engine} 讀取 {os.path.basename(path)} 失敗: {e}")
+            last_error = e
+    raise last_error
+
+
+# 所有分頁共用的成員：內容變動會改變每個分頁的解析結果（共用字串索引、數值格式）
+_SHARED_MEMBERS = ('xl/sharedStrings.xml', 'xl/styles.xml', 'xl/workbook.xml')
+
+_NS_MAIN = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_NS_REL = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_NS_PKG_REL = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+# {abspath: (檔案指紋, 各分頁識別 tuple)}
+_SHEET_IDENTITIES = {}
+
+
+def sheet_members(zf):
+    """活頁簿各分頁的 (名稱, zip 成員路徑)，依分頁順序"""
+    workbook = ET.fromstring(zf.read('xl/workbook.xml'))
+    rels = ET.fromstring(zf.read('xl/_rels/workbook.xml.rels'))
+
+    targets = {}
+    for rel in rels.iter(f'{_NS_PKG_REL}Relationship'):
+        target = rel.get('Target', '')
+        # Target 可能是絕對路徑 (/xl/worksheets/sheet1.xml) 或相對於 xl/
+        member = target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+        targets[rel.get('Id')] = member
+    return [(sheet.get('name'), targets[sheet.get(f'{_NS_REL}id')])
+            for sheet in workbook.iter(f'{_NS_MAIN}sheet')]
+
+
+def _read_sheet_identities(source):
+    with zipfile.ZipFile(source) as zf:
+        infos = {info.filename: info for info in zf.infolist()}
+        members = sheet_members(zf)
+
+    shared = tuple((name, infos[name].CRC, infos[name].file_size) if name in infos else (name, None, None)
+                   for name in _SHARED_MEMBERS)
+    return tuple((name, infos[member].CRC, infos[member].file_size, shared) for name, member in members)
+
+
+def sheet_identities(path):
+    """各分頁的識別 (名稱, 成員 CRC, 成員大小, 共用成員識別)，依活頁簿分頁順序
+
+    只讀 zip 目錄與 workbook.xml，不解壓分頁內容；無法判讀（非 xlsx）時回傳 None
+    """
+    path = os.path.abspath(path)
+    fingerprint = file_fingerprint(path)
+    memo = _SHEET_IDENTITIES.get(path)
+    if memo is not None and memo[0] == fingerprint:
+        return memo[1]
+    try:
+        identities = _read_sheet_identities(path)
+    except Exception as e:
+        print(f"[Workbook] 無法讀取 {os.path.basename(path)} 的分頁目錄: {e}")
+        identities = None
+    _SHEET_IDENTITIES[path] = (fingerprint, identities)
+    return identities
+
+
+def _check_complete(data):
+    """read_generation 的驗證：空檔或 zip 目錄不完整（寫入中）時拋出例外"""
+    if not data:
+        raise ValueError('檔案內容為空')
+    if data[:2] == b'PK':
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            zf.getinfo('xl/workbook.xml')
+
+
+def read_workbook_generation(path):
+    """讀入活頁簿的一個完整世代
+
+    Returns:
+        tuple: (檔案內容 bytes, 內容雜湊, 世代編號, 各分頁識別)
+    """
+    path = os.path.abspath(path)
+    data, fingerprint, generation = read_generation(path, validate=_check_complete)
+    try:
+        identities = _read_sheet_identities(io.BytesIO(data))
+    except Exception as e:
+        print(f"[Workbook] 無法讀取 {os.path.basename(path)} 的分頁目錄: {e}")
+        identities = None
+    _SHEET_IDENTITIES[path] = (fingerprint, identities)
+    return data, fingerprint, generation, identities
+
+
+def sheet_identity(path, sheet_idx):
+    """單一分頁的識別；無法判讀分頁目錄時退回整個檔案的指紋"""
+    identities = sheet_identities(path)
+    if identities is None or sheet_idx >= len(identities):
+        return file_fingerprint(path)
+    return identities[sheet_idx]
+
+
+# 尚未寫回檔案的修改：fn(path) -> {分頁索引: (識別, 套用函式 fn(DataFrame 副本) -> DataFrame)}
+_overlay_source = None
+
+
+def set_overlay_source(fn):
+    """註冊待寫回修改的來源（由寫入日誌的使用者註冊）"""
+    global _overlay_source
+    _overlay_source = fn
+
+
+def _overlays(path):
+    return _overlay_source(path) if _overlay_source is not None else {}
+
+
+class WorkbookSnapshot:
+    """不可變的活頁簿快照
+
+    建立時一次解析所有分頁，之後只提供唯讀存取。
+    sheet() 回傳的 DataFrame 由所有讀取者共用，需要修改時請先 .copy()。
+    傳入 previous 時，分頁識別未變的分頁直接沿用上一版的 DataFrame 與衍生結果。
+    overlays 為 {分頁索引: (識別, 套用函式)}，套用在檔案內容上，識別相同時沿用上一版的套用結果。
+    identity / generation 為建立時讀入的檔案內容雜湊與世代編號（fingerprint.read_generation）。
+    """
+
+    def __init__(self, path, engines=DEFAULT_READER_ENGINES, previous=None, overlays=None):
+        self.path = path
+        data = None
+        if (previous is not None and previous.path == path and previous.sheet_identities is not None
+                and file_fingerprint(path) == previous.identity):
+            # 檔案未變更（只有覆蓋層變更）：沿用上一版的世代，不讀檔
+            self.identity, self.generation = previous.identity, previous.generation
+            self.sheet_identities = previous.sheet_identities
+        else:
+            data, self.identity, self.generation, self.sheet_identities = read_workbook_generation(path)
+        overlays = overlays or {}
+        self.overlay_tokens = {idx: token for idx, (token, _) in overlays.items()}
+
+        unchanged = self._reusable_sheets(previous)
+        if previous is not None and unchanged and len(unchanged) == len(previous._base_frames):
+            # 只有覆蓋層變更：不開啟檔案
+            self.engine, self.sheet_names, self._base_frames = previous.engine, previous.sheet_names, previous._base_frames
+        else:
+            self.engine, self.sheet_names, self._base_frames = read_workbook_frames(
+                path, engines, reuse={idx: previous._base_frames[idx] for idx in unchanged}, data=data)
+
+        # 檔案內容與覆蓋層都未變更的分頁，沿用上一版的結果
+        reused = [idx for idx in unchanged
+                  if previous.overlay_tokens.get(idx) == self.overlay_tokens.get(idx)]
+        frames = list(self._base_frames)
+        for idx, (_, apply_fn) in overlays.items():
+            if idx < len(frames):
+                frames[idx] = previous._frames[idx] if idx in reused else apply_fn(frames[idx].copy())
+        self._frames = tuple(frames)
+        self.reused_sheets = tuple(reused)
+
+        self._rows = {idx: rows for idx, rows in previous._rows.items() if idx in reused} if reused else {}
+        self._derived = {k: v for k, v in previous._derived.items() if k[0] in reused} if reused else {}
+        self._rows_lock = threading.Lock()
+
+    def _reusable_sheets(self, previous):
+        if previous is None or previous.path != self.path:
+            return []
+        old, new = previous.sheet_identities, self.sheet_identities
+        if old is None or new is None or len(old) != len(new):
+            return []
+        return [idx for idx, ident in enumerate(new) if ident == old[idx]]
+
+    def with_sheets(self, frames):
+        """只替換部分分頁內容的新快照（寫入者已算出覆蓋層變更後的結果），其餘分頁與衍生結果沿用
+
+        Args:
+            frames: {分頁索引: (覆蓋層識別, DataFrame)}
+        """
+        snapshot = copy.copy(self)
+        snapshot.overlay_tokens = dict(self.overlay_tokens)
+        new_frames = list(self._frames)
+        for idx, (token, frame) in frames.items():
+            if token is None:
+                snapshot.overlay_tokens.pop(idx, None)
+            else:
+                snapshot.overlay_tokens[idx] = token
+            new_frames[idx] = frame
+        snapshot._frames = tuple(new_frames)
+        snapshot.reused_sheets = tuple(idx for idx in range(len(new_frames)) if idx not in frames)
+        snapshot._rows = {idx: rows for idx, rows in self._rows.items() if idx not in frames}
+        snapshot._derived = {k: v for k, v in self._derived.items() if k[0] not in frames}
+        snapshot._rows_lock = threading.Lock()
+        return snapshot
+
+    def sheet(self, sheet):
+        """依分頁索引或名稱取得已解析的 DataFrame"""
+        if isinstance(sheet, str):
+            sheet = self.sheet_names.index(sheet)
+        return self._frames[sheet]
+
+    def rows(self, sheet):
+        """依分頁取得列資料 (tuple of tuples)，適合只需逐列掃描的讀取者"""
+        if isinstance(sheet, str):
+            sheet = self.sheet_names.index(sheet)
+        rows = self._rows.get(sheet)
+        if rows is None:
+            with self._rows_lock:
+                rows = self._rows.get(sheet)
+                if rows is None:
+                    rows = tuple(self._frames[sheet].itertuples(index=False, name=None))
+                    self._rows[sheet] = rows
+        return rows
+
+    def derived(self, sheet, name, fn):
+        """取得由單一分頁衍生的結果（例如彙總），fn(DataFrame) 只在該分頁變更後計算一次
+
+        結果跟著分頁沿用到下一版快照，呼叫者不可修改回傳值。
+        """
+        if isinstance(sheet, str):
+            sheet = self.sheet_names.index(sheet)
+        key = (sheet, name)
+        if key not in self._derived:
+            value = fn(self._frames[sheet])
+            with self._rows_lock:
+                self._derived.setdefault(key, value)
+        return self._derived[key]
+
+
+def casting_file_path():
+    return current_app.config['CASTING_FILE']
+
+def _sheet_key(path, sheet_idx):
+    overlay = _overlays(path).get(sheet_idx)
+    return sheet_identity(path, sheet_idx), overlay[0] if overlay else None
+
+def casting_sheet_key(sheet_idx):
+    """鑄件盤點資料單一分頁的快取鍵（含待寫回修改），供只依賴一個分頁的資料集使用"""
+    return partial(_sheet_key, sheet_idx=sheet_idx)
+
+def casting_overlay_key():
+    """鑄件盤點資料待寫回修改的識別，與檔案指紋一起作為快取鍵"""
+    overlays = _overlays(os.path.abspath(casting_file_path()))
+    return tuple(sorted((idx, token) for idx, (token, _) in overlays.items()))
+
+def _build_casting_snapshot():
+    path = os.path.abspath(casting_file_path())
+    engines = current_app.config.get('CASTING_READER_ENGINES', DEFAULT_READER_ENGINES)
+    # 以上一版快照（即使已因寫入而失效）為基礎，只重新解析變動的分頁
+    previous = registry.peek('casting_workbook')
+    return WorkbookSnapshot(path, engines, previous, _overlays(path))
+
+
+# 寫入者已知的分頁變更（registry.apply_change 的 change）：
+# before / after 為修改前後的快照，rows 為 {分頁索引: [修改的列位置（含新增的列）]}
+SheetChange = namedtuple('SheetChange', ['before', 'after', 'rows'])
+
+
+def _snapshot_delta(snapshot, change):
+    return change.after if snapshot is change.before else None
+
+
+# 快照只存在記憶體；同時有多個讀取者時只解析一次，其餘等待後共用結果
+registry.register('casting_workbook', _build_casting_snapshot,
+                  inputs=[FileInput(casting_file_path), TagInput(casting_overlay_key)],
+                  delta=_snapshot_delta)
+
+
+def get_casting_snapshot(fresh=False):
+    """取得鑄件盤點資料的快照；檔案未變更時直接回傳同一個物件
+
+    fresh=True 時不接受過期的版本，等待與檔案目前內容一致的快照（寫入者使用）
+    """
+    return registry.get('casting_workbook', stale_ok=not fresh)
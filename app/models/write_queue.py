@@ -0,0 +1,142 @@
+"""
+活頁簿的單一寫入佇列
+同一個檔案的所有修改（儲存格修改、出入庫、歷程回寫、背景寫回、借還吊具）交給該檔案專屬的寫入執行緒依序執行，
+每個修改看到的都是前一個修改完成後的內容（可線性化），不需要在整個請求外加全域鎖。
+佇列有上限：佇列已滿時呼叫者最多等待 SUBMIT_TIMEOUT 秒，逾時拋出 WriteQueueFull（回應系統忙碌），
+請求不會無限堆積；佇列深度與等待 / 執行時間統計於 stats()。
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from flask import current_app, has_app_context
+
+
+class WriteQueueFull(Exception):
+    """寫入佇列已滿（呼叫者應請使用者稍後再試）"""
+
+
+class _Task:
+    def __init__(self, fn, args, kwargs, app):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.app = app
+        self.future = Future()
+        self.submitted_at = time.perf_counter()
+
+
+class WriteQueue:
+    """單一檔案的寫入執行緒與有上限的佇列"""
+
+    MAX_SIZE = 64          # 佇列中最多等待的修改數
+    SUBMIT_TIMEOUT = 10.0  # 佇列已滿時最多等待的秒數
+
+    def __init__(self, path, maxsize=None):
+        self.path = os.path.abspath(path)
+        self._queue = queue.Queue(maxsize=maxsize or self.MAX_SIZE)
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'max_depth': 0,
+            'last_wait_ms': 0.0, 'max_wait_ms': 0.0, 'total_wait_ms': 0.0,
+            'last_run_ms': 0.0, 'max_run_ms': 0.0, 'total_run_ms': 0.0
+        }
+
+    def in_writer(self):
+        """目前是否在本佇列的寫入執行緒中"""
+        return threading.current_thread() is self._thread
+
+    def submit(self, fn, *args, **kwargs):
+        """把修改排入佇列，回傳 Future；佇列已滿且逾時時拋出 WriteQueueFull"""
+        app = current_app._get_current_object() if has_app_context() else None
+        task = _Task(fn, args, kwargs, app)
+        self._ensure_thread()
+        try:
+            self._queue.put(task, timeout=self.SUBMIT_TIMEOUT)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats['rejected'] += 1
+            raise WriteQueueFull(f'{os.path.basename(self.path)} 寫入佇列已滿，請稍後再試')
+        with self._stats_lock:
+            self._stats['submitted'] += 1
+            self._stats['max_depth'] = max(self._stats['max_depth'], self._queue.qsize())
+        return task.future
+
+    def call(self, fn, *args, **kwargs):
+        """在寫入執行緒執行並等待結果（例外原樣拋出）；已在寫入執行緒中時直接執行"""
+        if self.in_writer():
+            return fn(*args, **kwargs)
+        return self.submit(fn, *args, **kwargs).result()
+
+    def _ensure_thread(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, daemon=True,
+                                                name=f"write-queue-{os.path.basename(self.path)}")
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            task = self._queue.get()
+            if not task.future.set_running_or_notify_cancel():
+                continue
+            started = time.perf_counter()
+            try:
+                if task.app is not None:
+                    with task.app.app_context():
+                        result = task.fn(*task.args, **task.kwargs)
+                else:
+                    result = task.fn(*task.args, **task.kwargs)
+            except BaseException as e:
+                self._record(task, started, failed=True)
+                task.future.set_exception(e)
+            else:
+                self._record(task, started, failed=False)
+                task.future.set_result(result)
+
+    def _record(self, task, started, failed):
+        wait_ms = (started - task.submitted_at) * 1000
+        run_ms = (time.perf_counter() - started) * 1000
+        with self._stats_lock:
+            s = self._stats
+            s['failed' if failed else 'completed'] += 1
+            s['last_wait_ms'] = round(wait_ms, 1)
+            s['max_wait_ms'] = round(max(s['max_wait_ms'], wait_ms), 1)
+            s['total_wait_ms'] = round(s['total_wait_ms'] + wait_ms, 1)
+            s['last_run_ms'] = round(run_ms, 1)
+            s['max_run_ms'] = round(max(s['max_run_ms'], run_ms), 1)
+            s['total_run_ms'] = round(s['total_run_ms'] + run_ms, 1)
+
+    def stats(self):
+        with self._stats_lock:
+            result = dict(self._stats)
+        done = result['completed'] + result['failed']
+        result['depth'] = self._queue.qsize()
+        result['avg_wait_ms'] = round(result['total_wait_ms'] / done, 1) if done else 0.0
+        result['avg_run_ms'] = round(result['total_run_ms'] / done, 1) if done else 0.0
+        return result
+
+
+# {abspath: WriteQueue}
+_QUEUES = {}
+_QUEUES_LOCK = threading.Lock()
+
+
+def get_write_queue(path):
+    path = os.path.abspath(path)
+    with _QUEUES_LOCK:
+        write_queue = _QUEUES.get(path)
+        if write_queue is None:
+            write_queue = _QUEUES[path] = WriteQueue(path)
+        return write_queue
+
+
+def write_queue_stats():
+    """各檔案寫入佇列的統計 {檔名: stats}"""
+    with _QUEUES_LOCK:
+        queues = list(_QUEUES.values())
+    return {os.path.basename(q.path): q.stats() for q in queues}
@@ -0,0 +1,225 @@
+"""
+xlsx 儲存格直接修補
+只改寫受影響分頁的 sheetN.xml（以字串層級替換目標儲存格），其餘 zip 成員內容原封不動複製，
+不經過 openpyxl 的整本活頁簿解析與重新序列化（樣式、共用字串、註解都不會被改寫）。
+只支援修改既有列上的值；需要新增列、覆蓋公式等結構性修改時拋出 PatchUnsupported，由呼叫者改用 openpyxl。
+"""
+import copy
+import html
+import os
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from datetime import date, datetime
+
+from openpyxl.utils import column_index_from_string, get_column_letter
+
+from .atomic_file import atomic_write
+from .workbook import sheet_members
+
+_NS_MAIN = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
+_SHEET_DATA = re.compile(r'<sheetData\b[^>]*?(?:/>|>(.*?)</sheetData>)', re.S)
+_ROW = re.compile(r'<row\b[^>]*?/>|<row\b[^>]*>.*?</row>', re.S)
+_CELL = re.compile(r'<c\b[^>]*?/>|<c\b[^>]*>.*?</c>', re.S)
+_OPEN_TAG = re.compile(r'<(?:row|c)\b[^>]*?/?>', re.S)
+_ROW_REF = re.compile(r'\br="(\d+)"')
+_CELL_REF = re.compile(r'\br="([A-Z]+)(\d+)"')
+_ATTR = re.compile(r'\s([\w:]+)="([^"]*)"')
+_VALUE = re.compile(r'<v>(.*?)</v>', re.S)
+_TEXT = re.compile(r'<t\b[^>]*>(.*?)</t>', re.S)
+_SPANS = re.compile(r'\bspans="(\d+):(\d+)"')
+_DIMENSION = re.compile(r'<dimension\b[^>]*\bref="[A-Z]+\d+:([A-Z]+)\d+"')
+
+
+class PatchUnsupported(Exception):
+    """無法以直接修補完成的修改（呼叫者改用 openpyxl）"""
+
+
+def _number(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def _cell_xml(attrs, value):
+    """依值的型別產生儲存格 XML；保留原儲存格的樣式等屬性（型別 t 依新值決定）"""
+    attrs = ''.join(f' {k}="{v}"' for k, v in attrs.items() if k != 't')
+    if value is None or value == '':
+        return f'<c{attrs}/>'
+    if isinstance(value, (datetime, date)):
+        raise PatchUnsupported('日期儲存格需要數值格式')
+    if isinstance(value, bool):
+        return f'<c{attrs} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        if isinstance(value, float) and (value != value or value in (float('inf'), float('-inf'))):
+            raise PatchUnsupported(f'無法寫入的數值: {value}')
+        return f'<c{attrs}><v>{value!r}</v></c>'
+    text = html.escape(str(value), quote=False)
+    space = ' xml:space="preserve"' if text != text.strip() else ''
+    return f'<c{attrs} t="inlineStr"><is><t{space}>{text}</t></is></c>'
+
+
+class _Row:
+    def __init__(self, xml):
+        self.open_tag = _OPEN_TAG.match(xml).group(0)
+        self.cells = {}  # 欄號 (1 起算) -> 儲存格 XML，維持欄位順序
+        if self.open_tag.endswith('/>'):
+            self.open_tag = self.open_tag[:-2].rstrip() + '>'
+            return
+        for cell in _CELL.findall(xml):
+            ref = _CELL_REF.search(_OPEN_TAG.match(cell).group(0))
+            if ref is None:
+                raise PatchUnsupported('儲存格缺少位置屬性')
+            self.cells[column_index_from_string(ref.group(1))] = cell
+
+    def xml(self):
+        return self.open_tag + ''.join(self.cells[col] for col in sorted(self.cells)) + '</row>'
+
+
+class SheetXml:
+    """單一分頁的 XML，提供依 (列, 欄)（皆 1 起算，同 openpyxl）讀寫值"""
+
+    def __init__(self, data, shared_strings):
+        self._text = data.decode('utf-8')
+        self._shared_strings = shared_strings
+        match = _SHEET_DATA.search(self._text)
+        if match is None:
+            raise PatchUnsupported('找不到 sheetData')
+        self._head, self._tail = self._text[:match.start()], self._text[match.end():]
+        body = match.group(1) or ''
+        self._open = match.group(0)[:match.group(0).index('>') + 1]
+        if self._open.endswith('/>'):
+            self._open = self._open[:-2].rstrip() + '>'
+        self._rows = {}  # 列號 -> 原始 XML 或已解析的 _Row
+        for row in _ROW.findall(body):
+            ref = _ROW_REF.search(_OPEN_TAG.match(row).group(0))
+            if ref is None:
+                raise PatchUnsupported('列缺少位置屬性')
+            self._rows[int(ref.group(1))] = row
+        dimension = _DIMENSION.search(self._head)
+        self._max_col = column_index_from_string(dimension.group(1)) if dimension else None
+        self.modified = False
+
+    @property
+    def max_row(self):
+        return max(self._rows, default=0)
+
+    def _row(self, row):
+        value = self._rows.get(row)
+        if isinstance(value, str):
+            value = self._rows[row] = _Row(value)
+        return value
+
+    def value(self, row, col):
+        """儲存格的值（數值、字串、布林；空白為 None）；公式儲存格回傳快取的計算結果"""
+        r = self._row(row)
+        cell = r.cells.get(col) if r is not None else None
+        if cell is None:
+            return None
+        attrs = dict(_ATTR.findall(_OPEN_TAG.match(cell).group(0)))
+        kind = attrs.get('t', 'n')
+        if kind == 'inlineStr':
+            texts = _TEXT.findall(cell)
+            return html.unescape(''.join(texts)) if texts else None
+        v = _VALUE.search(cell)
+        if v is None:
+            return None
+        text = html.unescape(v.group(1))
+        if kind == 's':
+            return self._shared_strings()[int(text)]
+        if kind == 'b':
+            return text == '1'
+        if kind in ('str', 'e'):
+            return text
+        return _number(text)
+
+    def row_values(self, row, max_col=None):
+        """單列的值 tuple（至 max_col 欄，預設為該列最後一個儲存格）"""
+        r = self._row(row)
+        if r is None:
+            return ()
+        max_col = max_col or max(r.cells, default=0)
+        return tuple(self.value(row, col) for col in range(1, max_col + 1))
+
+    def column(self, col, min_row=2):
+        """單欄自 min_row 至最後一列的值（不存在的列為 None），列位置與 openpyxl iter_rows 相同"""
+        return [self.value(row, col) if row in self._rows else None for row in range(min_row, self.max_row + 1)]
+
+    def set(self, row, col, value):
+        r = self._row(row)
+        if r is None:
+            raise PatchUnsupported(f'第 {row} 列不存在')
+        cell = r.cells.get(col)
+        if cell is None:
+            spans = _SPANS.search(r.open_tag)
+            if (self._max_col is not None and col > self._max_col) or (spans and not int(spans.group(1)) <= col <= int(spans.group(2))):
+                raise PatchUnsupported(f'第 {col} 欄超出分頁範圍')
+            attrs = {'r': f'{get_column_letter(col)}{row}'}
+        else:
+            if '<f' in cell:
+                raise PatchUnsupported(f'{get_column_letter(col)}{row} 為公式儲存格')
+            attrs = dict(_ATTR.findall(_OPEN_TAG.match(cell).group(0)))
+        r.cells[col] = _cell_xml(attrs, value)
+        self.modified = True
+
+    def tobytes(self):
+        rows = ''.join(self._rows[row] if isinstance(self._rows[row], str) else self._rows[row].xml()
+                       for row in sorted(self._rows))
+        return (self._head + self._open + rows + '</sheetData>' + self._tail).encode('utf-8')
+
+
+class WorkbookPatch:
+    """以 with 使用：修改 sheet() 取得的分頁後呼叫 save()，只改寫有修改的分頁成員"""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._zf = zipfile.ZipFile(self.path)
+        self._members = sheet_members(self._zf)
+        self._sheets = {}
+        self._shared = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._zf.close()
+
+    @property
+    def sheet_names(self):
+        return [name for name, _ in self._members]
+
+    def _shared_strings(self):
+        if self._shared is None:
+            try:
+                root = ET.fromstring(self._zf.read('xl/sharedStrings.xml'))
+            except KeyError:
+                root = None
+            # 與 openpyxl 相同：取 <t> 與 rich text <r><t>，略過注音 <rPh>
+            self._shared = [] if root is None else [
+                ''.join(t.text or '' for t in si.findall(f'{_NS_MAIN}t') + si.findall(f'{_NS_MAIN}r/{_NS_MAIN}t'))
+                for si in root.iter(f'{_NS_MAIN}si')]
+        return self._shared
+
+    def sheet(self, sheet):
+        """依分頁索引或名稱取得 SheetXml"""
+        if isinstance(sheet, str):
+            sheet = self.sheet_names.index(sheet)
+        if sheet not in self._sheets:
+            self._sheets[sheet] = SheetXml(self._zf.read(self._members[sheet][1]), self._shared_strings)
+        return self._sheets[sheet]
+
+    def save(self):
+        """原子寫入（同目錄暫存檔 + fsync + 取代原檔）；回傳是否有修改"""
+        patched = {self._members[idx][1]: sheet.tobytes() for idx, sheet in self._sheets.items() if sheet.modified}
+        if not patched:
+            return False
+        with atomic_write(self.path, prefix='.~patch-') as tmp_path:
+            with zipfile.ZipFile(tmp_path, 'w') as out:
+                for info in self._zf.infolist():
+                    data = patched.get(info.filename)
+                    if data is None:
+                        data = self._zf.read(info)
+                    out.writestr(copy.copy(info), data, compress_type=info.compress_type)
+        return True
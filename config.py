@@ -11,6 +11,15 @@ class Config:
     PICKING_FILE = os.path.join(DATA_DIR, '成品撥料.XLSX')
     PICKING_API_URL = "http://192.168.6.119:5002/api/finished_materials"
     PICKING_DETAILS_API_URL = "http://192.168.6.119:5002/api/demand_details/all"
+    # 鑄件盤點資料讀取引擎（依序嘗試，失敗時退回下一個）
+    CASTING_READER_ENGINES = ('calamine', 'openpyxl')
+    # 儲存格修改的寫入日誌（尚未寫回 Excel 的修改，啟動時重新套用）
+    EDIT_JOURNAL_FILE = os.path.join(BASE_DIR, 'logs', 'edit_journal.db')
+    # 修改歷程（只附加；第一次啟動時匯入舊版 logs/edit_history.json）
+    EDIT_HISTORY_FILE = os.path.join(BASE_DIR, 'logs', 'edit_history.db')
+    # 鑄件盤點資料的來源：'excel' 直接讀寫活頁簿；'sqlite' 以資料庫為準，活頁簿在背景重新產生
+    CASTING_STORE = os.environ.get('CASTING_STORE', 'excel')
+    CASTING_DB_FILE = os.path.join(BASE_DIR, 'logs', 'casting_store.db')
 
     
     # 應用程式設定
@@ -0,0 +1,163 @@
+"""
+比較 load_casting_inventory 的逐列迴圈 (舊版) 與欄式彙總 (新版)
+1. 確認兩者產生完全相同的 summary / semi_finished / finished / details / all_models
+2. 量測各自的彙總耗時 (不含讀取 Excel)
+
+用法: python scratch/bench_casting_aggregation.py [鑄件盤點資料.xlsx] [重複次數]
+"""
+import os
+import sys
+import time
+
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+from app.models.inventory import (
+    CONFIGS, SEMI_FINISHED_FIELDS, FINISHED_FIELDS, normalize_model_name,
+    _aggregate_part_frame, _merge_part_models
+)
+
+PARTS = [('底座', 1), ('工作台', 2), ('橫樑', 3), ('立柱', 4), ('定樑', 7)]
+PART_ORDER = ['底座', '工作台', '橫樑', '立柱', '定樑']
+
+
+def master_models(frames):
+    """與 _get_master_model_list 相同的機型清單 (不經快取)"""
+    all_models = {}
+    seen = set()
+    df_summary = frames[0]
+    model_col = '機型' if '機型' in df_summary.columns else df_summary.columns[0]
+    sources = [df_summary[model_col]] + [frames[idx].iloc[:, 1] for _, idx in PARTS if frames[idx].shape[1] > 1]
+    for col in sources:
+        for m in col.dropna().unique():
+            model_str = str(m).strip()
+            if 'VW-X340' in model_str:
+                continue
+            if model_str and model_str not in ['nan', '品號', '機型']:
+                norm = normalize_model_name(model_str)
+                if norm not in seen:
+                    all_models[model_str] = True
+                    seen.add(norm)
+    return list(all_models.keys())
+
+
+def init_models(master):
+    all_models = {}
+    normalized_map = {}
+    for model_str in master:
+        all_models[model_str] = {'機型': model_str, '底座': 0, '工作台': 0, '橫樑': 0, '立柱': 0, '定樑': 0}
+        norm = normalize_model_name(model_str)
+        if norm and norm not in normalized_map:
+            normalized_map[norm] = model_str
+    return all_models, normalized_map
+
+
+def finish(inventory, semi_finished, finished, all_models):
+    return {
+        'summary': {k: inventory.get(k, 0) for k in PART_ORDER},
+        'semi_finished': {k: semi_finished.get(k, 0) for k in PART_ORDER},
+        'finished': {k: finished.get(k, 0) for k in PART_ORDER},
+        'details': list(all_models.values()),
+        'all_models': all_models
+    }
+
+
+def aggregate_loop(frames, master):
+    """舊版 iterrows + 三層迴圈 (自 load_casting_inventory 原樣保留)"""
+    inventory, semi_finished, finished = {}, {}, {}
+    all_models, normalized_map = init_models(master)
+    for part_name, sheet_idx in PARTS:
+        df = frames[sheet_idx]
+        config = CONFIGS.get(part_name, [])
+        process_col_indices = [idx for label, idx in config if label != '總數']
+        field_to_idx = {label: idx for label, idx in config}
+        part_total = part_semi = part_finished = 0
+        if '機型' in df.columns:
+            for _, row in df.iterrows():
+                model = row.get('機型', '')
+                if pd.notna(model) and str(model).strip() and str(model).strip() != '品號':
+                    model_str = str(model).strip()
+                    norm_key = normalize_model_name(model_str)
+                    if norm_key in normalized_map:
+                        model_str = normalized_map[norm_key]
+                    if model_str not in all_models:
+                        all_models[model_str] = {'機型': model_str, '底座': 0, '工作台': 0, '橫樑': 0, '立柱': 0, '定樑': 0}
+                        if norm_key: normalized_map[norm_key] = model_str
+                    row_total = row_semi = row_finished = 0
+                    for col_idx in process_col_indices:
+                        if col_idx < len(row):
+                            val = row.iloc[col_idx]
+                            if pd.notna(val):
+                                try:
+                                    row_total += int(float(val))
+                                except:
+                                    pass
+                    for field_name in SEMI_FINISHED_FIELDS.get(part_name, []):
+                        if field_name in field_to_idx and field_to_idx[field_name] < len(row):
+                            val = row.iloc[field_to_idx[field_name]]
+                            if pd.notna(val):
+                                try:
+                                    row_semi += int(float(val))
+                                except:
+                                    pass
+                    for field_name in FINISHED_FIELDS.get(part_name, []):
+                        if field_name in field_to_idx and field_to_idx[field_name] < len(row):
+                            val = row.iloc[field_to_idx[field_name]]
+                            if pd.notna(val):
+                                try:
+                                    row_finished += int(float(val))
+                                except:
+                                    pass
+                    all_models[model_str][part_name] += row_total
+                    part_total += row_total
+                    part_semi += row_semi
+                    part_finished += row_finished
+        inventory[part_name] = part_total
+        semi_finished[part_name] = part_semi
+        finished[part_name] = part_finished
+    return finish(inventory, semi_finished, finished, all_models)
+
+
+def aggregate_columnar(frames, master):
+    """新版欄式彙總 (_aggregate_part_frame + _merge_part_models)"""
+    inventory, semi_finished, finished = {}, {}, {}
+    all_models, normalized_map = init_models(master)
+    for part_name, sheet_idx in PARTS:
+        part = _aggregate_part_frame(frames[sheet_idx], part_name)
+        _merge_part_models(part_name, part['models'], all_models, normalized_map)
+        inventory[part_name] = part['total']
+        semi_finished[part_name] = part['semi']
+        finished[part_name] = part['finished']
+    return finish(inventory, semi_finished, finished, all_models)
+
+
+def bench(fn, frames, master, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        result = fn(frames, master)
+    return result, (time.perf_counter() - t0) / repeat * 1000
+
+
+if __name__ == '__main__':
+    casting_file = sys.argv[1] if len(sys.argv) > 1 else os.path.join(BASE_DIR, '鑄件盤點資料.xlsx')
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    xl = pd.ExcelFile(casting_file, engine='openpyxl')
+    frames = {idx: pd.read_excel(xl, sheet_name=idx) for idx in [0] + [i for _, i in PARTS]}
+    master = master_models(frames)
+
+    loop_result, loop_ms = bench(aggregate_loop, frames, master, repeat)
+    col_result, col_ms = bench(aggregate_columnar, frames, master, repeat)
+
+    same = (loop_result == col_result and
+            list(loop_result['all_models']) == list(col_result['all_models']))
+    print(f"rows: {sum(frames[i].shape[0] for _, i in PARTS)}, models: {len(col_result['details'])}")
+    print(f"iterrows loop : {loop_ms:8.2f} ms")
+    print(f"columnar      : {col_ms:8.2f} ms  ({loop_ms / col_ms:.1f}x)")
+    print(f"identical     : {same}")
+    if not same:
+        for key in ['summary', 'semi_finished', 'finished']:
+            if loop_result[key] != col_result[key]:
+                print(f"  {key}: loop={loop_result[key]} columnar={col_result[key]}")
+        sys.exit(1)
@@ -0,0 +1,66 @@
+"""
+比較鑄件盤點資料單一分頁變更後的完整重新解析與分頁增量重新解析
+1. 複製活頁簿並以 openpyxl 存檔一次（與系統寫入後的檔案格式相同）
+2. 修改「立柱」一個儲存格後，分別量測完整解析與沿用未變更分頁的耗時（含各零件彙總）
+3. 確認兩者的分頁資料與彙總結果完全相同
+
+用法: python scratch/bench_sheet_reload.py [鑄件盤點資料.xlsx] [重複次數]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from functools import partial
+
+import openpyxl
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+from app.models.workbook import WorkbookSnapshot
+from app.models.inventory import SHEET_MAP, _aggregate_part_frame
+
+
+def build(path, previous):
+    snapshot = WorkbookSnapshot(path, previous=previous)
+    aggregates = {part: snapshot.derived(idx, 'aggregate', partial(_aggregate_part_frame, part_name=part))
+                  for part, idx in SHEET_MAP.items()}
+    return snapshot, aggregates
+
+
+def bench(path, previous, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        result = build(path, previous)
+    return result, (time.perf_counter() - t0) / repeat * 1000
+
+
+if __name__ == '__main__':
+    casting_file = sys.argv[1] if len(sys.argv) > 1 else os.path.join(BASE_DIR, '鑄件盤點資料.xlsx')
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    work_dir = tempfile.mkdtemp(prefix='sheet_reload_')
+    path = os.path.join(work_dir, os.path.basename(casting_file))
+    shutil.copy(casting_file, path)
+    openpyxl.load_workbook(path).save(path)
+
+    base, _ = build(path, None)
+
+    wb = openpyxl.load_workbook(path)
+    ws = wb['立柱']
+    cell = ws.cell(row=2, column=3)
+    cell.value = (cell.value or 0) + 1 if isinstance(cell.value, (int, float)) or cell.value is None else 1
+    wb.save(path)
+
+    (full, full_agg), full_ms = bench(path, None, repeat)
+    (incr, incr_agg), incr_ms = bench(path, base, repeat)
+
+    same = (full_agg == incr_agg and
+            all(f.equals(i) for f, i in zip(full._frames, incr._frames)))
+    print(f"reused sheets : {[incr.sheet_names[i] for i in incr.reused_sheets]}")
+    print(f"full reload   : {full_ms:8.2f} ms")
+    print(f"incremental   : {incr_ms:8.2f} ms  ({full_ms / incr_ms:.1f}x)")
+    print(f"identical     : {same}")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    if not same:
+        sys.exit(1)
@@ -0,0 +1,65 @@
+"""
+鑄件盤點資料.xlsx 讀取引擎比對
+1. 分別以 calamine 與 openpyxl 解析所有分頁，逐格確認正規化後的值完全相同
+2. 量測兩個引擎的解析耗時
+
+用法: python scratch/check_reader_parity.py [鑄件盤點資料.xlsx] [重複次數]
+"""
+import os
+import sys
+import time
+
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+from app.models.workbook import read_workbook_frames
+
+
+def same_cell(a, b):
+    if pd.isna(a) and pd.isna(b):
+        return True
+    return type(a) == type(b) and a == b
+
+
+def compare(frames_a, frames_b, sheet_names):
+    mismatches = []
+    for name, a, b in zip(sheet_names, frames_a, frames_b):
+        if list(a.columns) != list(b.columns):
+            mismatches.append(f"{name}: 表頭不同 {list(a.columns)} != {list(b.columns)}")
+            continue
+        if a.shape != b.shape:
+            mismatches.append(f"{name}: 大小不同 {a.shape} != {b.shape}")
+            continue
+        for r, (row_a, row_b) in enumerate(zip(a.itertuples(index=False), b.itertuples(index=False))):
+            for c, (va, vb) in enumerate(zip(row_a, row_b)):
+                if not same_cell(va, vb):
+                    mismatches.append(f"{name}!R{r + 2}C{c + 1}: {va!r} != {vb!r}")
+    return mismatches
+
+
+def bench(path, engine, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        result = read_workbook_frames(path, engines=(engine,))
+    return result, (time.perf_counter() - t0) / repeat * 1000
+
+
+if __name__ == '__main__':
+    casting_file = sys.argv[1] if len(sys.argv) > 1 else os.path.join(BASE_DIR, '鑄件盤點資料.xlsx')
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    (_, names_o, frames_o), openpyxl_ms = bench(casting_file, 'openpyxl', repeat)
+    (_, names_c, frames_c), calamine_ms = bench(casting_file, 'calamine', repeat)
+
+    print(f"openpyxl : {openpyxl_ms:8.1f} ms")
+    print(f"calamine : {calamine_ms:8.1f} ms  ({openpyxl_ms / calamine_ms:.1f}x)")
+
+    if names_o != names_c:
+        print(f"分頁名稱不同: {names_o} != {names_c}")
+        sys.exit(1)
+    mismatches = compare(frames_o, frames_c, names_o)
+    print(f"分頁數: {len(names_o)}, 差異: {len(mismatches)}")
+    for m in mismatches[:20]:
+        print(f"  {m}")
+    sys.exit(1 if mismatches else 0)